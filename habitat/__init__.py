@@ -30,6 +30,8 @@ See http://habitat.habhub.org for more information.
 
     habitat.parser
     habitat.parser_daemon
+    habitat.parser_benchmark
+    habitat.config_resolver
     habitat.parser_modules
     habitat.loadable_manager
     habitat.sensors
@@ -45,6 +47,7 @@ __authors__ = "Adam Greig, Daniel Richman"
 __short_copyright__ = "2010-2012 " + __authors__
 __copyright__ = "Copyright " + __short_copyright__
 
+from . import config_resolver
 from . import filters
 from . import parser
 from . import parser_daemon
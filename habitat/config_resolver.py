@@ -0,0 +1,249 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resolve callsigns to payload_configuration documents from memory.
+
+:class:`ConfigResolver` keeps a local mirror of approved flights and all
+payload_configuration documents. It is loaded from views when started and
+then kept up to date by following the ``_changes`` feed through the
+``parser/configs`` filter, so that looking up the configuration for a
+callsign does not cost any requests to CouchDB.
+
+Lookups give the same results as the view queries made by
+:meth:`habitat.parser.Parser._find_config_doc`.
+"""
+
+import time
+import logging
+import threading
+
+from strict_rfc3339 import rfc3339_to_timestamp
+
+from .utils import immortal_changes
+
+logger = logging.getLogger("habitat.config_resolver")
+
+__all__ = ['ConfigResolver', 'PRIORITY_FLIGHT', 'PRIORITY_CONFIG',
+           'PRIORITY_UNKNOWN']
+
+#: Priority of a callsign in an active flight (see
+#: :meth:`ConfigResolver.priority`)
+PRIORITY_FLIGHT = 0
+#: Priority of a callsign with a payload_configuration but no active flight
+PRIORITY_CONFIG = 1
+#: Priority of a callsign with no payload_configuration
+PRIORITY_UNKNOWN = 2
+
+
+class ConfigResolver(object):
+    """
+    An in-memory mirror of flight and payload_configuration documents.
+
+    Documents returned by :meth:`find` are shared with the mirror and
+    must not be modified.
+
+    Functions in :attr:`callbacks` are called with each document received
+    from the ``_changes`` feed, after the mirror has been updated.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.last_seq = None
+
+        # flight id -> (end time, start time, [payload_configuration ids])
+        self.flights = {}
+        # payload_configuration id -> doc
+        self.configs = {}
+        # callsign -> {payload_configuration id: (time created, index)}
+        self.callsigns = {}
+
+        self.callbacks = []
+
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def start(self):
+        """
+        Load the mirror and start following the ``_changes`` feed in a
+        background thread.
+        """
+        self.load()
+        self._thread = threading.Thread(target=self.run,
+                                        name="ConfigResolver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def load(self):
+        """
+        (Re)load the mirror from the database's views.
+
+        ``update_seq`` is read before the views are queried, so following
+        changes from :attr:`last_seq` will replay anything modified while
+        loading rather than miss it.
+        """
+        self.last_seq = self.db.info()["update_seq"]
+
+        t = int(time.time())
+        flights = self.db.view("flight/end_start_including_payloads",
+                               startkey=[t])
+        configs = self.db.view("payload_configuration/name_time_created",
+                               include_docs=True)
+
+        with self._lock:
+            self.flights = {}
+            self.configs = {}
+            self.callsigns = {}
+
+            for row in flights:
+                end, start, flight_id, linked = row["key"]
+                if linked == 0:
+                    self.flights[flight_id] = (end, start, row["value"] or [])
+            for row in configs:
+                self._add_config(row["doc"])
+
+        logger.info("Loaded {0} flights and {1} payload_configurations"
+                    .format(len(self.flights), len(self.configs)))
+
+    def run(self):
+        """Follow the ``_changes`` feed, updating the mirror. Blocks."""
+        consumer = immortal_changes.Consumer(self.db)
+        consumer.wait(self._changes_callback, filter="parser/configs",
+                since=self.last_seq, include_docs=True, heartbeat=1000)
+
+    def _changes_callback(self, result):
+        self.last_seq = result["seq"]
+        if result.get("deleted"):
+            self.remove(result["id"])
+        else:
+            self.update(result["doc"])
+
+        for callback in self.callbacks:
+            callback(result["doc"])
+
+    def update(self, doc):
+        """Add, replace or remove *doc* in the mirror as appropriate."""
+        with self._lock:
+            self._remove(doc["_id"])
+
+            if doc.get("_deleted"):
+                return
+            elif doc.get("type") == "flight" and doc.get("approved"):
+                end = rfc3339_to_timestamp(doc["end"])
+                start = rfc3339_to_timestamp(doc["start"])
+                payloads = doc.get("payloads", [])
+                self.flights[doc["_id"]] = (end, start, payloads)
+                logger.debug("Updated flight {0}".format(doc["_id"]))
+            elif doc.get("type") == "payload_configuration":
+                self._add_config(doc)
+                logger.debug("Updated payload_configuration {0}"
+                             .format(doc["_id"]))
+
+    def remove(self, doc_id):
+        """Forget about the document *doc_id*, if it is mirrored."""
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        self.flights.pop(doc_id, None)
+        config = self.configs.pop(doc_id, None)
+        if config is not None:
+            for sentence in config.get("sentences", []):
+                ids = self.callsigns.get(sentence["callsign"])
+                if ids is not None:
+                    ids.pop(doc_id, None)
+                    if not ids:
+                        del self.callsigns[sentence["callsign"]]
+
+    def _add_config(self, doc):
+        doc_id = doc["_id"]
+        self.configs[doc_id] = doc
+        if "sentences" not in doc:
+            return
+        created = rfc3339_to_timestamp(doc["time_created"])
+        for index, sentence in enumerate(doc["sentences"]):
+            ids = self.callsigns.setdefault(sentence["callsign"], {})
+            ids[doc_id] = (created, index)
+
+    def find(self, callsign):
+        """
+        Find the payload_configuration for *callsign* at the present moment.
+
+        Resolution proceeds exactly as
+        :meth:`habitat.parser.Parser._find_config_doc`: the configurations
+        of active flights are checked in the order the
+        ``flight/end_start_including_payloads`` view would list them, then
+        the most recently created payload_configuration mentioning
+        *callsign* is used.
+
+        Returns a dict with the keys ``id``, ``payload_configuration`` and
+        (if appropriate) ``flight_id``, or None.
+        """
+        t = int(time.time())
+
+        with self._lock:
+            active = [(end, start, flight_id, payloads)
+                      for flight_id, (end, start, payloads)
+                      in self.flights.iteritems()
+                      if end >= t and start < t]
+            active.sort()
+
+            for end, start, flight_id, payloads in active:
+                for config_id in payloads:
+                    config = self.configs.get(config_id)
+                    if config is None:
+                        continue
+                    if self._callsign_in_config(callsign, config):
+                        return {
+                            "id": config_id,
+                            "flight_id": flight_id,
+                            "payload_configuration": config
+                        }
+
+            ids = self.callsigns.get(callsign)
+            if ids:
+                key = lambda i: ids[i] + (i, )
+                config_id = max(ids, key=key)
+                return {
+                    "id": config_id,
+                    "payload_configuration": self.configs[config_id]
+                }
+
+        return None
+
+    def priority(self, callsign):
+        """
+        How urgently telemetry from *callsign* should be parsed:
+        :data:`PRIORITY_FLIGHT` if it is in an active flight,
+        :data:`PRIORITY_CONFIG` if there is a payload_configuration for it,
+        otherwise :data:`PRIORITY_UNKNOWN`. Lower is more urgent.
+        """
+        t = int(time.time())
+
+        with self._lock:
+            ids = self.callsigns.get(callsign)
+            if not ids:
+                return PRIORITY_UNKNOWN
+            for end, start, payloads in self.flights.itervalues():
+                if end >= t and start < t:
+                    for config_id in payloads:
+                        if config_id in ids:
+                            return PRIORITY_FLIGHT
+            return PRIORITY_CONFIG
+
+    def _callsign_in_config(self, callsign, config):
+        return callsign in (s["callsign"] for s in config.get("sentences", []))
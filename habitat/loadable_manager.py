@@ -108,6 +108,7 @@ class LoadableManager:
         """
 
         self.libraries = {}
+        self.resolved = {}
 
         for loadable in config["loadables"]:
             self.load(loadable["class"], loadable["name"])
@@ -117,17 +118,25 @@ class LoadableManager:
 
         module = dynamicloader.load(module)
         self.libraries[shorthand] = module
+        self.resolved.clear()
 
-    def run(self, name, config, data):
+    def resolve(self, name):
         """
-        Run the loadable specified by *name*, giving it *config* and *data*.
+        Find the loadable specified by *name*.
 
-        If the loadable only takes one argument, it will only be given *data*.
-        *config* is ignored in this case.
+        Returns a tuple ``(function, number of arguments)``, where the number
+        of arguments is either 1 (*data* only) or 2 (*config* and *data*).
+        Raises :py:exc:`ValueError <exceptions.ValueError>` if *name* does not
+        refer to a function in a loaded library's ``__all__``.
 
-        Returns the result of running the loadable.
+        Results are cached until the next call to :meth:`load`.
         """
 
+        try:
+            return self.resolved[name]
+        except KeyError:
+            pass
+
         name_parts = name.split('.')
         library_name = '.'.join(name_parts[0:-1])
         function_name = name_parts[-1]
@@ -143,6 +152,26 @@ class LoadableManager:
         func = getattr(library, function_name)
 
         if dynamicloader.hasnumargs(func, 1):
+            result = (func, 1)
+        else:
+            result = (func, 2)
+
+        self.resolved[name] = result
+        return result
+
+    def run(self, name, config, data):
+        """
+        Run the loadable specified by *name*, giving it *config* and *data*.
+
+        If the loadable only takes one argument, it will only be given *data*.
+        *config* is ignored in this case.
+
+        Returns the result of running the loadable.
+        """
+
+        func, num_args = self.resolve(name)
+
+        if num_args == 1:
             return func(data)
         else:
             return func(config, data)
@@ -28,17 +28,19 @@ import couchdbkit
 import copy
 import re
 import json
-import statsd
+import collections
 import time
+import threading
 import strict_rfc3339
 
 from . import loadable_manager
-from .utils import dynamicloader, quick_traceback
+from . import config_resolver
+from .utils import dynamicloader, quick_traceback, immortal_changes
+from .utils import lru_cache, stage_timing, metrics
 
 logger = logging.getLogger("habitat.parser")
-statsd.init_statsd({'STATSD_BUCKET_PREFIX': 'habitat'})
 
-__all__ = ['Parser', 'ParserModule']
+__all__ = ['Parser', 'ParserModule', 'SentenceConfig', 'Sniffed', 'sniff']
 
 
 class Parser(object):
@@ -48,9 +50,17 @@ class Parser(object):
     :class:`Parser` takes arbitrary unparsed  payload telemetry and
     attempts to use each loaded :class:`ParserModule` to turn this telemetry
     into useful data.
+
+    Radiosonde telemetry (callsigns starting with ``radiosonde_override_prefix``)
+    is parsed with the ``radiosonde_override`` payload_configuration, with its
+    name and first sentence's callsign replaced by the radiosonde's. These
+    configurations are built once per callsign and kept in
+    :attr:`rs_configs`; like those from a :class:`ConfigResolver
+    <habitat.config_resolver.ConfigResolver>`, they are shared and must not be
+    modified.
     """
 
-    ascii_exp = re.compile("^[\\x20-\\x7E]+$")
+    rs_cache_size = 1000
 
     def __init__(self, config):
         """
@@ -61,6 +71,29 @@ class Parser(object):
         * Load modules from ``self.config["modules"]``.
         * Connects to CouchDB using ``self.config["couch_uri"]`` and
           ``config["couch_db"]``.
+        * If ``self.config["config_resolver"]`` is true, starts a
+          :class:`ConfigResolver <habitat.config_resolver.ConfigResolver>`
+          to look up payload_configuration documents from memory.
+        * If ``self.config["negative_cache_size"]`` is non-zero, remembers
+          callsigns for which no configuration could be found for up to
+          ``self.config["negative_cache_ttl"]`` seconds (default 300).
+        * If ``self.config["route_cache_size"]`` is non-zero, remembers which
+          module last parsed messages from each receiver and fallback
+          payload callsign, and which sentence of each payload_configuration
+          revision last parsed each callsign (up to that many in all), and
+          tries those first.
+        * If ``self.config["result_cache_size"]`` is non-zero, remembers the
+          data parsed from that many messages, keyed by the SHA-256 of the
+          raw telemetry and the configuration sentence used, so that a
+          message delivered again needn't be filtered or parsed again.
+        * Send metrics to statsd every ``self.config["metrics_interval"]``
+          seconds (default 10), including the time spent in each stage of
+          parsing, and log messages slower than
+          ``self.config["slow_message_threshold"]`` seconds, if set.
+        * If ``config["radiosonde_override"]`` and
+          ``config["radiosonde_override_prefix"]`` are set, loads that
+          payload_configuration for radiosonde telemetry, and reloads it
+          whenever it changes.
         """
 
         config = copy.deepcopy(config)
@@ -85,27 +118,71 @@ class Parser(object):
         self.couch_server = couchdbkit.Server(config["couch_uri"])
         self.db = self.couch_server[config["couch_db"]]
 
-        # Grab the radiosonde override config.
+        metrics.configure(parser_config.get("metrics_interval", 10))
+        self.stage_timings = stage_timing.StageTimings("parser.stages",
+                parser_config.get("slow_message_threshold"))
+        self._local = threading.local()
+
         self.rs_prefix = "RS_"  # Default radiosonde callsign identifier.
+        self.rs_id = None
         self.rs_config = None
+        self.rs_modules = []
+        self.rs_configs = lru_cache.LRUCache(self.rs_cache_size)
         try:
             self.rs_prefix = config["radiosonde_override_prefix"]
-            _rs_config = self.db[config["radiosonde_override"]]
-            self.rs_config = {
-                'payload_configuration': _rs_config,
-                'id': config["radiosonde_override"]}
-            logging.debug(
-                "Loaded radiosonde override payload doc (%s)",
-                config["radiosonde_override"])
+            self.rs_id = config["radiosonde_override"]
         except KeyError as e:
             logging.debug("Could not find key in config - %s", str(e))
-        except couchdbkit.ResourceNotFound as e:
-            logging.debug(
-                "Could not find payload doc %s",
-                config["radiosonde_override"])
 
-    @statsd.StatsdTimer.wrap('parser.time')
-    def parse(self, doc, initial_config=None):
+        self.negative_cache = None
+        self._negative_cache_generation = 0
+        if parser_config.get("negative_cache_size", 0):
+            self.negative_cache = lru_cache.LRUCache(
+                parser_config["negative_cache_size"],
+                parser_config.get("negative_cache_ttl", 300))
+
+        watch_configs = self.negative_cache is not None or \
+                self.rs_id is not None
+
+        # The callback is added before the resolver starts following changes
+        # and before the radiosonde override is fetched, so that no change
+        # to either falls between the two.
+        self.config_resolver = None
+        if parser_config.get("config_resolver", False):
+            self.config_resolver = config_resolver.ConfigResolver(self.db)
+            if watch_configs:
+                self.config_resolver.callbacks.append(self._config_changed)
+            self.config_resolver.start()
+
+        # Without the resolver, the parser follows configuration changes
+        # itself, from before the radiosonde override is fetched.
+        since = None
+        if watch_configs and self.config_resolver is None:
+            since = self.db.info()["update_seq"]
+
+        # Grab the radiosonde override config.
+        if self.rs_id is not None:
+            try:
+                self._load_radiosonde_config(self.db[self.rs_id])
+                logging.debug(
+                    "Loaded radiosonde override payload doc (%s)", self.rs_id)
+            except couchdbkit.ResourceNotFound as e:
+                logging.debug("Could not find payload doc %s", self.rs_id)
+
+        if since is not None:
+            self._start_config_watcher(since)
+
+        self.routes = None
+        if parser_config.get("route_cache_size", 0):
+            self.routes = lru_cache.LRUCache(parser_config["route_cache_size"])
+
+        self.results = None
+        if parser_config.get("result_cache_size", 0):
+            self.results = lru_cache.LRUCache(
+                parser_config["result_cache_size"])
+
+    @metrics.timed("parser.time")
+    def parse(self, doc, initial_config=None, timer=None):
         """
         Attempts to parse telemetry information out of a new telemetry
         document *doc*.
@@ -133,10 +210,27 @@ class Parser(object):
 
         Parser modules should be wary when outputting field names with
         leading underscores.
+
+        The time spent in each stage is added to *timer*, if given, and the
+        caller should pass it to :attr:`stage_timings` once finished with the
+        message; otherwise a timer is created and recorded here.
         """
+        record = timer is None
+        if record:
+            timer = stage_timing.StageTimer(doc.get("_id"))
+
+        self._local.timer = timer
+        try:
+            return self._parse(doc, initial_config, timer)
+        finally:
+            self._local.timer = None
+            if record:
+                self.stage_timings.record(timer)
+
+    def _parse(self, doc, initial_config, timer):
         data = None
         raw_data = base64.b64decode(doc['data']['_raw'])
-        debug_type, debug_data = self._get_debug(raw_data)
+        sniffed = sniff(raw_data)
         receiver_callsign = doc['receivers'].keys()[0]
 
         if '_fallbacks' in doc['data']:
@@ -144,16 +238,39 @@ class Parser(object):
         else:
             fallbacks = {}
 
-        logger.info("Parsing [{type}] {data!r} ({id}) from {who}"
-                    .format(id=doc["_id"], data=debug_data, type=debug_type,
-                            who=receiver_callsign.encode("ascii", "replace")))
+        if sniffed.kind == "binary":
+            metrics.increment("parser.binary_doc")
+        else:
+            metrics.increment("parser.ascii_doc")
+
+        if logger.isEnabledFor(logging.INFO):
+            debug_type, debug_data = self._get_debug(raw_data, sniffed)
+            logger.info("Parsing [{type}] {data!r} ({id}) from {who}"
+                        .format(id=doc["_id"], data=debug_data,
+                                type=debug_type,
+                                who=receiver_callsign.encode("ascii",
+                                                             "replace")))
+
+        hints = self._route_hints(receiver_callsign, fallbacks)
+        route = self._find_route(hints)
+        if initial_config is None and \
+                self._is_radiosonde(raw_data, sniffed, fallbacks):
+            metrics.increment("parser.radiosonde")
+            modules = self.rs_modules
+        else:
+            modules = self._module_order(route, fallbacks, initial_config)
 
-        for module in self.modules:
-            config = copy.deepcopy(initial_config)
+        for module in modules:
+            config = initial_config
+            timer.config_id = None
             try:
                 callsign = self._get_callsign(raw_data, fallbacks, module)
-                config = self._get_config(callsign, config)
-                data = self._get_data(raw_data, callsign, config, module)
+                with timer.stage("config", module["name"]):
+                    config = self._get_config(callsign, config)
+                timer.config_id = config["id"]
+                data = self._get_data(raw_data, callsign, config, module,
+                                      self._find_sentence(callsign, config),
+                                      provided=initial_config is not None)
                 if fallbacks:
                     for k, v in fallbacks.iteritems():
                         if k not in data:
@@ -163,49 +280,195 @@ class Parser(object):
                 pass
 
         if type(data) is dict:
+            self._learn_route(hints, route, module, callsign, config, data)
             doc['data'].update(data)
             logger.info("{module} parsed data from {callsign} successfully"
                         .format(module=module["name"], callsign=callsign))
             logger.debug("Parsed data: " + json.dumps(data, indent=2))
-            statsd.increment("parser.parsed")
+            metrics.increment("parser.parsed")
             if "_protocol" in data:
-                statsd.increment(
-                    "parser.protocol.{0}".format(data['_protocol']))
+                metrics.increment(_buckets(data["_protocol"]).protocol)
             return doc
         else:
             logger.info("All attempts to parse failed")
-            statsd.increment("parser.failed")
+            metrics.increment("parser.failed")
             return None
 
-    def _get_debug(self, raw_data):
-        if self.ascii_exp.search(raw_data):
-            statsd.increment("parser.ascii_doc")
-            return 'ascii', raw_data
+    def _route_hints(self, receiver_callsign, fallbacks):
+        """
+        Keys under which the route taken by this message is remembered: the
+        fallback payload callsign (if any) and the receiver's callsign.
+        """
+        if self.routes is None:
+            return ()
+        if "payload" in fallbacks:
+            return (("payload", fallbacks["payload"]),
+                    ("receiver", receiver_callsign))
+        return (("receiver", receiver_callsign), )
+
+    def _find_route(self, hints):
+        """
+        The name of the module that last parsed a message with any of
+        *hints*, or None.
+        """
+        for hint in hints:
+            route = self.routes.get(hint)
+            if route is not None:
+                metrics.increment("parser.route_hit")
+                return route
+        return None
+
+    def _sentence_key(self, callsign, config):
+        """
+        The key under which the sentence of *config* that last parsed
+        *callsign*'s telemetry is remembered, or None if *config* has no ID.
+
+        Sentence indexes only mean something for one revision of one
+        payload_configuration, so (unlike modules) they are not remembered
+        per receiver.
+        """
+        if self.routes is None or config.get("id") is None:
+            return None
+        rev = config.get("payload_configuration", {}).get("_rev")
+        return ("sentence", config["id"], rev, callsign)
+
+    def _find_sentence(self, callsign, config):
+        """
+        The index of the sentence of *config* that last parsed telemetry
+        from *callsign*, or None.
+        """
+        key = self._sentence_key(callsign, config)
+        if key is None:
+            return None
+        return self.routes.get(key)
+
+    def _learn_route(self, hints, route, module, callsign, config, data):
+        """Remember which module and sentence parsed this message."""
+        if module["name"] != route:
+            for hint in hints:
+                self.routes.put(hint, module["name"])
+
+        key = self._sentence_key(callsign, config)
+        index = data["_parsed"]["configuration_sentence_index"]
+        if key is not None and self.routes.get(key) != index:
+            self.routes.put(key, index)
+
+    def _module_order(self, route, fallbacks, initial_config):
+        """
+        The order in which to try modules: the one that last parsed a
+        similar message first, then those used by the protocols of the
+        payload_configuration that will probably be used, then the rest in
+        the configured order.
+
+        The payload_configuration is only consulted if it is to hand, i.e.
+        *initial_config* was given or there is a fallback payload callsign
+        and a :class:`ConfigResolver <habitat.config_resolver.ConfigResolver>`
+        to look it up in.
+        """
+        preferred = []
+        if route is not None:
+            preferred.append(route)
+
+        config = initial_config
+        if config is None and self.config_resolver is not None and \
+                "payload" in fallbacks:
+            found = self.config_resolver.find(fallbacks["payload"])
+            if found is not None:
+                config = found["payload_configuration"]
+        if config is not None:
+            for sentence in config.get("sentences", []):
+                if sentence.get("protocol") not in preferred:
+                    preferred.append(sentence.get("protocol"))
+
+        if not preferred:
+            return self.modules
+
+        first = [m for name in preferred
+                   for m in self.modules if m["name"] == name]
+        return first + [m for m in self.modules if m["name"] not in preferred]
+
+    def _is_radiosonde(self, raw_data, sniffed, fallbacks):
+        """
+        Whether the message is (probably) from a radiosonde, judging by the
+        start of a UKHAS sentence or the fallback payload callsign, so that
+        only the modules used by the radiosonde override need be tried.
+        """
+        if self.rs_config is None or not self.rs_modules:
+            return False
+        if sniffed.kind == "ukhas" and raw_data.startswith(self.rs_prefix, 2):
+            return True
+        return fallbacks.get("payload", "").startswith(self.rs_prefix)
+
+    def _radiosonde_config(self, callsign):
+        """
+        The radiosonde override config with its callsign replaced by
+        *callsign*, built on first use and then kept in :attr:`rs_configs`.
+
+        Only the dicts that differ are copied; everything else is shared with
+        the override document.
+        """
+        base = self.rs_config
+        cached = self.rs_configs.get(callsign)
+        if cached is not None and cached[0] is base:
+            return cached[1]
+
+        doc = base["payload_configuration"]
+        sentences = list(doc["sentences"])
+        # Replace the callsign fields within the config
+        # to keep the downstream parsers happy.
+        sentences[0] = dict(sentences[0], callsign=callsign)
+        config = {"id": base["id"],
+                  "payload_configuration": dict(doc, name=callsign,
+                                                sentences=sentences)}
+        self.rs_configs.put(callsign, (base, config))
+        return config
+
+    def _load_radiosonde_config(self, doc):
+        """
+        Use *doc* (the latest revision of the radiosonde override
+        payload_configuration) from now on.
+        """
+        if doc.get("_deleted"):
+            self.rs_config = None
+            self.rs_modules = []
         else:
-            statsd.increment("parser.binary_doc")
+            protocols = []
+            for sentence in doc.get("sentences", []):
+                if sentence.get("protocol") not in protocols:
+                    protocols.append(sentence.get("protocol"))
+            self.rs_modules = [m for name in protocols
+                                 for m in self.modules if m["name"] == name]
+            self.rs_config = {'payload_configuration': doc, 'id': doc["_id"]}
+        self.rs_configs.clear()
+
+    def _get_debug(self, raw_data, sniffed):
+        if sniffed.kind == "binary":
             return 'b64', base64.b64encode(raw_data)
+        else:
+            return 'ascii', raw_data
 
     def _get_callsign(self, raw_data, fallbacks, module):
         """Attempt to find a callsign from the data."""
-        raw_data = self.filtering.pre_filter(raw_data, module)
+        with self._stage("pre_filter", module):
+            raw_data = self.filtering.pre_filter(raw_data, module)
 
         try:
-            callsign = module["module"].pre_parse(raw_data)
+            with self._stage("pre_parse", module):
+                callsign = module["module"].pre_parse(raw_data)
         except CantParse as e:
             logger.debug("CantParse exception in {module}: {e}"
                          .format(e=quick_traceback.oneline(e),
                                  module=module['name']))
-            statsd.increment("parser.{0}.cantparse".format(module['name']))
+            metrics.increment(_buckets(module["name"]).cantparse)
             raise CantGetCallsign()
         except CantExtractCallsign as e:
             logger.debug("CantExtractCallsign exception in {m}: {e}"
                          .format(e=quick_traceback.oneline(e),
                                  m=module['name']))
-            statsd.increment("parser.{0}.cantextractcallsign"
-                             .format(module['name']))
+            metrics.increment(_buckets(module["name"]).cantextractcallsign)
             if 'payload' in fallbacks:
                 logger.debug("Could not find callsign but using fallback.")
-                statsd.increment("parser.fallback_callsign")
+                metrics.increment("parser.fallback_callsign")
                 return fallbacks['payload']
             else:
                 raise CantGetCallsign()
@@ -222,20 +485,26 @@ class Parser(object):
                          .format(c=callsign))
             raise CantGetConfig()
         elif config:
-            if "_id" not in config:
-                config["_id"] = None
+            # The provided config is not modified, so needn't be copied.
+            config_id = config.get("_id")
             logger.debug("payload_configuration provided (id: {0})"
-                    .format(config["_id"]))
-            return {"id": config["_id"], "payload_configuration": config}
+                    .format(config_id))
+            return {"id": config_id, "payload_configuration": config}
+
+        generation = self._negative_cache_generation
 
         if (self.rs_config != None) and callsign.startswith(self.rs_prefix):
-            logging.debug(
+            logger.debug(
                 "Overriding payload doc lookup for radiosonde telemetry.")
-            config = copy.deepcopy(self.rs_config)
-            # Replace the callsign fields within the config
-            # to keep the downstream parsers happy.
-            config['payload_configuration']['name'] = callsign
-            config['payload_configuration']['sentences'][0]['callsign'] = callsign
+            config = self._radiosonde_config(callsign)
+
+        elif self.negative_cache is not None and \
+                callsign in self.negative_cache:
+            logger.debug("No configuration doc for {callsign!r} (cached)"
+                         .format(callsign=callsign))
+            metrics.increment("parser.no_config_doc")
+            metrics.increment("parser.negative_cache_hit")
+            raise CantGetConfig()
 
         else:
             config = self._find_config_doc(callsign)
@@ -243,7 +512,8 @@ class Parser(object):
         if not config:
             logger.debug("No configuration doc for {callsign!r} found"
                          .format(callsign=callsign))
-            statsd.increment("parser.no_config_doc")
+            metrics.increment("parser.no_config_doc")
+            self._negative_cache_add(callsign, generation)
             raise CantGetConfig()
 
         if "flight_id" in config:
@@ -256,27 +526,70 @@ class Parser(object):
 
         return config
 
-    def _get_data(self, raw_data, callsign, config, module):
-        """Attempt to parse data from what we know so far."""
+    def _get_data(self, raw_data, callsign, config, module,
+                  first_sentence=None, provided=False):
+        """
+        Attempt to parse data from what we know so far.
+
+        The sentence at index *first_sentence*, if given, is tried first.
+
+        If *provided*, *config* was given to :meth:`parse` rather than
+        fetched from the database, and may have been edited without its
+        ``_rev`` changing; its sentences are given no
+        :attr:`SentenceConfig.key`.
+
+        If :attr:`results` is enabled and the sentence has a
+        :attr:`SentenceConfig.key`, data previously parsed from the same
+        *raw_data* with the same sentence (and the same certificates, which
+        decide which hotfix filters run) is reused.
+        """
         sentences = config["payload_configuration"]["sentences"]
-        for sentence_index, sentence in enumerate(sentences):
+        rev = config["payload_configuration"].get("_rev")
+        order = range(len(sentences))
+        if first_sentence is not None and first_sentence < len(sentences):
+            order.remove(first_sentence)
+            order.insert(0, first_sentence)
+        for sentence_index in order:
+            sentence = sentences[sentence_index]
             if sentence["callsign"] != callsign:
                 continue
             if sentence["protocol"] != module["name"]:
                 continue
 
-            data = self.filtering.intermediate_filter(raw_data, sentence)
-
-            try:
-                data = module["module"].parse(data, sentence)
-            except (ValueError, KeyError) as e:
-                logger.debug("Exception in {module} main parse: {e}"
-                    .format(module=module['name'],
-                            e=quick_traceback.oneline(e)))
-                statsd.increment("parser.parse_exception")
-                continue
-
-            data = self.filtering.post_filter(data, sentence)
+            if not provided and config["id"] is not None and rev is not None:
+                key = (config["id"], rev, sentence_index)
+            else:
+                key = None
+            sentence = SentenceConfig(sentence, key)
+
+            result_key = None
+            if self.results is not None and key is not None:
+                result_key = self._result_key(raw_data, key)
+                data = self.results.get(result_key)
+                if data is not None:
+                    metrics.increment("parser.result_cache_hit")
+                    data = _copy_for_filter(data)
+
+            if result_key is None or data is None:
+                with self._stage("intermediate_filter", module):
+                    data = self.filtering.intermediate_filter(raw_data,
+                                                              sentence)
+
+                try:
+                    with self._stage("parse", module):
+                        data = module["module"].parse(data, sentence)
+                except (ValueError, KeyError) as e:
+                    logger.debug("Exception in {module} main parse: {e}"
+                        .format(module=module['name'],
+                                e=quick_traceback.oneline(e)))
+                    metrics.increment("parser.parse_exception")
+                    continue
+
+                with self._stage("post_filter", module):
+                    data = self.filtering.post_filter(data, sentence)
+
+                if result_key is not None:
+                    self.results.put(result_key, _copy_for_filter(data))
 
             data["_protocol"] = module["name"]
             data["_parsed"] = {
@@ -289,6 +602,39 @@ class Parser(object):
             return data
         raise CantGetData()
 
+    def _result_key(self, raw_data, key):
+        """
+        The key in :attr:`results` for *raw_data* parsed with the sentence
+        *key*, under the current certificates.
+        """
+        try:
+            self.filtering._check_certs_dir()
+        except:
+            logger.debug("Error while reloading certificates: {0}"
+                         .format(quick_traceback.oneline()))
+        return (self._digest(raw_data), self.filtering.certs_generation) + key
+
+    def _digest(self, raw_data):
+        """
+        The SHA-256 of *raw_data*, remembered (per thread) for the message
+        being parsed since every sentence tried needs it.
+        """
+        local = self._local
+        if getattr(local, "digested", None) is not raw_data:
+            local.digest = hashlib.sha256(raw_data).digest()
+            local.digested = raw_data
+        return local.digest
+
+    def _stage(self, name, module):
+        """
+        Time the stage *name* of parsing the current message, if there is
+        one (see :meth:`parse`).
+        """
+        timer = getattr(self._local, "timer", None)
+        if timer is None:
+            return _untimed
+        return timer.stage(name, module["name"])
+
     def _find_config_doc(self, callsign):
         """
         Attempt to locate a payload_configuration document suitable for parsing
@@ -313,7 +659,13 @@ class Parser(object):
         The returned document may have more than one sentence object, and each
         should be attempted in order.
         If no configuration can be found, None is returned.
+
+        If the config resolver is enabled, the same resolution is performed
+        against its in-memory mirror instead of querying CouchDB.
         """
+        if self.config_resolver is not None:
+            return self.config_resolver.find(callsign)
+
         t = int(time.time())
         flights = self.db.view("flight/end_start_including_payloads",
                                include_docs=True, startkey=[t])
@@ -345,11 +697,76 @@ class Parser(object):
     def _callsign_in_config(self, callsign, config):
         return callsign in (s["callsign"] for s in config.get("sentences", []))
 
+    def _negative_cache_add(self, callsign, generation):
+        """
+        Remember that no configuration exists for *callsign*, unless a
+        configuration document has changed since *generation* was read
+        (in which case the lookup may already be out of date).
+        """
+        if self.negative_cache is None:
+            return
+        if generation == self._negative_cache_generation:
+            self.negative_cache.put(callsign, True)
+
+    def _config_changed(self, doc):
+        """
+        Reload the radiosonde override if *doc* is a new revision of it, and
+        invalidate negative cache entries made stale by a change to *doc*.
+
+        Only a payload_configuration can make an unknown callsign resolvable:
+        flights merely refer to existing payload_configuration documents, and
+        any callsign they could match would already have been found by the
+        fallback lookup.
+        """
+        if self.rs_id is not None and doc.get("_id") == self.rs_id:
+            logger.info("Reloading radiosonde override payload doc ({0})"
+                        .format(self.rs_id))
+            self._load_radiosonde_config(doc)
+
+        if self.negative_cache is None or \
+                doc.get("type") != "payload_configuration":
+            return
+
+        self._negative_cache_generation += 1
+        for sentence in doc.get("sentences", []):
+            if self.negative_cache.pop(sentence["callsign"]):
+                logger.debug("Invalidated negative cache entry for {0!r}"
+                             .format(sentence["callsign"]))
+
+    def _start_config_watcher(self, since):
+        """
+        Follow changes to configuration documents after *since* in a
+        background thread so that the negative cache can be invalidated and
+        the radiosonde override reloaded.
+
+        This is one ``_changes`` feed per :class:`Parser`, and so one per
+        parser daemon worker process; with a :attr:`config_resolver`, its
+        feed is used instead.
+        """
+        def run():
+            consumer = immortal_changes.Consumer(self.db)
+            consumer.wait(lambda result: self._config_changed(result["doc"]),
+                          filter="parser/configs", since=since,
+                          include_docs=True, heartbeat=1000)
+
+        thread = threading.Thread(target=run, name="ParserConfigWatcher")
+        thread.daemon = True
+        thread.start()
+
 
 class ParserFiltering(object):
     """
     Handle filtering of data during parsing.
+
+    Hotfix filters whose certificate and signature have been verified are
+    compiled once and cached, keyed by the SHA-256 of their code, their
+    signature and their certificate name. The cache (and the cache of loaded
+    certificates) is flushed whenever the certificate directories change, and
+    :attr:`certs_generation` is incremented.
     """
+
+    hotfix_cache_size = 100
+
     def __init__(self, config, lmgr):
         """
         * Scans ``config["parser"]["certs_dir"]`` for CA and developer
@@ -357,18 +774,52 @@ class ParserFiltering(object):
         """
         self.config = copy.deepcopy(config)
         self.loadable_manager = lmgr
-        self.certificate_authorities = []
         self.cert_path = self.config["parser"]["certs_dir"]
+        self.hotfixes = lru_cache.LRUCache(self.hotfix_cache_size)
+        self.certs_generation = 0
+        self._load_certificate_authorities()
+
+    def _load_certificate_authorities(self):
+        # Forget everything verified with the old certificates first, so
+        # that if loading fails no hotfix runs until it succeeds (the
+        # directories' mtimes are only recorded then, so it is retried).
+        self.loaded_certs = {}
+        self.hotfixes.clear()
+        self.certificate_authorities = []
+        self.certs_generation += 1
+
+        mtimes = self._get_certs_mtimes()
+        certificate_authorities = []
         ca_path = os.path.join(self.cert_path, 'ca')
         for f in os.listdir(ca_path):
             ca = M2Crypto.X509.load_cert(os.path.join(ca_path, f))
             if ca.check_ca():
-                self.certificate_authorities.append(ca)
+                certificate_authorities.append(ca)
             else:
                 raise ValueError("CA certificate is not a CA: {0}"
                                  .format(os.path.join(ca_path, f)))
 
-        self.loaded_certs = {}
+        self.certificate_authorities = certificate_authorities
+        self.certs_mtimes = mtimes
+
+    def _get_certs_mtimes(self):
+        mtimes = []
+        for d in ('ca', 'certs'):
+            path = os.path.join(self.cert_path, d)
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _check_certs_dir(self):
+        """
+        Reload the CA certificates and forget loaded certificates and
+        verified hotfixes if the certificate directories have changed.
+        """
+        if self._get_certs_mtimes() != self.certs_mtimes:
+            logger.info("Certificates changed; flushing hotfix cache")
+            self._load_certificate_authorities()
 
     def pre_filter(self, raw_data, module):
         """
@@ -396,10 +847,11 @@ class ParserFiltering(object):
     def _apply_filters(self, data, sentence, filter_type, result_type):
         if "filters" in sentence:
             if filter_type in sentence["filters"]:
-                for index, f in enumerate(sentence["filters"][filter_type]):
+                filters = sentence["filters"][filter_type]
+                for index, f in enumerate(filters):
                     whence = (filter_type, index)
                     data = self._filter(data, f, result_type, whence)
-                    statsd.increment("parser.filters.{0}".format(filter_type))
+                metrics.increment(_filter_buckets[filter_type], len(filters))
         return data
 
     def _filter(self, data, f, result_type, filter_whence):
@@ -413,13 +865,16 @@ class ParserFiltering(object):
         (filter_type, filter_index); e.g. ("intermediate", 4).
         """
         rollback = data
-        data = copy.deepcopy(data)
+        data = _copy_for_filter(data)
 
         try:
             if f["type"] == "normal":
                 fil = 'filters.' + f['filter']
                 filter_whence += ("normal", fil)
-                data = self.loadable_manager.run(fil, f, data)
+                # filters may write defaults into their config, which is
+                # shared with the payload_configuration
+                data = self.loadable_manager.run(fil, _copy_for_filter(f),
+                                                 data)
             elif f["type"] == "hotfix":
                 filter_whence += ("hotfix", )
                 data = self._hotfix_filter(data, f)
@@ -462,10 +917,10 @@ class ParserFiltering(object):
             sig = base64.b64decode(f["signature"])
             ok = cert.get_pubkey().get_rsa().verify(digest, sig, 'sha256')
         except (TypeError, M2Crypto.RSA.RSAError):
-            statsd.increment("parser.filters.hotfix.invalid_signature")
+            metrics.increment("parser.filters.hotfix.invalid_signature")
             raise ValueError("Hotfix signature is not valid")
         if not ok:
-            statsd.increment("parser.filters.hotfix.invalid_signature")
+            metrics.increment("parser.filters.hotfix.invalid_signature")
             raise ValueError("Hotfix signature is not valid")
 
     def _compile_hotfix(self, f):
@@ -478,20 +933,44 @@ class ParserFiltering(object):
             code = compile(body, "<filter>", "exec")
             exec code in env
         except (SyntaxError, AttributeError, TypeError):
-            statsd.increment("parser.filters.hotfix.compile_error")
+            metrics.increment("parser.filters.hotfix.compile_error")
             raise ValueError("Hotfix code didn't compile: " + repr(f))
         return env
 
+    def _hotfix_cache_key(self, f):
+        """
+        Get the key for **f** in the hotfix cache, or None if it cannot be
+        cached (in which case verification will fail anyway).
+        """
+        try:
+            digest = hashlib.sha256(f["code"]).hexdigest()
+            return (digest, f["signature"], f["certificate"])
+        except (KeyError, TypeError):
+            return None
+
     def _hotfix_filter(self, data, f):
         """Load a filter specified by some code in the database. Check its
-        authenticity by verifying its certificate, then run if OK."""
+        authenticity by verifying its certificate, then run if OK.
+
+        Verified and compiled hotfixes are cached, so each is only checked
+        once while the certificates remain unchanged."""
         self._sanity_check_hotfix(f)
-        cert = self._get_certificate(f["certificate"])
-        self._verify_certificate(f, cert)
-        env = self._compile_hotfix(f)
+        self._check_certs_dir()
+
+        key = self._hotfix_cache_key(f)
+        env = self.hotfixes.get(key) if key is not None else None
+
+        if env is None:
+            cert = self._get_certificate(f["certificate"])
+            self._verify_certificate(f, cert)
+            env = self._compile_hotfix(f)
+            if key is not None:
+                self.hotfixes.put(key, env)
+        else:
+            metrics.increment("parser.filters.hotfix.cache_hit")
 
         logger.debug("Executing a hotfix")
-        statsd.increment("parser.filters.hotfix.executed")
+        metrics.increment("parser.filters.hotfix.executed")
 
         return env["f"](data)
 
@@ -512,6 +991,138 @@ class ParserFiltering(object):
             raise ValueError("Certificate could not be loaded.")
 
 
+_immutable_types = (basestring, int, long, float, bool, type(None))
+
+
+class _ModuleBuckets(object):
+    """Metric names for a parser module, formatted once."""
+
+    def __init__(self, name):
+        self.protocol = "parser.protocol.{0}".format(name)
+        self.cantparse = "parser.{0}.cantparse".format(name)
+        self.cantextractcallsign = "parser.{0}.cantextractcallsign" \
+                                        .format(name)
+
+_module_buckets = {}
+
+def _buckets(name):
+    """The :class:`_ModuleBuckets` for the module called *name*."""
+    buckets = _module_buckets.get(name)
+    if buckets is None:
+        buckets = _module_buckets[name] = _ModuleBuckets(name)
+    return buckets
+
+_filter_buckets = dict((t, "parser.filters." + t)
+                       for t in ("pre", "intermediate", "post"))
+
+
+class _Untimed(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_untimed = _Untimed()
+
+
+def _copy_for_filter(data):
+    """
+    Copy *data* so that a filter may modify the copy without affecting the
+    original (which is needed to roll back if the filter fails).
+
+    Immutable values are shared rather than copied, so strings cost nothing
+    and a dict of parsed fields costs a shallow copy; only mutable values
+    nested inside it (which a filter could modify in place) are deep copied.
+    """
+    if isinstance(data, _immutable_types):
+        return data
+    elif type(data) is dict:
+        return dict((k, v if isinstance(v, _immutable_types)
+                           else copy.deepcopy(v))
+                    for k, v in data.iteritems())
+    else:
+        return copy.deepcopy(data)
+
+
+class SentenceConfig(dict):
+    """
+    A sentence dictionary from a payload_configuration document, which also
+    records where it came from.
+
+    :attr:`key` is ``(payload_configuration id, revision, sentence index)``,
+    or None if the configuration document has no ID or revision, or was
+    provided directly to :meth:`Parser.parse`. Since a document's
+    revision changes whenever it is edited, parser modules may use *key* to
+    cache work that depends on the sentence's settings and fields. (The
+    callsign may differ between sentences with the same key, since the
+    radiosonde override rewrites it for each radiosonde.)
+    """
+    def __init__(self, sentence, key=None):
+        super(SentenceConfig, self).__init__(sentence)
+        self.key = key
+
+
+Sniffed = collections.namedtuple("Sniffed",
+                                 ["kind", "length", "checksum_at"])
+
+_printable = "".join(chr(i) for i in xrange(0x20, 0x7F))
+_printable_exp = re.compile("^[\\x20-\\x7E]+$")
+_sniffed = threading.local()
+
+def sniff(string):
+    """
+    Classify *string* (raw telemetry) with a single scan, returning a
+    :class:`Sniffed` ``(kind, length, checksum_at)``.
+
+    *kind* is one of:
+
+    * ``"ukhas"``: ``$$``, printable ASCII, then a newline
+    * ``"text"``: printable ASCII, perhaps followed by a newline
+    * ``"binary"``: anything else
+
+    *checksum_at* is the index of the ``*`` before a two or four digit
+    checksum at the end of a ``"ukhas"`` string, or None.
+
+    The result for the last string sniffed in each thread is remembered, so
+    the parser and each module it tries can call :func:`sniff` on the same
+    string without scanning it again.
+    """
+    if getattr(_sniffed, "string", None) is string:
+        return _sniffed.result
+
+    length = len(string)
+    framed = length > 2 and string[:2] == "$$" and string[-1] == "\n"
+    if framed:
+        body = string[2:-1]
+    elif length and string[-1] == "\n":
+        body = string[:-1]
+    else:
+        body = string
+
+    if isinstance(body, str):
+        printable = bool(body) and not body.translate(None, _printable)
+    else:
+        printable = bool(_printable_exp.search(body))
+
+    checksum_at = None
+    if not printable:
+        kind = "binary"
+    elif framed:
+        kind = "ukhas"
+        if length >= 6 and string[-4] == "*":
+            checksum_at = length - 4
+        elif length >= 8 and string[-6] == "*":
+            checksum_at = length - 6
+    else:
+        kind = "text"
+
+    result = Sniffed(kind, length, checksum_at)
+    _sniffed.string = string
+    _sniffed.result = result
+    return result
+
+
 class ParserModule(object):
     """
     Base class for real ParserModules to inherit from.
@@ -520,6 +1131,9 @@ class ParserModule(object):
     They do not have to inherit from :class:`ParserModule`, but can if they
     want. They must implement :meth:`pre_parse` and :meth:`parse` as described
     below.
+
+    :func:`sniff` classifies a string without scanning it again if the parser
+    (or another module) already has.
     """
     def __init__(self, parser):
         self.parser = parser
@@ -0,0 +1,176 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the parser's throughput offline, by replaying a dump of telemetry.
+
+The dump is a file containing one JSON document per line: the
+payload_telemetry documents to parse, plus the flight and
+payload_configuration documents they need (anything else is ignored).
+Such a dump can be made from the output of ``_all_docs?include_docs=true``
+or ``_changes?include_docs=true``.
+
+The configuration documents are loaded into an in-memory stand-in for
+CouchDB (``habitat.utils.memory_couch``, a test double that is not
+imported by :mod:`habitat.utils`), which the parser then queries
+as configured, so no database is needed. Note that flights are only
+considered if they are active at the time the benchmark is run; otherwise
+the most recent payload_configuration for each callsign is used, as usual.
+
+Usage::
+
+    bin/parser_benchmark <habitat.yml> <dump.jsonl>
+"""
+
+import sys
+import copy
+import math
+import json
+import time
+import yaml
+import logging
+import collections
+
+from . import parser
+from .utils import memory_couch
+
+__all__ = ["ParserBenchmark", "load_dump", "format_results", "main"]
+
+
+def load_dump(filename):
+    """
+    Read the dump *filename*, returning a list of payload_telemetry documents
+    and a list of flight and payload_configuration documents.
+    """
+    telemetry = []
+    configs = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            doc = json.loads(line)
+            if doc.get("type") == "payload_telemetry":
+                telemetry.append(doc)
+            elif doc.get("type") in ("flight", "payload_configuration"):
+                configs.append(doc)
+    return telemetry, configs
+
+
+def _percentile(ordered, p):
+    """Nearest-rank percentile *p* (0 to 100) of a sorted list."""
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class ParserBenchmark(object):
+    """
+    Runs :meth:`Parser.parse <habitat.parser.Parser.parse>` over a list of
+    documents, with a :class:`Parser <habitat.parser.Parser>` connected to
+    an in-memory database containing *configs*.
+    """
+
+    couch_uri = "http://parser-benchmark"
+
+    def __init__(self, config, configs):
+        config = copy.deepcopy(config)
+        config["couch_uri"] = self.couch_uri
+
+        server = memory_couch.Server(self.couch_uri, validate=False)
+        self.db = server[config["couch_db"]]
+        for doc in configs:
+            doc = dict(doc)
+            doc.pop("_rev", None)
+            self.db.save_doc(doc)
+
+        memory_couch.install()
+        try:
+            self.parser = parser.Parser(config)
+        finally:
+            memory_couch.uninstall()
+
+    def run(self, telemetry):
+        """
+        Parse each document in *telemetry*, returning a dict of results:
+
+        * ``messages``, ``seconds`` and ``rate`` (messages per second)
+        * ``protocols``: the number of messages each module parsed
+        * ``failed``: the number of messages nothing could parse
+        * ``p50`` and ``p99``: latency percentiles in seconds
+        """
+        docs = [copy.deepcopy(doc) for doc in telemetry]
+        latencies = []
+        protocols = collections.defaultdict(int)
+        failed = 0
+
+        start = time.time()
+        for doc in docs:
+            before = time.time()
+            result = self.parser.parse(doc)
+            latencies.append(time.time() - before)
+
+            if result is None:
+                failed += 1
+            else:
+                protocols[result["data"].get("_protocol")] += 1
+        seconds = time.time() - start
+
+        latencies.sort()
+        return {
+            "messages": len(docs),
+            "seconds": seconds,
+            "rate": len(docs) / seconds if seconds else 0.0,
+            "protocols": dict(protocols),
+            "failed": failed,
+            "p50": _percentile(latencies, 50),
+            "p99": _percentile(latencies, 99)
+        }
+
+
+def format_results(results):
+    """Format the results of :meth:`ParserBenchmark.run` as text."""
+    n = results["messages"] or 1
+    lines = [
+        "{0} messages in {1:.3f}s: {2:.1f} msgs/s".format(
+            results["messages"], results["seconds"], results["rate"]),
+        "latency p50 {0:.3f}ms, p99 {1:.3f}ms".format(
+            results["p50"] * 1000, results["p99"] * 1000)
+    ]
+    for name, count in sorted(results["protocols"].items()):
+        lines.append("{0}: {1} parsed ({2:.1f}%)".format(
+            name, count, 100.0 * count / n))
+    lines.append("failed: {0} ({1:.1f}%)".format(
+        results["failed"], 100.0 * results["failed"] / n))
+    return "\n".join(lines)
+
+
+def main():
+    """Entry point for ``bin/parser_benchmark``."""
+    if len(sys.argv) != 3:
+        print "Usage: {0} <habitat.yml> <dump.jsonl>".format(sys.argv[0])
+        return
+
+    with open(sys.argv[1]) as f:
+        config = yaml.safe_load(f)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    telemetry, configs = load_dump(sys.argv[2])
+    benchmark = ParserBenchmark(config, configs)
+    print format_results(benchmark.run(telemetry))
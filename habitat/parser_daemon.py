@@ -19,19 +19,27 @@
 Run the Parser as a daemon connected to CouchDB's _changes feed.
 """
 
+import os
+import json
+import base64
+import itertools
+import collections
 import logging
 import couchdbkit
 import restkit
 import copy
-import statsd
 import time
 import random
+import threading
+import multiprocessing
+import Queue
 
 from . import parser
-from .utils import immortal_changes
+from . import views
+from . import config_resolver
+from .utils import immortal_changes, stage_timing, metrics, lru_cache
 
 logger = logging.getLogger("habitat.parser_daemon")
-statsd.init_statsd({'STATSD_BUCKET_PREFIX': 'habitat'})
 
 __all__ = ['ParserDaemon']
 
@@ -41,81 +49,692 @@ class ParserDaemon(object):
     :class:`ParserDaemon` runs persistently, watching CouchDB's _changes feed
     for new unparsed telemetry, parsing it with :class:`Parser` and storing the
     result back in the database.
+
+    If ``config[daemon_name]["workers"]`` is greater than one, documents are
+    parsed by a pool of that many processes, each with its own
+    :class:`Parser`. Results are saved, and :attr:`last_seq` advanced, in the
+    order the changes arrived.
+
+    If ``config[daemon_name]["bulk_save_size"]`` is non-zero, parsed
+    documents are saved by a writer thread in batches of up to that many,
+    waiting at most ``bulk_save_window`` seconds to fill a batch, using one
+    ``_bulk_docs`` request per batch.
+
+    If ``config[daemon_name]["pipeline"]`` is true, reading changes,
+    parsing and saving happen in separate threads connected by queues of at
+    most ``queue_size`` documents, so that waiting for CouchDB to save one
+    document overlaps with parsing the next. When a queue is full the stage
+    before it waits, and ultimately the _changes feed is read no faster than
+    documents are saved. (With a worker pool, the pool is the parsing stage.)
+    The length of each queue is sent to statsd as a gauge.
+
+    If ``config[daemon_name]["priority"]`` is also true (which needs
+    ``workers`` to be one), queued documents are parsed in order of priority (see
+    :meth:`ConfigResolver.priority
+    <habitat.config_resolver.ConfigResolver.priority>`) rather than arrival:
+    active flights first, then known payloads, then unknown callsigns.
+    This needs the parser's ``config_resolver``. If ``shed_threshold`` is
+    set, documents from unknown callsigns are skipped without being parsed
+    while at least that many documents are waiting.
+
+    If ``config[daemon_name]["checkpoint_file"]`` is set, :attr:`last_seq` is
+    saved there every ``checkpoint_interval`` seconds. On start, the daemon
+    resumes from the checkpoint, catching up with batches of
+    ``catch_up_batch_size`` changes before following the continuous feed.
+
+    If ``config[daemon_name]["shards"]`` is greater than one, this daemon
+    only parses documents in shard number ``config[daemon_name]["shard"]``
+    (counting from zero; see :func:`habitat.views.parser.shard_of`), so that
+    that many daemons may share the work between them.
+
+    Changes to documents that were parsed and saved recently (or are still
+    being parsed) are skipped: up to
+    ``config[daemon_name]["destutter_size"]`` (default 1000) document IDs
+    are remembered for ``destutter_window`` seconds (default 60), along with
+    the revision that was parsed. A change to the same revision, or to the
+    next one (as made by saving the parsed data), is counted and ignored.
+    Documents that could not be parsed or saved are forgotten, so that a
+    later revision is tried again.
     """
 
+    save_attempts = 30
+
     def __init__(self, config, daemon_name="parserdaemon"):
         """
         On construction, it will:
 
         * Connect to CouchDB using ``self.config["couch_uri"]`` and
           ``config["couch_db"]``.
+        * Start the worker processes, if configured.
+
+        Raises :exc:`ValueError` if options are given that would be ignored
+        (``priority`` without ``pipeline``, or with a worker pool, and
+        ``shed_threshold`` without ``priority``).
         """
 
         config = copy.deepcopy(config)
+        daemon_config = config.get(daemon_name) or {}
+
+        self.workers = daemon_config.get("workers", 1)
+        self.pipeline = daemon_config.get("pipeline", False)
+        self.priority = daemon_config.get("priority", False)
+        self.shed_threshold = daemon_config.get("shed_threshold")
+        if self.priority and not self.pipeline:
+            raise ValueError("priority scheduling needs pipeline mode")
+        if self.priority and self.workers > 1:
+            raise ValueError("priority scheduling needs workers to be 1")
+        if self.shed_threshold is not None and not self.priority:
+            raise ValueError("shed_threshold needs priority scheduling")
+
+        # Start worker processes before anything (such as the Parser) starts
+        # threads, which do not survive a fork.
+        self.pool = None
+        if self.workers > 1:
+            self.pool = multiprocessing.Pool(self.workers, _worker_init,
+                                             (config, ))
+            self.pending = Queue.Queue(2 * self.workers)
+
+        self.shard = daemon_config.get("shard", 0)
+        self.shards = daemon_config.get("shards", 1)
+        if not 0 <= self.shard < self.shards:
+            raise ValueError("shard must be between 0 and shards - 1")
+        self.filter_params = {"filter": "parser/unparsed"}
+        if self.shards > 1:
+            self.filter_params["shard"] = self.shard
+            self.filter_params["shards"] = self.shards
+
+        self.bulk_save_size = daemon_config.get("bulk_save_size", 0)
+        self.bulk_save_window = daemon_config.get("bulk_save_window", 0.5)
+        self.save_queue = None
+        if self.bulk_save_size:
+            self.save_queue = Queue.Queue(2 * self.bulk_save_size)
+
+        self.queue_size = daemon_config.get("queue_size", 100)
+        self.parse_queue = None
+        if self.pipeline:
+            if self.pool is None:
+                self.parse_queue = Queue.Queue(self.queue_size)
+            if self.save_queue is None:
+                self.save_queue = Queue.Queue(self.queue_size)
+
+        self.seqs = None
+        if self.priority:
+            self.parse_queue = Queue.PriorityQueue(self.queue_size)
+            self.seqs = _SeqTracker()
+            self._arrivals = itertools.count()
+
+        # whether each change is dealt with before the next is read
+        self.inline = self.pool is None and self.save_queue is None
+
         self.couch_server = couchdbkit.Server(config["couch_uri"])
         self.db = self.couch_server[config["couch_db"]]
-        self.last_seq = self.db.info()["update_seq"]
-        self.last_id = None
+        update_seq = self.db.info()["update_seq"]
+        self.recent = lru_cache.LRUCache(
+                daemon_config.get("destutter_size", 1000),
+                daemon_config.get("destutter_window", 60))
+
+        self.checkpoint_file = daemon_config.get("checkpoint_file")
+        self.checkpoint_interval = daemon_config.get("checkpoint_interval", 10)
+        self.catch_up_batch_size = \
+                daemon_config.get("catch_up_batch_size", 1000)
+        self._next_checkpoint = 0
+
+        self.last_seq = None
+        if self.checkpoint_file is not None:
+            self.last_seq = self._read_checkpoint()
+        self.catch_up = self.last_seq is not None
+        if not self.catch_up:
+            self.last_seq = update_seq
 
         self.parser = parser.Parser(config)
 
+        if self.priority and self.parser.config_resolver is None:
+            raise ValueError("priority scheduling needs the parser's "
+                             "config_resolver")
+
     def run(self):
         """
         Start a continuous connection to CouchDB's _changes feed, watching for
         new unparsed telemetry.
         """
+        if self.pool is not None:
+            collector = threading.Thread(target=self._collect,
+                                         name="ParserDaemonCollector")
+            collector.daemon = True
+            collector.start()
+
+        if self.parse_queue is not None:
+            parse_stage = threading.Thread(target=self._parse_stage,
+                                           name="ParserDaemonParser")
+            parse_stage.daemon = True
+            parse_stage.start()
+
+        if self.save_queue is not None:
+            writer = threading.Thread(target=self._write,
+                                      name="ParserDaemonWriter")
+            writer.daemon = True
+            writer.start()
+
         consumer = immortal_changes.Consumer(self.db)
-        consumer.wait(self._couch_callback, filter="parser/unparsed",
-                since=self.last_seq, include_docs=True, heartbeat=1000)
+
+        since = self.last_seq
+        if self.catch_up:
+            since = self._catch_up(consumer)
+
+        consumer.wait(self._couch_callback, since=since, include_docs=True,
+                heartbeat=1000, **self.filter_params)
+
+    def _catch_up(self, consumer):
+        """
+        Process the changes made since :attr:`last_seq` using batched,
+        non-continuous requests, logging how far behind the daemon is
+        after each batch.
+
+        Returns the sequence the continuous feed should start from. If
+        anything goes wrong, that is wherever catching up had reached.
+        """
+        since = self.last_seq
+        logger.info("Catching up from seq {0}".format(since))
+
+        try:
+            while True:
+                changes = consumer.fetch(since=since,
+                        limit=self.catch_up_batch_size, include_docs=True,
+                        **self.filter_params)
+
+                for result in changes["results"]:
+                    try:
+                        self._couch_callback(result)
+                    except (SystemExit, KeyboardInterrupt):
+                        raise
+                    except:
+                        logger.exception("Exception from changes callback")
+
+                since = changes["last_seq"]
+                update_seq = self.db.info()["update_seq"]
+                lag = _seq_number(update_seq) - _seq_number(since)
+                logger.info("Catching up: at seq {0}, {1} changes behind"
+                            .format(since, lag))
+
+                if len(changes["results"]) < self.catch_up_batch_size:
+                    break
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            logger.exception("Exception while catching up")
+        else:
+            logger.info("Caught up")
+
+        return since
+
+    def _advance(self, seq):
+        """
+        Record that every change up to *seq* has been dealt with, saving a
+        checkpoint if one is due.
+        """
+        self.last_seq = seq
+        if self.checkpoint_file is not None and \
+                time.time() >= self._next_checkpoint:
+            self._write_checkpoint()
+
+    def _read_checkpoint(self):
+        """Load the saved sequence, or return None if there isn't one."""
+        try:
+            with open(self.checkpoint_file) as f:
+                seq = json.load(f)
+        except IOError:
+            logger.info("No checkpoint at {0}".format(self.checkpoint_file))
+            return None
+        except ValueError:
+            logger.warn("Ignoring corrupt checkpoint {0}"
+                        .format(self.checkpoint_file))
+            return None
+
+        logger.info("Resuming from checkpoint seq {0}".format(seq))
+        return seq
+
+    def _write_checkpoint(self):
+        """Atomically save :attr:`last_seq` to the checkpoint file."""
+        temp = self.checkpoint_file + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(self.last_seq, f)
+            os.rename(temp, self.checkpoint_file)
+        except (IOError, OSError):
+            logger.exception("Could not write checkpoint")
+        self._next_checkpoint = time.time() + self.checkpoint_interval
 
     def _couch_callback(self, result):
         """
         Handle a new result from the CouchDB _changes feed. Passes the doc off
         to Parser.parse, then saves the result.
+
+        If there is a worker pool, the doc is instead queued to be parsed by
+        a worker; in pipeline mode it is queued for the parsing thread. Both
+        block if too many docs are already waiting.
         """
-        self.last_seq = result['seq']
         doc = result['doc']
 
-        if self.last_id == doc["_id"]:
-            logger.debug("Destuttering: ignoring change for id {0}, since we " 
-                         "just processed it".format(self.last_id))
+        if self.shards > 1 and \
+                views.parser.shard_of(doc["_id"], self.shards) != self.shard:
+            # the filter should not have sent this; another daemon will
+            # deal with it
+            if self.inline:
+                self._advance(result['seq'])
+            return
+
+        generation = _rev_number(doc.get("_rev"))
+        seen = self.recent.get(doc["_id"])
+        if seen is not None and generation <= seen + 1:
+            logger.debug("Destuttering: ignoring change for id {0}, since we "
+                         "recently processed it".format(doc["_id"]))
+            metrics.increment("parser_daemon.destuttered")
+            if self.inline:
+                self._advance(result['seq'])
+            return
+
+        # in progress; forgotten again if parsing or saving fails
+        self.recent.put(doc["_id"], generation)
+
+        if not self.inline:
+            self._report_queues()
+
+        if self.pool is not None:
+            pending = self.pool.apply_async(_worker_parse, (doc, ))
+            self.pending.put((result['seq'], doc["_id"], pending))
+            return
+
+        if self.priority:
+            self._queue_by_priority(result['seq'], doc)
+            return
+
+        if self.parse_queue is not None:
+            self.parse_queue.put((result['seq'], doc))
             return
 
-        self.last_id = doc["_id"]
-        doc = self.parser.parse(doc)
-        if doc:
-            self._save_updated_doc(doc)
+        if self.save_queue is not None:
+            self.save_queue.put((result['seq'], self._parse_for_writer(doc)))
+            return
+
+        doc_id = doc["_id"]
+        timer = stage_timing.StageTimer(doc_id)
+        try:
+            doc = self.parser.parse(doc, timer=timer)
+            if doc:
+                with timer.stage("save"):
+                    self._save_updated_doc(doc)
+            else:
+                self._forget(doc_id)
+        except:
+            self._forget(doc_id)
+            raise
+        finally:
+            self.parser.stage_timings.record(timer)
+
+        # only once saved, so that the change is not skipped on restart
+        self._advance(result['seq'])
+
+    def _forget(self, doc_id):
+        """
+        Stop destuttering changes to *doc_id*, which could not be parsed or
+        saved, so that its next revision is tried.
+        """
+        self.recent.pop(doc_id)
+
+    def _report_queues(self):
+        """Send the length of each queue to statsd."""
+        if self.pool is not None:
+            metrics.gauge("parser_daemon.queue.pending", self.pending.qsize())
+        if self.parse_queue is not None:
+            metrics.gauge("parser_daemon.queue.parse",
+                          self.parse_queue.qsize())
+        if self.save_queue is not None:
+            metrics.gauge("parser_daemon.queue.save", self.save_queue.qsize())
+
+    def _queue_by_priority(self, seq, doc):
+        """
+        Queue *doc* to be parsed according to its priority, or skip it if
+        it is of the lowest priority and too many documents are waiting.
+        """
+        callsign = _guess_callsign(doc)
+        if callsign is None:
+            priority = config_resolver.PRIORITY_UNKNOWN
+        else:
+            priority = self.parser.config_resolver.priority(callsign)
+
+        self.seqs.start(seq)
+
+        if priority == config_resolver.PRIORITY_UNKNOWN and \
+                self.shed_threshold is not None and \
+                self.parse_queue.qsize() >= self.shed_threshold:
+            logger.debug("Shedding {0} ({1!r})".format(doc["_id"], callsign))
+            metrics.increment("parser_daemon.shed")
+            self._forget(doc["_id"])
+            self._finish([seq])
+            return
+
+        self.parse_queue.put((priority, next(self._arrivals), seq, doc))
+
+    def _finish(self, seqs):
+        """
+        Record that the changes *seqs* have been dealt with, advancing
+        :attr:`last_seq` as far as possible. Only needed when documents may
+        finish out of order.
+        """
+        done = self.seqs.finish(seqs)
+        if done is not None:
+            self._advance(done)
+
+    def _parse_stage(self):
+        """Parse queued documents, forever."""
+        while True:
+            self._parse_one()
+
+    def _parse_one(self):
+        """
+        Wait for a document from the changes feed, parse it, and queue it to
+        be saved.
+        """
+        seq, doc = self.parse_queue.get()[-2:]
+        self.save_queue.put((seq, self._parse_for_writer(doc)))
+
+    def _parse_for_writer(self, doc):
+        """
+        Parse *doc*, to be queued for the writer thread. Returns None (and
+        stops destuttering the document) if it could not be parsed.
+        """
+        doc_id = doc["_id"]
+        try:
+            doc = self.parser.parse(doc)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            logger.exception("Exception while parsing")
+            doc = None
+        if not doc:
+            self._forget(doc_id)
+        return doc
+
+    def _collect(self):
+        """Save results from the worker pool, in order, forever."""
+        while True:
+            self._collect_one()
+
+    def _collect_one(self):
+        """
+        Wait for the oldest document given to the worker pool to be parsed,
+        then save it.
+        """
+        seq, doc_id, pending = self.pending.get()
+        try:
+            doc = pending.get()
+            if not doc:
+                self._forget(doc_id)
+            if self.save_queue is not None:
+                self.save_queue.put((seq, doc))
+                return
+            if doc:
+                self._timed_save(doc)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            logger.exception("Exception while parsing or saving")
+            self._forget(doc_id)
+        self._advance(seq)
+
+    def _write(self):
+        """Save parsed documents, forever."""
+        while True:
+            self._write_batch()
+
+    def _write_batch(self):
+        """
+        Wait for a parsed document, collect more until the batch is full or
+        :attr:`bulk_save_window` has passed, then save them all. Without bulk
+        saving, the batch is just the one document.
+
+        :attr:`last_seq` is advanced once the batch has been saved.
+        """
+        batch = [self.save_queue.get()]
+        deadline = time.time() + self.bulk_save_window
+
+        while len(batch) < self.bulk_save_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.save_queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+
+        docs = [doc for seq, doc in batch if doc]
+        try:
+            if len(docs) == 1 and not self.bulk_save_size:
+                self._timed_save(docs[0])
+            elif docs:
+                self._timed_save(docs)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            logger.exception("Exception while saving")
+            for doc in docs:
+                self._forget(doc["_id"])
+
+        if self.seqs is not None:
+            self._finish([seq for seq, doc in batch])
+        else:
+            self._advance(batch[-1][0])
+
+    def _timed_save(self, docs):
+        """
+        Save a parsed document (or a list of them, in bulk), recording the
+        time taken as the "save" stage (see :attr:`Parser.stage_timings
+        <habitat.parser.Parser.stage_timings>`) as the inline path does.
+
+        A single document's save is tagged with the payload_configuration it
+        was parsed with; a bulk save, which may mix several, with none.
+        """
+        if isinstance(docs, list):
+            timer = stage_timing.StageTimer(
+                    "{0} documents".format(len(docs)))
+            save = self._bulk_save
+        else:
+            timer = stage_timing.StageTimer(docs["_id"])
+            timer.config_id = docs.get("data", {}).get("_parsed", {})\
+                    .get("payload_configuration")
+            save = self._save_updated_doc
+
+        try:
+            with timer.stage("save"):
+                save(docs)
+        finally:
+            self.parser.stage_timings.record(timer)
+
+    @metrics.timed("parser_daemon.bulk_save_time")
+    def _bulk_save(self, docs):
+        """
+        Save *docs* with as few ``_bulk_docs`` requests as possible.
+
+        Each document is first submitted with the revision it was parsed
+        from. Only those that conflict (because a receiver was added
+        meanwhile) are re-fetched, merged and resubmitted, in one request
+        per attempt.
+        """
+        attempts = 1
+        while True:
+            try:
+                self.db.save_docs(docs)
+                results = [{} for doc in docs]
+            except couchdbkit.exceptions.BulkSaveError as e:
+                results = e.results
+
+            conflicts = []
+            for doc, result in zip(docs, results):
+                error = result.get("error")
+                if error is None:
+                    metrics.increment("parser_daemon.saved")
+                elif error == "conflict":
+                    conflicts.append(doc)
+                elif error in ("forbidden", "unauthorized"):
+                    logger.warn("Could not save doc {0}, {1}: {2}"
+                                .format(doc["_id"], error, result["reason"]))
+                else:
+                    logger.error("Could not save doc {0}, {1}: {2}"
+                                 .format(doc["_id"], error, result["reason"]))
+                    metrics.increment("parser_daemon.save_error")
+
+            logger.debug("Saved {0} of {1} docs after {2} attempts"
+                         .format(len(docs) - len(conflicts), len(docs),
+                                 attempts))
+
+            if not conflicts:
+                return
 
-    @statsd.StatsdTimer.wrap('parser_daemon.save_time')
+            if attempts >= self.save_attempts:
+                err = "Could not save {0} docs after {1} attempts." \
+                        .format(len(conflicts), attempts)
+                logger.error(err)
+                metrics.increment("parser_daemon.save_error", len(conflicts))
+                raise RuntimeError(err)
+
+            attempts += 1
+            delay = random.uniform(0.01, 0.1)
+            logger.debug("{0} save conflicts (attempt #{1}, delay {2}s)"
+                         .format(len(conflicts), attempts, delay))
+            metrics.increment("parser_daemon.save_conflict", len(conflicts))
+            time.sleep(delay)
+
+            docs = self._merge_latest(conflicts)
+
+    def _merge_latest(self, docs):
+        """
+        Fetch the latest revisions of *docs* in one request and merge their
+        parsed data into them.
+        """
+        parsed = dict((doc["_id"], doc) for doc in docs)
+        rows = self.db.all_docs(keys=list(parsed), include_docs=True)
+
+        merged = []
+        for row in rows:
+            if row.get("doc") is None:
+                logger.warn("Doc {0} disappeared before it could be saved"
+                            .format(row["key"]))
+                continue
+            latest = row["doc"]
+            latest["data"].update(parsed[latest["_id"]]["data"])
+            merged.append(latest)
+        return merged
+
+    @metrics.timed("parser_daemon.save_time")
     def _save_updated_doc(self, doc, attempts=1):
         """
-        Save doc to the database, retrying with a merge in the event of
-        resource conflicts. This should definitely be a method of some Telem
-        class thing.
+        Save the parsed data in doc to the database, using the
+        ``payload_telemetry/_update/add_parsed_data`` update handler to merge
+        it into the latest revision server side, and retrying in the event of
+        resource conflicts.
         """
-        latest = self.db[doc['_id']]
-        latest['data'].update(doc['data'])
+        url = "_design/payload_telemetry/_update/add_parsed_data/" + \
+                doc["_id"]
         try:
-            self.db.save_doc(latest)
+            self.db.res.put(url, payload={"data": doc["data"]}).skip_body()
             logger.debug("Saved doc {0} successfully after {1} attempts" \
                 .format(doc["_id"], attempts))
-            statsd.increment("parser_daemon.saved")
+            metrics.increment("parser_daemon.saved")
         except couchdbkit.exceptions.ResourceConflict:
-            attempts += 1
-            if attempts >= 30:
+            if attempts >= self.save_attempts:
                 err = "Could not save doc {0} after {1} conflicts." \
                         .format(doc["_id"], attempts)
                 logger.error(err)
-                statsd.increment("parser_daemon.save_error")
+                metrics.increment("parser_daemon.save_error")
                 raise RuntimeError(err)
             else:
                 delay = random.uniform(0.01, 0.1)
                 logger.debug("Save conflict (doc {0}, attempt #{1}, delay {2}s)" \
-                    .format(doc["_id"], attempts, delay))
+                    .format(doc["_id"], attempts + 1, delay))
                 time.sleep(delay)
-                statsd.increment("parser_daemon.save_conflict")
-                self._save_updated_doc(doc, attempts)
+                metrics.increment("parser_daemon.save_conflict")
+                self._save_updated_doc(doc, attempts + 1)
         except restkit.errors.Unauthorized as e:
             logger.warn("Could not save doc {0}, unauthorized: {1}" \
                 .format(doc["_id"], e))
             return
+
+class _SeqTracker(object):
+    """
+    Changes that were started in order but may finish in any order.
+
+    :meth:`finish` gives the latest sequence before which every change has
+    finished, i.e. how far :attr:`ParserDaemon.last_seq` may be advanced.
+    """
+
+    def __init__(self):
+        self.started = collections.deque()
+        self.finished = set()
+        self._lock = threading.Lock()
+
+    def start(self, seq):
+        with self._lock:
+            self.started.append(seq)
+
+    def finish(self, seqs):
+        """
+        Mark *seqs* as finished. Returns the new sequence up to which all
+        changes have finished, or None if that has not moved.
+        """
+        done = None
+        with self._lock:
+            self.finished.update(seqs)
+            while self.started and self.started[0] in self.finished:
+                done = self.started.popleft()
+                self.finished.discard(done)
+        return done
+
+
+def _guess_callsign(doc):
+    """
+    The callsign of the telemetry in *doc*, without parsing it: the first
+    field of a UKHAS sentence, or the fallback payload callsign, or None.
+    """
+    data = doc.get("data", {})
+    fallback = data.get("_fallbacks", {}).get("payload")
+    try:
+        raw = base64.b64decode(data["_raw"])
+    except (KeyError, TypeError):
+        return fallback
+    if parser.sniff(raw).kind == "ukhas":
+        end = raw.find(",")
+        if end > 2:
+            return raw[2:end]
+    return fallback
+
+
+def _rev_number(rev):
+    """
+    The generation of the revision *rev* (the ``N`` in ``N-hash``), or 0 if
+    it is missing.
+    """
+    if not rev:
+        return 0
+    return int(rev.split("-", 1)[0])
+
+
+def _seq_number(seq):
+    """
+    The numeric part of a ``_changes`` sequence, which may be an integer or
+    (since CouchDB 2) a string such as ``"42-g1AAAA..."``.
+    """
+    if isinstance(seq, basestring):
+        seq = seq.split("-", 1)[0]
+    return int(seq)
+
+
+_worker_parser = None
+
+def _worker_init(config):
+    """Create the :class:`Parser` used by a worker process."""
+    global _worker_parser
+    _worker_parser = parser.Parser(config)
+
+def _worker_parse(doc):
+    """Parse *doc* in a worker process."""
+    return _worker_parser.parse(doc)
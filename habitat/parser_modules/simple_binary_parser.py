@@ -81,10 +81,31 @@ applicable.
 """
 
 import struct
+import collections
+
 from ..parser import ParserModule, CantExtractCallsign
+from ..utils import lru_cache
+
+
+BinaryPlan = collections.namedtuple("BinaryPlan", ["struct", "fields"])
+
 
 class SimpleBinaryParser(ParserModule):
-    """The Simple Binary Parser Module"""
+    """
+    The Simple Binary Parser Module
+
+    Like :class:`habitat.parser_modules.ukhas_parser.UKHASParser`, sentence
+    configurations are verified once, producing a :class:`BinaryPlan` (a
+    compiled :class:`struct.Struct` and the sensor for each field) which is
+    cached by :attr:`SentenceConfig.key
+    <habitat.parser.SentenceConfig.key>`.
+    """
+
+    plan_cache_size = 1000
+
+    def __init__(self, parser):
+        super(SimpleBinaryParser, self).__init__(parser)
+        self.plans = lru_cache.LRUCache(self.plan_cache_size)
 
     def pre_parse(self, string):
         """
@@ -113,17 +134,77 @@ class SimpleBinaryParser(ParserModule):
         if len(field_names) != len(set(field_names)):
             raise ValueError("Duplicate field name.")
 
-    def _parse_field(self, field, config):
+    def _compile_plan(self, config):
+        """
+        Verify the sentence *config*, compile its format string and look up
+        its sensors, returning a :class:`BinaryPlan`.
+
+        The plan's ``fields`` is a list of tuples
+        ``(name, field config, sensor function, number of arguments)``, where
+        the sensor function is None for fields without a sensor.
+
+        Raises :py:exc:`ValueError <exceptions.ValueError>` if *config* is
+        invalid.
+        """
+        self._verify_config(config)
+        prefix = [config["format_prefix"]] if "format_prefix" in config else []
+        fmtstring = ''.join(prefix + [f["format"] for f in config["fields"]])
+
+        try:
+            compiled = struct.Struct(str(fmtstring))
+            count = len(compiled.unpack("\x00" * compiled.size))
+        except struct.error as exp:
+            raise ValueError("Could not unpack binary data: {0}".format(exp))
+
+        if count != len(config["fields"]):
+            raise ValueError(
+                "Number of extracted fields does not match config"
+                " (got {0}, expected {1}).".format(
+                count, len(config["fields"])))
+
+        fields = []
+        for field_config in config["fields"]:
+            name = field_config["name"]
+            if 'sensor' not in field_config:
+                fields.append((name, field_config, None, 0))
+                continue
+            sensor = 'sensors.' + field_config["sensor"]
+            try:
+                func, num_args = self.loadable_manager.resolve(sensor)
+            except ValueError as e:
+                raise ValueError("(field {f}): {e!s}".format(f=name, e=e))
+            fields.append((name, field_config, func, num_args))
+
+        return BinaryPlan(compiled, fields)
+
+    def _get_plan(self, config):
+        """
+        Get the :class:`BinaryPlan` for *config*, from the cache if possible.
+        """
+        key = getattr(config, "key", None)
+        if key is not None:
+            plan = self.plans.get(key)
+            if plan is not None:
+                return plan
+
+        plan = self._compile_plan(config)
+        if key is not None:
+            self.plans.put(key, plan)
+        return plan
+
+    def _parse_field(self, field, plan_field):
         """
         Pass off the data from unpacking the binary to the sensor given in
-        the configuration for actual parsing.
+        the configuration (see :class:`BinaryPlan`) for actual parsing.
         """
-        name = config["name"]
-        if 'sensor' not in config:
+        name, config, func, num_args = plan_field
+        if func is None:
             return name, field
-        sensor = 'sensors.' + config["sensor"]
         try:
-            data = self.loadable_manager.run(sensor, config, field)
+            if num_args == 1:
+                data = func(field)
+            else:
+                data = func(config, field)
         except (ValueError, KeyError) as e:
             error_type = type(e)
             raise error_type("(field {f}): {e!s}".format(f=name, e=e))
@@ -142,24 +223,20 @@ class SimpleBinaryParser(ParserModule):
 
         ValueError is raised on invalid messages.
         """
-        self._verify_config(config)
-        prefix = [config["format_prefix"]] if "format_prefix" in config else []
-        fmtstring = ''.join(prefix + [f["format"] for f in config["fields"]])
-        
+        plan = self._get_plan(config)
+
+        if len(data) != plan.struct.size:
+            raise ValueError("Could not unpack binary data: expected {0} "
+                             "bytes, got {1}".format(plan.struct.size,
+                                                     len(data)))
         try:
-            data = struct.unpack(str(fmtstring), data)
-        except struct.error as exp:
+            data = plan.struct.unpack_from(memoryview(data))
+        except (struct.error, TypeError) as exp:
             raise ValueError("Could not unpack binary data: {0}".format(exp))
-        
-        if len(data) != len(config["fields"]):
-            raise ValueError(
-                "Number of extracted fields does not match config"
-                " (got {0}, expected {1}).".format(
-                len(data), len(config["fields"])))
-        
+
         output = {}
-        for field, field_config in zip(data, config["fields"]):
-            name, data = self._parse_field(field, field_config)
-            output[name] = data
+        for field, plan_field in zip(data, plan.fields):
+            name, value = self._parse_field(field, plan_field)
+            output[name] = value
 
         return output
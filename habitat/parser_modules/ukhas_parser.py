@@ -50,21 +50,51 @@ this case the message should not include a terminating ``*``.
 """
 
 import re
+import threading
+import collections
 
-from ..parser import ParserModule, CantParse
-from ..utils import checksums
+from ..parser import ParserModule, CantParse, sniff
+from ..utils import checksums, lru_cache
 
 checksum_algorithms = [
     "crc16-ccitt", "xor", "fletcher-16", "fletcher-16-256", "none"]
 
+_checksum_names = {"crc16-ccitt": "CRC16-CCITT", "xor": "XOR",
+                   "fletcher-16": "Fletcher-16",
+                   "fletcher-16-256": "Fletcher-16-256"}
+
+
+SentencePlan = collections.namedtuple("SentencePlan",
+                                      ["checksum", "num_fields", "fields"])
+
+Tokens = collections.namedtuple("Tokens", ["body", "checksum", "fields"])
+
 
 class UKHASParser(ParserModule):
-    """The UKHAS Parser Module"""
+    """
+    The UKHAS Parser Module
+
+    Sentence configurations are verified and their sensors looked up once,
+    producing a :class:`SentencePlan`. Plans are cached by
+    :attr:`SentenceConfig.key <habitat.parser.SentenceConfig.key>`, so
+    messages from a payload whose configuration has been seen before skip
+    straight to parsing.
+
+    Each sentence is split into :class:`Tokens` once: the result of
+    :meth:`pre_parse` is kept (per thread) and reused by :meth:`parse` if it
+    is given the same string.
+    """
 
-    string_exp = re.compile("^[\\x20-\\x7E]+$")
     callsign_exp = re.compile("^[a-zA-Z0-9/_\\-]+$")
     checksum_exp = re.compile("^[a-fA-F0-9]+$")
 
+    plan_cache_size = 1000
+
+    def __init__(self, parser):
+        super(UKHASParser, self).__init__(parser)
+        self.plans = lru_cache.LRUCache(self.plan_cache_size)
+        self._tokenized = threading.local()
+
     def _split_basic_format(self, string):
         """
         Verify the basic format and content, and split up the telemetry.
@@ -80,44 +110,34 @@ class UKHASParser(ParserModule):
         It then returns (string, checksum) with delimiters '$$' '*' and '\\n'
         discarded.
 
+        The checks use :func:`habitat.parser.sniff`, so a string the parser
+        has already sniffed is not scanned again.
+
         Raises :py:exc:`ValueError <exceptions.ValueError>` on error.
         """
 
-        if len(string) < 8:
+        sniffed = sniff(string)
+
+        if sniffed.length < 8:
             raise ValueError("String is less than 8 characters.")
         if string[:2] != "$$":
             raise ValueError("String does not start `$$'.")
         if string[-1] != "\n":
             raise ValueError("String does not end with '\\n'")
-
-        string = string[2:-1]
-
-        if not self.string_exp.search(string):
+        if sniffed.kind != "ukhas":
             raise ValueError("String contains characters that are not "
                              "printable ASCII.")
 
-        string, checksum = self._split_checksum(string)
+        if sniffed.checksum_at is None:
+            string, checksum = string[2:-1], None
+        else:
+            at = sniffed.checksum_at
+            string, checksum = string[2:at], string[at + 1:-1]
         if checksum and not self.checksum_exp.search(checksum):
             raise ValueError("Checksum found but contained non-hex digits.")
 
         return string, checksum
 
-    def _split_checksum(self, string):
-        """
-        Splits off a two or four digit checksum from the end of the string.
-
-        Returns a list of the start of the string and the checksum, discarding
-        the ``*`` separator between the two. Returns :py:data:`None` for the
-        checksum if no ``*`` was found.
-        """
-
-        if string[-3] == '*':
-            return [string[:-3], string[-2:]]
-        elif string[-5] == '*':
-            return [string[:-5], string[-4:]]
-        else:
-            return [string, None]
-
     def _extract_fields(self, string):
         """
         Splits the string into comma-separated fields.
@@ -131,6 +151,33 @@ class UKHASParser(ParserModule):
             raise ValueError("No fields found.")
         return fields
 
+    def _tokenize(self, string):
+        """
+        Verify the format of *string* and split it up, returning
+        :class:`Tokens` ``(body, checksum, fields)``: the sentence between
+        ``$$`` and ``*``, the checksum (or None) and the comma-separated
+        fields, the first of which is a valid callsign.
+
+        The tokens of the last string tokenized by this thread are
+        remembered, so that :meth:`parse` needn't repeat the work of
+        :meth:`pre_parse`.
+
+        Raises :py:exc:`ValueError <exceptions.ValueError>` on error.
+        """
+
+        last = self._tokenized
+        if getattr(last, "string", None) is string:
+            return last.tokens
+
+        body, checksum = self._split_basic_format(string)
+        fields = self._extract_fields(body)
+        self._verify_callsign(fields[0])
+
+        tokens = Tokens(body, checksum, fields)
+        last.string = string
+        last.tokens = tokens
+        return tokens
+
     def _verify_config(self, config):
         """
         Checks the provided *config* dict.
@@ -173,38 +220,75 @@ class UKHASParser(ParserModule):
 
         if checksum == None and algorithm != "none":
             raise ValueError("No checksum found but config specifies one.")
-        elif algorithm == "crc16-ccitt":
-            if checksums.crc16_ccitt(string) != checksum.upper():
-                raise ValueError("Invalid CRC16-CCITT checksum.")
-        elif algorithm == "xor":
-            if checksums.xor(string) != checksum.upper():
-                raise ValueError("Invalid XOR checksum.")
-        elif algorithm == "fletcher-16":
-            if checksums.fletcher_16(string) != checksum.upper():
-                raise ValueError("Invalid Fletcher-16 checksum.")
-        elif algorithm == "fletcher-16-256":
-            if checksums.fletcher_16(string, 256) != checksum.upper():
-                raise ValueError("Invalid Fletcher-16-256 checksum.")
+        elif algorithm != "none":
+            if checksums.checksum(algorithm, string) != checksum.upper():
+                raise ValueError("Invalid {0} checksum."
+                                 .format(_checksum_names[algorithm]))
 
     def _verify_callsign(self, callsign):
         if not self.callsign_exp.search(callsign):
             raise ValueError("Invalid callsign, contains characters "
                              "besides A-Z and 0-9.")
 
-    def _parse_field(self, field, config):
+    def _compile_plan(self, config):
         """
-        Parse a *field* string using its configuration dictionary.
+        Verify the sentence *config* and look up its sensors, returning a
+        :class:`SentencePlan`.
+
+        The plan's ``fields`` is a list of tuples
+        ``(name, field config, sensor function, number of arguments)``.
+
+        Raises :py:exc:`ValueError <exceptions.ValueError>` if *config* is
+        invalid or refers to a sensor that is not loaded.
+        """
+
+        self._verify_config(config)
+
+        fields = []
+        for field_config in config["fields"]:
+            name = field_config["name"]
+            sensor = 'sensors.' + field_config["sensor"]
+            try:
+                func, num_args = self.loadable_manager.resolve(sensor)
+            except ValueError as e:
+                raise ValueError("(field {f}): {e!s}".format(f=name, e=e))
+            fields.append((name, field_config, func, num_args))
+
+        return SentencePlan(config["checksum"], len(fields), fields)
+
+    def _get_plan(self, config):
+        """
+        Get the :class:`SentencePlan` for *config*, from the cache if
+        possible.
+        """
+
+        key = getattr(config, "key", None)
+        if key is not None:
+            plan = self.plans.get(key)
+            if plan is not None:
+                return plan
+
+        plan = self._compile_plan(config)
+        if key is not None:
+            self.plans.put(key, plan)
+        return plan
+
+    def _parse_field(self, field, plan_field):
+        """
+        Parse a *field* string using its entry in a :class:`SentencePlan`.
 
         Return the name from the config and the appropriately parsed data.
         :py:exc:`ValueError <exceptions.ValueError>` is raised in invalid
         inputs.
         """
 
-        name = config["name"]
-        sensor = 'sensors.' + config["sensor"]
+        name, config, func, num_args = plan_field
 
         try:
-            data = self.loadable_manager.run(sensor, config, field)
+            if num_args == 1:
+                data = func(field)
+            else:
+                data = func(config, field)
         except (ValueError, KeyError) as e:
             # Annotate error with the field name.
             error_type = type(e)
@@ -222,12 +306,10 @@ class UKHASParser(ParserModule):
         """
 
         try:
-            string, checksum = self._split_basic_format(string)
-            fields = self._extract_fields(string)
-            self._verify_callsign(fields[0])
+            tokens = self._tokenize(string)
         except (ValueError, KeyError):
             raise CantParse
-        return fields[0]
+        return tokens.fields[0]
 
     def parse(self, string, config):
         """
@@ -244,19 +326,17 @@ class UKHASParser(ParserModule):
         :py:exc:`ValueError <exceptions.ValueError>` is raised on invalid
         messages.
         """
-        self._verify_config(config)
-        strippedstring, checksum = self._split_basic_format(string)
-        self._verify_checksum(strippedstring, checksum, config["checksum"])
-
-        fields = self._extract_fields(strippedstring)
-        self._verify_callsign(fields[0])
+        plan = self._get_plan(config)
+        tokens = self._tokenize(string)
+        self._verify_checksum(tokens.body, tokens.checksum, plan.checksum)
 
-        if len(fields) - 1 != len(config["fields"]):
+        fields = tokens.fields
+        if len(fields) - 1 != plan.num_fields:
             raise ValueError("Incorrect number of fields (got {0}, expect {1})"
-                    .format(len(fields) - 1, len(config["fields"])))
+                    .format(len(fields) - 1, plan.num_fields))
 
         output = {"payload": fields[0], "_sentence": string}
-        for field, field_config in zip(fields[1:], config["fields"]):
-            name, data = self._parse_field(field, field_config)
+        for field, plan_field in zip(fields[1:], plan.fields):
+            name, data = self._parse_field(field, plan_field)
             output[name] = data
         return output
@@ -0,0 +1,172 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the in-memory payload_configuration resolver
+"""
+
+import mox
+import couchdbkit
+
+from nose.tools import eq_
+
+from .. import config_resolver
+
+
+def make_config(doc_id, callsigns, time_created="2013-01-01T00:00:00Z"):
+    return {"_id": doc_id, "type": "payload_configuration",
+            "time_created": time_created,
+            "sentences": [{"callsign": c} for c in callsigns]}
+
+def make_flight(doc_id, payloads, start="1970-01-01T00:00:05Z",
+                end="1970-01-01T00:00:10Z", approved=True):
+    return {"_id": doc_id, "type": "flight", "approved": approved,
+            "start": start, "end": end, "payloads": payloads}
+
+
+class TestConfigResolver(object):
+    def setup(self):
+        self.m = mox.Mox()
+        self.mock_db = self.m.CreateMock(couchdbkit.Database)
+        self.m.StubOutWithMock(config_resolver, 'time')
+        self.resolver = config_resolver.ConfigResolver(self.mock_db)
+
+    def teardown(self):
+        self.m.UnsetStubs()
+
+    def test_load(self):
+        config = make_config("config", ["habitat"])
+        self.mock_db.info().AndReturn({"update_seq": 1234})
+        config_resolver.time.time().AndReturn(7)
+        self.mock_db.view("flight/end_start_including_payloads",
+                          startkey=[7]).AndReturn([
+            {"key": [10, 5, "flight", 0], "id": "flight",
+             "value": ["config"]},
+            {"key": [10, 5, "flight", 1], "id": "flight",
+             "value": {"_id": "config"}},
+            {"key": [12, 5, "empty", 0], "id": "empty", "value": None}])
+        self.mock_db.view("payload_configuration/name_time_created",
+                          include_docs=True).AndReturn([
+            {"id": "config", "key": ["config", 0], "doc": config}])
+        self.m.ReplayAll()
+        self.resolver.load()
+        self.m.VerifyAll()
+
+        eq_(self.resolver.last_seq, 1234)
+        eq_(self.resolver.flights, {"flight": (10, 5, ["config"]),
+                                    "empty": (12, 5, [])})
+        eq_(self.resolver.configs, {"config": config})
+        eq_(self.resolver.callsigns, {"habitat": {"config": (1356998400, 0)}})
+
+    def test_finds_active_flights_in_view_order(self):
+        self.resolver.update(make_config("c1", ["habitat"]))
+        self.resolver.update(make_config("c2", ["habitat"]))
+        self.resolver.update(make_config("c3", ["habitat"]))
+        # ended
+        self.resolver.update(make_flight("f1", ["c1"],
+                                         end="1970-01-01T00:00:03Z"))
+        # not yet started
+        self.resolver.update(make_flight("f2", ["c1"],
+                                         start="1970-01-01T00:00:06Z"))
+        # not approved
+        self.resolver.update(make_flight("f3", ["c1"], approved=False))
+        # active, but sorts after f5
+        self.resolver.update(make_flight("f4", ["c2"],
+                                         end="1970-01-01T00:00:11Z"))
+        self.resolver.update(make_flight("f5", ["missing", "c3"]))
+
+        config_resolver.time.time().AndReturn(6.5)
+        self.m.ReplayAll()
+        eq_(self.resolver.find("habitat"),
+            {"id": "c3", "flight_id": "f5",
+             "payload_configuration": self.resolver.configs["c3"]})
+        self.m.VerifyAll()
+
+    def test_falls_back_to_most_recent_config(self):
+        self.resolver.update(make_flight("f1", ["c1"]))
+        self.resolver.update(make_config("c1", ["other"]))
+        self.resolver.update(make_config("c2", ["habitat"],
+                                         "2013-01-02T00:00:00Z"))
+        self.resolver.update(make_config("c3", ["habitat"],
+                                         "2013-01-01T00:00:00Z"))
+        self.resolver.update(make_config("c4", ["habitat"]))
+
+        config_resolver.time.time().AndReturn(6.5)
+        config_resolver.time.time().AndReturn(6.5)
+        self.m.ReplayAll()
+        eq_(self.resolver.find("habitat"),
+            {"id": "c2", "payload_configuration": self.resolver.configs["c2"]})
+        assert self.resolver.find("nothing") is None
+        self.m.VerifyAll()
+
+    def test_priority(self):
+        self.resolver.update(make_config("c1", ["flying"]))
+        self.resolver.update(make_config("c2", ["landed"]))
+        self.resolver.update(make_flight("f1", ["c1"]))
+        self.resolver.update(make_flight("f2", ["c2"],
+                                         end="1970-01-01T00:00:03Z"))
+
+        for i in xrange(3):
+            config_resolver.time.time().AndReturn(6.5)
+        self.m.ReplayAll()
+        eq_(self.resolver.priority("flying"), config_resolver.PRIORITY_FLIGHT)
+        eq_(self.resolver.priority("landed"), config_resolver.PRIORITY_CONFIG)
+        eq_(self.resolver.priority("noise"), config_resolver.PRIORITY_UNKNOWN)
+        self.m.VerifyAll()
+
+    def test_ties_broken_by_sentence_index_then_id(self):
+        self.resolver.update(make_config("c1", ["habitat", "habitat"]))
+        self.resolver.update(make_config("c2", ["habitat", "x"]))
+        self.resolver.update(make_config("c0", ["x", "habitat"]))
+
+        config_resolver.time.time().AndReturn(6.5)
+        self.m.ReplayAll()
+        eq_(self.resolver.find("habitat")["id"], "c1")
+        self.m.VerifyAll()
+
+    def test_changes_update_and_remove_docs(self):
+        self.resolver.update(make_config("c1", ["habitat"]))
+        self.resolver.update(make_flight("f1", ["c1"]))
+
+        self.resolver._changes_callback(
+            {"seq": 5, "id": "c1", "doc": make_config("c1", ["renamed"])})
+        eq_(self.resolver.last_seq, 5)
+        eq_(self.resolver.callsigns.keys(), ["renamed"])
+
+        self.resolver._changes_callback(
+            {"seq": 6, "id": "f1",
+             "doc": make_flight("f1", ["c1"], approved=False)})
+        eq_(self.resolver.flights, {})
+
+        self.resolver._changes_callback(
+            {"seq": 7, "id": "c1", "deleted": True,
+             "doc": {"_id": "c1", "_deleted": True}})
+        eq_(self.resolver.configs, {})
+        eq_(self.resolver.callsigns, {})
+
+    def test_run_follows_configs_changes(self):
+        self.resolver.last_seq = 1234
+        self.m.StubOutWithMock(config_resolver, 'immortal_changes')
+        consumer = self.m.CreateMockAnything()
+        config_resolver.immortal_changes.Consumer(self.mock_db)\
+                .AndReturn(consumer)
+        consumer.wait(self.resolver._changes_callback,
+                      filter="parser/configs", since=1234,
+                      include_docs=True, heartbeat=1000)
+        self.m.ReplayAll()
+        self.resolver.run()
+        self.m.VerifyAll()
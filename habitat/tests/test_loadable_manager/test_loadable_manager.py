@@ -20,7 +20,7 @@ Tests the Loadable Manager
 """
 
 import mox
-from nose.tools import raises
+from nose.tools import raises, assert_raises
 from ... import loadable_manager
 
 from . import example_loadable_library_a, example_loadable_library_b
@@ -117,6 +117,47 @@ class TestLoadableManager(object):
         self.mocker.VerifyAll()
         self.mocker.ResetAll()
 
+    def test_resolve_returns_function_and_number_of_args(self):
+        loadable_manager.dynamicloader.load(example_path + "_a").AndReturn(
+            example_loadable_library_a)
+        loadable_manager.dynamicloader.load(example_path + "_b").AndReturn(
+            example_loadable_library_b)
+        f_a = example_loadable_library_a.format_a
+        f_c = example_loadable_library_b.format_c
+        loadable_manager.dynamicloader.hasnumargs(f_a, 1).AndReturn(True)
+        loadable_manager.dynamicloader.hasnumargs(f_c, 1).AndReturn(False)
+        self.mocker.ReplayAll()
+
+        mgr = loadable_manager.LoadableManager(fake_config)
+        assert mgr.resolve("liba.format_a") == (f_a, 1)
+        assert mgr.resolve("libb.format_c") == (f_c, 2)
+
+        self.mocker.VerifyAll()
+        self.mocker.ResetAll()
+
+    def test_resolve_caches_until_load(self):
+        loadable_manager.dynamicloader.load(example_path + "_a").AndReturn(
+            example_loadable_library_a)
+        loadable_manager.dynamicloader.load(example_path + "_b").AndReturn(
+            example_loadable_library_b)
+        f_a = example_loadable_library_a.format_a
+        f_c = example_loadable_library_b.format_c
+        loadable_manager.dynamicloader.hasnumargs(f_a, 1).AndReturn(False)
+        loadable_manager.dynamicloader.load(example_path + "_b").AndReturn(
+            example_loadable_library_b)
+        loadable_manager.dynamicloader.hasnumargs(f_c, 1).AndReturn(False)
+        self.mocker.ReplayAll()
+
+        mgr = loadable_manager.LoadableManager(fake_config)
+        assert mgr.resolve("liba.format_a") == (f_a, 2)
+        assert mgr.resolve("liba.format_a") == (f_a, 2)
+        mgr.load(example_path + "_b", "liba")
+        assert_raises(ValueError, mgr.resolve, "liba.format_a")
+        assert mgr.resolve("liba.format_c") == (f_c, 2)
+
+        self.mocker.VerifyAll()
+        self.mocker.ResetAll()
+
     def test_repr_describes_manager(self):
         mgr = loadable_manager.LoadableManager(empty_config)
         expect = "<habitat.LoadableManager: {num} libraries loaded>"
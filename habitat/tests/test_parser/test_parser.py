@@ -29,7 +29,9 @@ import M2Crypto
 from copy import deepcopy
 from nose.tools import assert_raises, eq_
 
-from ... import parser, loadable_manager
+from ... import parser, loadable_manager, config_resolver
+from ...parser_modules import ukhas_parser
+from ...utils import lru_cache, stage_timing
 
 
 class TestParser(object):
@@ -63,6 +65,42 @@ class TestParser(object):
     def teardown(self):
         self.m.UnsetStubs()
 
+    def test_config_resolver_callback_is_added_before_start(self):
+        config = deepcopy(self.parser_config)
+        config["parser"]["config_resolver"] = True
+        config["parser"]["negative_cache_size"] = 10
+        resolver = self.m.CreateMock(config_resolver.ConfigResolver)
+        resolver.callbacks = []
+        self.m.StubOutWithMock(parser.config_resolver, "ConfigResolver")
+        parser.couchdbkit.Server("http://localhost:5984")\
+                .AndReturn(self.mock_server)
+        self.mock_server.__getitem__("test").AndReturn(self.mock_db)
+        parser.config_resolver.ConfigResolver(self.mock_db)\
+                .AndReturn(resolver)
+        resolver.start().WithSideEffects(
+                lambda: eq_(len(resolver.callbacks), 1))
+        self.m.ReplayAll()
+        p = parser.Parser(config)
+        self.m.VerifyAll()
+        eq_(resolver.callbacks, [p._config_changed])
+
+    def test_config_watcher_follows_changes_from_before_loading(self):
+        config = deepcopy(self.parser_config)
+        config["radiosonde_override_prefix"] = "RS_"
+        config["radiosonde_override"] = "sonde"
+        sonde = {"_id": "sonde", "_rev": "1-abc", "sentences": []}
+        self.m.StubOutWithMock(parser.Parser, "_start_config_watcher")
+        parser.couchdbkit.Server("http://localhost:5984")\
+                .AndReturn(self.mock_server)
+        self.mock_server.__getitem__("test").AndReturn(self.mock_db)
+        self.mock_db.info().AndReturn({"update_seq": 12})
+        self.mock_db.__getitem__("sonde").AndReturn(sonde)
+        parser.Parser._start_config_watcher(12)
+        self.m.ReplayAll()
+        p = parser.Parser(config)
+        self.m.VerifyAll()
+        eq_(p.rs_config["payload_configuration"], sonde)
+
     def test_init_doesnt_mess_up_config_modules(self):
         # once upon a time parser didn't deepcopy config, so config['modules']
         # would get all messed up
@@ -165,6 +203,15 @@ class TestParser(object):
         eq_(result, {"id": 123, "payload_configuration": config_result["doc"]})
         self.m.VerifyAll()
 
+    def test_find_config_doc_uses_config_resolver(self):
+        resolver = self.m.CreateMock(config_resolver.ConfigResolver)
+        self.parser.config_resolver = resolver
+        result = {"id": 123, "payload_configuration": {}}
+        resolver.find("habitat").AndReturn(result)
+        self.m.ReplayAll()
+        assert self.parser._find_config_doc("habitat") is result
+        self.m.VerifyAll()
+
     def test_is_ok_with_configs_without_sentences(self):
         # issue #255: KeyError because sentences is optional in
         # payload_configuration documents
@@ -243,6 +290,21 @@ class TestParser(object):
         assert len(result['receivers']) == 1
         self.m.VerifyAll()
 
+    def test_gives_modules_sentence_keys(self):
+        doc = {'data': {'_raw': "dGVzdCBzdHJpbmc="}, '_id': 'telem',
+               'receivers': {'tester': {'time_created': 123}}}
+        config = {'sentences': [{"callsign": "callsign", 'protocol': 'Mock'}],
+                  '_rev': '1-abc'}
+        config = {'payload_configuration': config, 'id': 'test'}
+        self.m.StubOutWithMock(self.parser, '_find_config_doc')
+        self.mock_module.pre_parse('test string').AndReturn('callsign')
+        self.parser._find_config_doc('callsign').AndReturn(config)
+        self.mock_module.parse('test string', mox.Func(
+            lambda s: s.key == ('test', '1-abc', 0))).AndReturn({})
+        self.m.ReplayAll()
+        assert self.parser.parse(doc)
+        self.m.VerifyAll()
+
     def test_uses_fallback_data(self):
         doc = {'data': {}, 'receivers': {'tester': {}}, '_id': 'telem'}
         doc['data']['_raw'] = "dGVzdCBzdHJpbmc="
@@ -304,6 +366,37 @@ class TestParser(object):
         self.parser.parse(doc)
         self.m.VerifyAll()
 
+    def test_times_stages(self):
+        doc, config = self.setup_parse()
+        self.m.ReplayAll()
+        timer = stage_timing.StageTimer("test_id")
+        self.parser.parse(doc, timer=timer)
+        self.m.VerifyAll()
+        eq_([entry[:3] for entry in timer.entries],
+            [("pre_filter", "Mock", None), ("pre_parse", "Mock", None),
+             ("config", "Mock", None), ("intermediate_filter", "Mock", "test"),
+             ("parse", "Mock", "test"), ("post_filter", "Mock", "test")])
+        eq_(timer.config_id, "test")
+
+    def test_records_own_timer(self):
+        doc, config = self.setup_parse()
+        self.parser.stage_timings = self.m.CreateMock(
+                stage_timing.StageTimings)
+        self.parser.stage_timings.record(mox.IsA(stage_timing.StageTimer))
+        self.m.ReplayAll()
+        self.parser.parse(doc)
+        self.m.VerifyAll()
+
+    def test_times_each_parse_once(self):
+        doc, config = self.setup_parse()
+        metrics = parser.metrics._metrics
+        self.m.stubs.Set(metrics, "_next_flush", float("inf"))
+        self.m.stubs.Set(metrics, "timers", {})
+        self.m.ReplayAll()
+        self.parser.parse(doc)
+        self.m.VerifyAll()
+        eq_(metrics.timers["parser.time"].n, 1)
+
     def test_doesnt_use_configs_for_other_protocols(self):
         # This was a bug: by @danielrichman:
         # If we have parsermodules A and B, and call parse("some
@@ -334,23 +427,215 @@ class TestParser(object):
         mods = self.parser.modules
         self.parser._get_callsign("test string", {},
             mods[0]).AndReturn("callsign one")
-        self.parser._get_config("callsign one", None).AndReturn("config one")
-        self.parser._get_data("test string", "callsign one", "config one",
-            mods[0]).AndRaise(parser.CantGetData())
+        config_one = {"id": "config one"}
+        self.parser._get_config("callsign one", None).AndReturn(config_one)
+        self.parser._get_data("test string", "callsign one", config_one,
+            mods[0], None, provided=False)\
+            .AndRaise(parser.CantGetData())
 
         # second module gets tried, should be given None as the config as
         # the previously found one is bad. the bug is that it would be given
         # "config one" instead of None.
         self.parser._get_callsign("test string", {},
             mods[1]).AndReturn("callsign two")
-        self.parser._get_config("callsign two", None).AndReturn("config two")
-        self.parser._get_data("test string", "callsign two", "config two",
-            mods[1]).AndRaise(parser.CantGetData())
+        config_two = {"id": "config two"}
+        self.parser._get_config("callsign two", None).AndReturn(config_two)
+        self.parser._get_data("test string", "callsign two", config_two,
+            mods[1], None, provided=False)\
+            .AndRaise(parser.CantGetData())
 
         self.m.ReplayAll()
         self.parser.parse(doc)
         self.m.VerifyAll()
 
+    def setup_routes(self):
+        self.parser.routes = lru_cache.LRUCache(10)
+        second_module = self.m.CreateMock(parser.ParserModule)
+        self.parser.modules.append({"name": "MockTwo",
+                                    "module": second_module})
+        self.m.StubOutWithMock(self.parser, '_get_callsign')
+        self.m.StubOutWithMock(self.parser, '_get_config')
+        self.m.StubOutWithMock(self.parser, '_get_data')
+        doc = {'data': {'_raw': "dGVzdCBzdHJpbmc="}, '_id': 'test_id',
+               'receivers': {'tester': {'time_created': 123}}}
+        data = {"_protocol": "MockTwo",
+                "_parsed": {"configuration_sentence_index": 1}}
+        config = {"id": "config"}
+        return doc, data, config
+
+    def test_result_cache_skips_filters_and_parsing(self):
+        self.parser.results = lru_cache.LRUCache(10)
+        doc = {'data': {'_raw': "dGVzdCBzdHJpbmc=",
+                        '_fallbacks': {'extra': 1}}, '_id': 'telem',
+               'receivers': {'tester': {'time_created': 123}}}
+        config = {'sentences': [{"callsign": "callsign", 'protocol': 'Mock'}],
+                  '_rev': '1-abc'}
+        config = {'payload_configuration': config, 'id': 'test'}
+        self.m.StubOutWithMock(self.parser, '_find_config_doc')
+        self.m.StubOutWithMock(self.parser.filtering, 'post_filter')
+        self.mock_module.pre_parse('test string').AndReturn('callsign')
+        self.parser._find_config_doc('callsign').AndReturn(config)
+        self.mock_module.parse('test string', mox.IgnoreArg())\
+                .AndReturn({"a": [1]})
+        self.parser.filtering.post_filter({"a": [1]}, mox.IgnoreArg())\
+                .AndReturn({"a": [1]})
+        self.mock_module.pre_parse('test string').AndReturn('callsign')
+        self.parser._find_config_doc('callsign').AndReturn(config)
+        self.m.ReplayAll()
+
+        first = self.parser.parse(deepcopy(doc))
+        first["data"]["a"].append(2)
+        second = self.parser.parse(deepcopy(doc))
+        self.m.VerifyAll()
+
+        eq_(second["data"]["a"], [1])
+        eq_(second["data"]["extra"], 1)
+        eq_(second["data"]["_parsed"]["payload_configuration"], "test")
+        eq_(len(self.parser.results), 1)
+
+        # another revision of the configuration is parsed afresh
+        config["payload_configuration"]["_rev"] = "2-def"
+        self.m.ResetAll()
+        self.mock_module.pre_parse('test string').AndReturn('callsign')
+        self.parser._find_config_doc('callsign').AndReturn(config)
+        self.mock_module.parse('test string', mox.IgnoreArg())\
+                .AndReturn({"a": [3]})
+        self.parser.filtering.post_filter({"a": [3]}, mox.IgnoreArg())\
+                .AndReturn({"a": [3]})
+        self.m.ReplayAll()
+        eq_(self.parser.parse(deepcopy(doc))["data"]["a"], [3])
+        self.m.VerifyAll()
+
+    def test_result_cache_is_not_used_after_certs_change(self):
+        self.parser.results = lru_cache.LRUCache(10)
+        doc = {'data': {'_raw': "dGVzdCBzdHJpbmc="}, '_id': 'telem',
+               'receivers': {'tester': {'time_created': 123}}}
+        config = {'sentences': [{"callsign": "callsign", 'protocol': 'Mock'}],
+                  '_rev': '1-abc'}
+        config = {'payload_configuration': config, 'id': 'test'}
+        self.m.StubOutWithMock(self.parser, '_find_config_doc')
+        for i in xrange(2):
+            self.mock_module.pre_parse('test string').AndReturn('callsign')
+            self.parser._find_config_doc('callsign').AndReturn(config)
+            self.mock_module.parse('test string', mox.IgnoreArg())\
+                    .AndReturn({"a": i})
+        self.m.ReplayAll()
+
+        eq_(self.parser.parse(deepcopy(doc))["data"]["a"], 0)
+        self.parser.filtering.certs_mtimes = [0, 0]
+        eq_(self.parser.parse(deepcopy(doc))["data"]["a"], 1)
+        self.m.VerifyAll()
+
+    def test_result_cache_is_not_used_for_provided_configs(self):
+        self.parser.results = lru_cache.LRUCache(10)
+        doc = {'data': {'_raw': "dGVzdCBzdHJpbmc="}, '_id': 'telem',
+               'receivers': {'tester': {'time_created': 123}}}
+        config = {'sentences': [{"callsign": "callsign", 'protocol': 'Mock'}],
+                  '_id': 'test', '_rev': '1-abc'}
+        for i in xrange(2):
+            self.mock_module.pre_parse('test string').AndReturn('callsign')
+            self.mock_module.parse('test string', mox.IgnoreArg())\
+                    .AndReturn({"a": i})
+        self.m.ReplayAll()
+
+        eq_(self.parser.parse(deepcopy(doc), config)["data"]["a"], 0)
+        eq_(self.parser.parse(deepcopy(doc), config)["data"]["a"], 1)
+        self.m.VerifyAll()
+        eq_(len(self.parser.results), 0)
+
+    def test_tries_last_successful_module_first(self):
+        doc, data, config = self.setup_routes()
+        mods = self.parser.modules
+
+        self.parser._get_callsign("test string", {}, mods[0])\
+                .AndRaise(parser.CantGetCallsign())
+        self.parser._get_callsign("test string", {}, mods[1])\
+                .AndReturn("callsign")
+        self.parser._get_config("callsign", None).AndReturn(config)
+        self.parser._get_data("test string", "callsign", config, mods[1],
+                              None, provided=False).AndReturn(dict(data))
+
+        # the route is remembered for the receiver
+        self.parser._get_callsign("test string", {}, mods[1])\
+                .AndReturn("callsign")
+        self.parser._get_config("callsign", None).AndReturn(config)
+        self.parser._get_data("test string", "callsign", config, mods[1],
+                              1, provided=False).AndReturn(dict(data))
+
+        self.m.ReplayAll()
+        self.parser.parse(deepcopy(doc))
+        eq_(self.parser.routes.get(("receiver", "tester")), "MockTwo")
+        eq_(self.parser.routes.get(("sentence", "config", None, "callsign")),
+            1)
+        self.parser.parse(deepcopy(doc))
+        self.m.VerifyAll()
+
+    def test_sentence_is_only_tried_first_for_the_same_config(self):
+        doc, data, config = self.setup_routes()
+        mods = self.parser.modules
+        other = {"id": "other"}
+        self.parser.routes.put(("receiver", "tester"), "MockTwo")
+        self.parser.routes.put(("sentence", "config", None, "callsign"), 1)
+
+        # the receiver now hears another payload
+        self.parser._get_callsign("test string", {}, mods[1])\
+                .AndReturn("another")
+        self.parser._get_config("another", None).AndReturn(other)
+        self.parser._get_data("test string", "another", other, mods[1],
+                              None, provided=False).AndReturn(dict(data))
+
+        self.m.ReplayAll()
+        self.parser.parse(deepcopy(doc))
+        self.m.VerifyAll()
+
+    def test_falls_back_to_other_modules(self):
+        doc, data, config = self.setup_routes()
+        mods = self.parser.modules
+        self.parser.routes.put(("receiver", "tester"), "MockTwo")
+
+        self.parser._get_callsign("test string", {}, mods[1])\
+                .AndRaise(parser.CantGetCallsign())
+        self.parser._get_callsign("test string", {}, mods[0])\
+                .AndReturn("callsign")
+        self.parser._get_config("callsign", None).AndReturn(config)
+        data = {"_protocol": "Mock",
+                "_parsed": {"configuration_sentence_index": 0}}
+        self.parser._get_data("test string", "callsign", config, mods[0],
+                              None, provided=False).AndReturn(data)
+
+        self.m.ReplayAll()
+        self.parser.parse(doc)
+        self.m.VerifyAll()
+        eq_(self.parser.routes.get(("receiver", "tester")), "Mock")
+
+    def test_prefers_modules_of_provided_config(self):
+        doc, data, config = self.setup_routes()
+        mods = self.parser.modules
+        initial = {"sentences": [{"callsign": "callsign",
+                                  "protocol": "MockTwo"}]}
+
+        self.parser._get_callsign("test string", {}, mods[1])\
+                .AndReturn("callsign")
+        self.parser._get_config("callsign", initial).AndReturn(config)
+        self.parser._get_data("test string", "callsign", config, mods[1],
+                              None, provided=True).AndReturn(data)
+
+        self.m.ReplayAll()
+        self.parser.parse(doc, initial)
+        self.m.VerifyAll()
+
+    def test_get_data_tries_first_sentence_first(self):
+        config = {"id": "test", "payload_configuration": {"sentences": [
+            {"callsign": "callsign", "protocol": "Mock", "n": 0},
+            {"callsign": "callsign", "protocol": "Mock", "n": 1}]}}
+        sentences = config["payload_configuration"]["sentences"]
+        self.mock_module.parse("test string", sentences[1]).AndReturn({})
+        self.m.ReplayAll()
+        data = self.parser._get_data("test string", "callsign", config,
+                                     self.parser.modules[0], 1)
+        self.m.VerifyAll()
+        eq_(data["_parsed"]["configuration_sentence_index"], 1)
+
     def test_uses_provided_config_despite_no_id(self):
         config = {"sentences": [{"callsign": "supply", "protocol": "Mock"}]}
         result = {"id": None, "payload_configuration": config}
@@ -381,11 +666,144 @@ class TestParser(object):
         assert self.parser._get_config('call_c') == result2
         self.m.VerifyAll()
 
+    def test_negative_cache_skips_lookups(self):
+        self.parser.negative_cache = lru_cache.LRUCache(10)
+        self.m.StubOutWithMock(self.parser, '_find_config_doc')
+        self.parser._find_config_doc('noise').AndReturn(None)
+        self.m.ReplayAll()
+        assert_raises(parser.CantGetConfig, self.parser._get_config, 'noise')
+        assert_raises(parser.CantGetConfig, self.parser._get_config, 'noise')
+        self.m.VerifyAll()
+
+    def test_negative_cache_invalidated_by_new_config(self):
+        self.parser.negative_cache = lru_cache.LRUCache(10)
+        self.m.StubOutWithMock(self.parser, '_find_config_doc')
+        result = {"id": "new", "payload_configuration": {}}
+        self.parser._find_config_doc('call').AndReturn(None)
+        self.parser._find_config_doc('call').AndReturn(result)
+        self.m.ReplayAll()
+        assert_raises(parser.CantGetConfig, self.parser._get_config, 'call')
+        self.parser._config_changed({"type": "flight"})
+        assert 'call' in self.parser.negative_cache
+        self.parser._config_changed({"type": "payload_configuration",
+                                     "sentences": [{"callsign": "call"}]})
+        assert self.parser._get_config('call') == result
+        self.m.VerifyAll()
+
+    def test_negative_cache_ignores_stale_lookups(self):
+        # a config saved while the lookup was in progress must not be
+        # hidden by the (now out of date) negative result.
+        self.parser.negative_cache = lru_cache.LRUCache(10)
+        def find_config_doc(callsign):
+            self.parser._config_changed({"type": "payload_configuration"})
+            return None
+        self.parser._find_config_doc = find_config_doc
+        assert_raises(parser.CantGetConfig, self.parser._get_config, 'call')
+        assert 'call' not in self.parser.negative_cache
+
     def test_raises_if_provided_config_doesnt_have_correct_callsign(self):
         config = {"sentences": [{"callsign": "bad", "protocol": "Mock"}]}
         assert_raises(parser.CantGetConfig, self.parser._get_config,
             'good', config)
 
+    def setup_radiosonde(self, rev="1-abc"):
+        self.parser.rs_id = "sonde"
+        doc = {"_id": "sonde", "_rev": rev, "name": "RS",
+               "sentences": [{"callsign": "RS", "protocol": "Mock"},
+                             {"callsign": "RS", "protocol": "Mock"}]}
+        self.parser._load_radiosonde_config(doc)
+        return doc
+
+    def test_parse_leaves_config_untouched(self):
+        self.parser.loadable_manager.load("habitat.filters", "filters.common")
+        doc = {'data': {'_raw': "dGVzdCBzdHJpbmc="}, '_id': 'telem',
+               'receivers': {'tester': {'time_created': 123}}}
+        config = {"_id": "test", "_rev": "1-abc", "sentences": [
+            {"callsign": "callsign", "protocol": "Mock",
+             "filters": {"post": [{"type": "normal",
+                                   "filter": "common.zero_pad_coordinates"}]}
+            }]}
+        original = deepcopy(config)
+        self.mock_module.pre_parse('test string').AndReturn('callsign')
+        self.mock_module.parse('test string', mox.IgnoreArg())\
+                .AndReturn({"latitude": 51.2, "longitude": -0.5})
+        self.m.ReplayAll()
+        result = self.parser.parse(doc, config)
+        self.m.VerifyAll()
+        eq_(result["data"]["latitude"], 51.00002)
+        eq_(config, original)
+
+    def test_edits_to_provided_config_are_used(self):
+        self.parser.loadable_manager.load("habitat.sensors.base",
+                                          "sensors.base")
+        self.parser.modules = [{"name": "UKHAS",
+                                "module": ukhas_parser.UKHASParser(
+                                    self.parser)}]
+        doc = {'data': {'_raw': "JCRjYWxsc2lnbixoZWxsbwo="}, '_id': 'telem',
+               'receivers': {'tester': {'time_created': 123}}}
+        config = {"_id": "test", "_rev": "1-abc", "sentences": [
+            {"callsign": "callsign", "protocol": "UKHAS", "checksum": "none",
+             "fields": [{"name": "greeting", "sensor": "base.string"}]}]}
+        result = self.parser.parse(deepcopy(doc), config)
+        eq_(result["data"]["greeting"], "hello")
+
+        # e.g., while being edited, the config's _rev needn't change
+        config["sentences"][0]["fields"][0]["name"] = "salutation"
+        result = self.parser.parse(deepcopy(doc), config)
+        eq_(result["data"]["salutation"], "hello")
+        assert "greeting" not in result["data"]
+
+    def test_radiosonde_configs_are_built_once(self):
+        doc = self.setup_radiosonde()
+        original = deepcopy(doc)
+        config = self.parser._get_config("RS_123")
+        eq_(config["id"], "sonde")
+        eq_(config["payload_configuration"]["name"], "RS_123")
+        eq_(config["payload_configuration"]["_rev"], "1-abc")
+        sentences = config["payload_configuration"]["sentences"]
+        eq_([s["callsign"] for s in sentences], ["RS_123", "RS"])
+        assert self.parser._get_config("RS_123") is config
+        eq_(self.parser._get_config("RS_456")["payload_configuration"]
+                ["name"], "RS_456")
+        # the override doc itself is not modified
+        eq_(doc, original)
+
+    def test_radiosonde_override_reloaded_when_changed(self):
+        self.setup_radiosonde()
+        old = self.parser._get_config("RS_123")
+        self.parser._config_changed({"_id": "other",
+                                     "type": "payload_configuration"})
+        assert self.parser._get_config("RS_123") is old
+
+        self.parser._config_changed(dict(self.setup_radiosonde("2-def"),
+                                         type="payload_configuration"))
+        new = self.parser._get_config("RS_123")
+        eq_(new["payload_configuration"]["_rev"], "2-def")
+
+        self.parser._config_changed({"_id": "sonde", "_deleted": True})
+        assert self.parser.rs_config is None
+
+    def test_radiosonde_fast_path_skips_other_modules(self):
+        doc, data, config = self.setup_routes()
+        doc["data"]["_raw"] = "JCRSU18xLDEK"  # "$$RS_1,1\n"
+        mods = self.parser.modules
+        sonde = self.setup_radiosonde()
+        sonde["sentences"][1]["protocol"] = "MockTwo"
+        self.parser._load_radiosonde_config(sonde)
+        eq_(self.parser.rs_modules, mods)
+        sonde["sentences"][0]["protocol"] = "MockTwo"
+        self.parser._load_radiosonde_config(sonde)
+        eq_(self.parser.rs_modules, [mods[1]])
+
+        self.parser._get_callsign("$$RS_1,1\n", {}, mods[1])\
+                .AndReturn("RS_1")
+        self.parser._get_config("RS_1", None).AndReturn(config)
+        self.parser._get_data("$$RS_1,1\n", "RS_1", config, mods[1],
+                              None, provided=False).AndReturn(data)
+        self.m.ReplayAll()
+        assert self.parser.parse(doc)
+        self.m.VerifyAll()
+
 class TestParserFiltering(object):
     def setup(self):
         self.m = mox.Mox()
@@ -524,6 +942,60 @@ class TestParserFiltering(object):
         assert self.fil._hotfix_filter({}, f) == 'hotfix ran'
         self.m.VerifyAll()
 
+    def test_hotfix_filters_are_cached(self):
+        self.m.StubOutWithMock(self.fil, '_get_certificate')
+        self.m.StubOutWithMock(self.fil, '_verify_certificate')
+        f = {'certificate': 'cert', 'code': 'return data + 1',
+             'signature': 'sig'}
+        g = dict(f, signature='other')
+        self.fil._get_certificate('cert').AndReturn('got_cert')
+        self.fil._verify_certificate(f, 'got_cert')
+        self.fil._get_certificate('cert').AndReturn('got_cert')
+        self.fil._verify_certificate(g, 'got_cert')
+        self.m.ReplayAll()
+        assert self.fil._hotfix_filter(1, f) == 2
+        assert self.fil._hotfix_filter(2, f) == 3
+        assert self.fil._hotfix_filter(3, g) == 4
+        self.m.VerifyAll()
+
+    def test_hotfix_cache_flushed_when_certs_change(self):
+        self.m.StubOutWithMock(self.fil, '_get_certificate')
+        self.m.StubOutWithMock(self.fil, '_verify_certificate')
+        f = {'certificate': 'cert', 'code': 'return data + 1',
+             'signature': 'sig'}
+        self.fil._get_certificate('cert').AndReturn('got_cert')
+        self.fil._verify_certificate(f, 'got_cert')
+        self.fil._get_certificate('cert').AndReturn('got_cert')
+        self.fil._verify_certificate(f, 'got_cert').AndRaise(ValueError)
+        self.m.ReplayAll()
+        assert self.fil._hotfix_filter(1, f) == 2
+        self.fil.loaded_certs['cert'] = 'got_cert'
+        self.fil.certs_mtimes = [0, 0]
+        assert_raises(ValueError, self.fil._hotfix_filter, 1, f)
+        assert self.fil.loaded_certs == {}
+        assert len(self.fil.certificate_authorities) == 1
+        self.m.VerifyAll()
+
+    def test_failed_ca_reload_flushes_hotfixes_and_is_retried(self):
+        self.fil.hotfixes.put("key", "compiled")
+        self.fil.loaded_certs["cert"] = "got_cert"
+        self.fil.certs_mtimes = [0, 0]
+        self.m.StubOutWithMock(parser.M2Crypto.X509, 'load_cert')
+        parser.M2Crypto.X509.load_cert(mox.IgnoreArg())\
+                .AndRaise(M2Crypto.X509.X509Error)
+        self.m.ReplayAll()
+        assert_raises(M2Crypto.X509.X509Error, self.fil._check_certs_dir)
+        self.m.VerifyAll()
+        assert "key" not in self.fil.hotfixes
+        eq_(self.fil.loaded_certs, {})
+        eq_(self.fil.certificate_authorities, [])
+        eq_(self.fil.certs_mtimes, [0, 0])
+
+        self.m.UnsetStubs()
+        self.fil._check_certs_dir()
+        eq_(len(self.fil.certificate_authorities), 1)
+        assert self.fil.certs_mtimes != [0, 0]
+
     def test_handles_hotfix_exceptions(self):
         self.m.StubOutWithMock(self.fil, '_sanity_check_hotfix')
         self.m.StubOutWithMock(self.fil, '_get_certificate')
@@ -604,6 +1076,28 @@ class TestParserFiltering(object):
         f = {'certificate': '../../dots.pem', 'code': '', 'signature': ''}
         assert_raises(ValueError, self.fil._sanity_check_hotfix, f)
 
+    def test_failed_filters_roll_back_changes(self):
+        data = {'a': 1, 'nested': {'b': [1, 2]}}
+        original = deepcopy(data)
+        f = {'type': 'normal', 'filter': 'x'}
+
+        def bad_filter(name, f, data):
+            data['a'] = 2
+            data['nested']['b'].append(3)
+            raise ValueError
+        self.fil.loadable_manager.run('filters.x', f, data)\
+                .WithSideEffects(bad_filter)
+        self.m.ReplayAll()
+        assert self.fil._filter(data, f, dict, ('x', 0)) is data
+        assert data == original
+        self.m.VerifyAll()
+
+    def test_filters_share_immutable_values(self):
+        value = "a long string" * 100
+        copied = parser._copy_for_filter({'a': value, 'b': [1]})
+        assert copied['a'] is value
+        assert parser._copy_for_filter(value) is value
+
     def test_filter_failures_do_not_produce_errors_in_the_log(self):
         # see issue #299
         self.m.StubOutWithMock(parser.logger, 'exception')
@@ -614,3 +1108,25 @@ class TestParserFiltering(object):
         self.m.ReplayAll()
         assert self.fil._filter('asdf', f, str, ('x', 0)) == 'asdf'
         self.m.VerifyAll()
+
+
+class TestSniff(object):
+    def test_kinds(self):
+        eq_(parser.sniff("$$habitat,1,2*abcd\n"),
+            parser.Sniffed("ukhas", 19, 13))
+        eq_(parser.sniff("$$habitat,1,2*ab\n"),
+            parser.Sniffed("ukhas", 17, 13))
+        eq_(parser.sniff("$$habitat,1,2\n"),
+            parser.Sniffed("ukhas", 14, None))
+        eq_(parser.sniff("$$habitat,1,2").kind, "text")
+        eq_(parser.sniff("hello\n").kind, "text")
+        eq_(parser.sniff(u"hello").kind, "text")
+        eq_(parser.sniff("$$habitat,\x00\n").kind, "binary")
+        eq_(parser.sniff("\x01\x02").kind, "binary")
+        eq_(parser.sniff("").kind, "binary")
+
+    def test_remembers_last_string(self):
+        string = "$$habitat,1,2*ab\n"
+        first = parser.sniff(string)
+        assert parser.sniff(string) is first
+        assert parser.sniff(string[:-1]) is not first
@@ -0,0 +1,113 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the offline parser benchmark
+"""
+
+import os
+import json
+import mox
+import tempfile
+import couchdbkit
+
+from nose.tools import eq_
+
+from .. import parser_benchmark
+from ..utils import memory_couch
+
+
+config_doc = {"_id": "config", "type": "payload_configuration",
+              "time_created": "2013-01-01T00:00:00Z",
+              "sentences": [{"callsign": "habitat"}]}
+
+def telemetry(n):
+    return {"_id": str(n), "type": "payload_telemetry",
+            "data": {"_raw": "aGVsbG8K"}, "receivers": {"habitat": {}}}
+
+
+class TestParserBenchmark(object):
+    def setup(self):
+        self.m = mox.Mox()
+        self.m.StubOutWithMock(parser_benchmark.parser, 'Parser')
+        self.config = {"couch_uri": "http://localhost:5984",
+                       "couch_db": "habitat", "parser": {}}
+
+        def check_server(config):
+            return couchdbkit.Server is memory_couch.Server
+
+        self.mock_parser = self.m.CreateMockAnything()
+        parser_benchmark.parser.Parser(mox.And(
+                mox.ContainsKeyValue("couch_uri", "http://parser-benchmark"),
+                mox.Func(check_server))).AndReturn(self.mock_parser)
+        self.m.ReplayAll()
+        self.benchmark = parser_benchmark.ParserBenchmark(
+                self.config, [dict(config_doc, _rev="1-abc")])
+        self.m.VerifyAll()
+        self.m.ResetAll()
+
+    def teardown(self):
+        self.m.UnsetStubs()
+        memory_couch.reset()
+
+    def test_loads_configs_into_memory(self):
+        assert couchdbkit.Server is not memory_couch.Server
+        doc = self.benchmark.db["config"]
+        del doc["_rev"]
+        eq_(doc, config_doc)
+
+    def test_run(self):
+        parsed = telemetry(0)
+        parsed["data"]["_protocol"] = "UKHAS"
+        self.mock_parser.parse(telemetry(0)).AndReturn(parsed)
+        self.mock_parser.parse(telemetry(1)).AndReturn(None)
+        self.mock_parser.parse(telemetry(2)).AndReturn(parsed)
+        self.m.ReplayAll()
+        docs = [telemetry(i) for i in xrange(3)]
+        results = self.benchmark.run(docs)
+        self.m.VerifyAll()
+
+        # the originals are not modified
+        eq_(docs, [telemetry(i) for i in xrange(3)])
+        eq_(results["messages"], 3)
+        eq_(results["protocols"], {"UKHAS": 2})
+        eq_(results["failed"], 1)
+        assert results["p50"] <= results["p99"]
+
+        text = parser_benchmark.format_results(results)
+        assert "UKHAS: 2 parsed (66.7%)" in text
+        assert "failed: 1 (33.3%)" in text
+
+
+def test_load_dump():
+    fd, filename = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(telemetry(0)) + "\n\n")
+            f.write(json.dumps(config_doc) + "\n")
+            f.write(json.dumps({"_id": "x", "type": "listener_info"}) + "\n")
+        eq_(parser_benchmark.load_dump(filename),
+            ([telemetry(0)], [config_doc]))
+    finally:
+        os.unlink(filename)
+
+def test_percentile():
+    ordered = range(1, 101)
+    eq_(parser_benchmark._percentile(ordered, 50), 50)
+    eq_(parser_benchmark._percentile(ordered, 99), 99)
+    eq_(parser_benchmark._percentile([5], 99), 5)
+    eq_(parser_benchmark._percentile([], 50), 0.0)
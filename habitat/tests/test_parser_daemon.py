@@ -19,43 +19,86 @@
 Unit tests for the Parser's Sink class.
 """
 
+import os
+import base64
 import mox
+import shutil
+import tempfile
 import couchdbkit
 import restkit
 
 from copy import deepcopy
-from nose.tools import assert_raises
+from nose.tools import assert_raises, eq_
 
-from ..utils import immortal_changes
+from ..utils import immortal_changes, stage_timing, lru_cache
 
 from .. import parser_daemon
 
 
-class TestParserDaemon(object):
+class FakeParser(object):
+    """The parts of a :class:`Parser` that the daemon uses besides parse."""
+
+    def __init__(self):
+        self.stage_timings = stage_timing.StageTimings("test")
+
+
+class ParserDaemonFixture(object):
+    """
+    Creates a :class:`ParserDaemon` with CouchDB and the parser mocked out.
+
+    Subclasses set :attr:`daemon_config` (the ``parserdaemon`` config) and
+    may override :meth:`make_mock_parser` to give the daemon a parser.
+    """
+
+    daemon_config = None
+    update_seq = 191238
+    create_daemon = True
+
     def setup(self):
         self.m = mox.Mox()
 
         self.config = {
             "couch_uri": "http://localhost:5984", "couch_db": "test"}
+        if self.daemon_config is not None:
+            self.config["parserdaemon"] = deepcopy(self.daemon_config)
 
+        self.mock_server = self.m.CreateMock(couchdbkit.Server)
+        self.mock_db = self.m.CreateMock(couchdbkit.Database)
+        self.mock_parser = self.make_mock_parser()
+        self.stub_imports()
+
+        if self.create_daemon:
+            self.daemon = self.make_daemon()
+
+    def teardown(self):
+        self.m.UnsetStubs()
+
+    def make_mock_parser(self):
+        return FakeParser()
+
+    def stub_imports(self):
         self.m.StubOutWithMock(parser_daemon, 'couchdbkit')
         self.m.StubOutWithMock(parser_daemon, 'immortal_changes')
         self.m.StubOutWithMock(parser_daemon, 'parser')
-        self.mock_server = self.m.CreateMock(couchdbkit.Server)
-        self.mock_db = self.m.CreateMock(couchdbkit.Database)
+
+    def expect_daemon(self):
         parser_daemon.couchdbkit.Server("http://localhost:5984")\
                 .AndReturn(self.mock_server)
         self.mock_server.__getitem__("test").AndReturn(self.mock_db)
-        self.mock_db.info().AndReturn({"update_seq": 191238})
-        parser_daemon.parser.Parser(self.config)
+        self.mock_db.info().AndReturn({"update_seq": self.update_seq})
+        parser_daemon.parser.Parser(self.config).AndReturn(self.mock_parser)
 
+    def make_daemon(self):
+        self.expect_daemon()
         self.m.ReplayAll()
-        self.daemon = parser_daemon.ParserDaemon(self.config)
+        daemon = parser_daemon.ParserDaemon(self.config)
         self.m.VerifyAll()
         self.m.ResetAll()
+        return daemon
 
-    def teardown(self):
-        self.m.UnsetStubs()
+
+class TestParserDaemon(ParserDaemonFixture):
+    update_url = "_design/payload_telemetry/_update/add_parsed_data/id"
 
     def test_init_connects_to_couch(self):
         # This actually tested by setup(), since the parser needs to be
@@ -72,74 +115,609 @@ class TestParserDaemon(object):
         self.m.VerifyAll()
 
     def test_couch_callback(self):
-        result = {'doc': {'hello': 'world'}, 'seq': 1}
+        result = {'doc': {'_id': 'id', 'hello': 'world'}, 'seq': 1}
         parsed = {'hello': 'parser'}
         self.m.StubOutWithMock(self.daemon, 'parser')
         self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
-        self.daemon.parser.parse(result['doc']).AndReturn(parsed)
+        self.daemon.parser.stage_timings = self.m.CreateMockAnything()
+        timer = mox.IsA(stage_timing.StageTimer)
+        self.daemon.parser.parse(result['doc'], timer=timer)\
+                .AndReturn(parsed)
         self.daemon._save_updated_doc(parsed)
+        self.daemon.parser.stage_timings.record(timer)
         self.m.ReplayAll()
         self.daemon._couch_callback(result)
         self.m.VerifyAll()
 
-    def test_saving_saves(self):
-        orig_doc = {"_id": "id", "receivers": [1], 'data': {'a': 1}}
-        parsed_doc = deepcopy(orig_doc)
-        parsed_doc['data']['b'] = 2
-        self.daemon.db.__getitem__('id').AndReturn(orig_doc)
-        self.daemon.db.save_doc(parsed_doc)
+    def expect_parse(self, doc, parsed=True):
+        timer = mox.IsA(stage_timing.StageTimer)
+        if parsed:
+            self.daemon.parser.parse(doc, timer=timer).AndReturn(doc)
+            self.daemon._save_updated_doc(doc)
+        else:
+            self.daemon.parser.parse(doc, timer=timer).AndReturn(None)
+        self.daemon.parser.stage_timings.record(timer)
+
+    def setup_destutter(self):
+        self.m.StubOutWithMock(self.daemon, 'parser')
+        self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
+        self.daemon.parser.stage_timings = self.m.CreateMockAnything()
+
+    def test_destutters_recent_revisions(self):
+        self.setup_destutter()
+        self.m.StubOutWithMock(parser_daemon.metrics, 'increment')
+        self.expect_parse({"_id": "a", "_rev": "1-x"})
+        self.expect_parse({"_id": "b", "_rev": "1-y"})
+        parser_daemon.metrics.increment("parser_daemon.destuttered")
+        parser_daemon.metrics.increment("parser_daemon.destuttered")
+        self.expect_parse({"_id": "a", "_rev": "3-z"})
+        self.m.ReplayAll()
+
+        changes = [("a", "1-x"), ("b", "1-y"), ("a", "1-x"), ("a", "2-w"),
+                   ("a", "3-z")]
+        for seq, (doc_id, rev) in enumerate(changes, 1):
+            self.daemon._couch_callback(
+                    {"seq": seq, "doc": {"_id": doc_id, "_rev": rev}})
+        self.m.VerifyAll()
+        # suppressed changes are still passed
+        eq_(self.daemon.last_seq, 5)
+
+    def test_retries_next_revision_after_failed_parse(self):
+        self.setup_destutter()
+        self.expect_parse({"_id": "a", "_rev": "1-x"}, parsed=False)
+        self.expect_parse({"_id": "a", "_rev": "2-y"})
         self.m.ReplayAll()
-        self.daemon._save_updated_doc(parsed_doc)
+        self.daemon._couch_callback(
+                {"seq": 1, "doc": {"_id": "a", "_rev": "1-x"}})
+        self.daemon._couch_callback(
+                {"seq": 2, "doc": {"_id": "a", "_rev": "2-y"}})
         self.m.VerifyAll()
 
-    def test_saving_merges(self):
-        orig_doc = {"_id": "id", "receivers": [1], 'data': {'a': 1}}
-        parsed_doc = deepcopy(orig_doc)
-        parsed_doc['data']['b'] = 2
-        updated_doc = deepcopy(orig_doc)
-        updated_doc['receivers'].append(2)
-        merged_doc = deepcopy(parsed_doc)
-        merged_doc['receivers'] = deepcopy(updated_doc['receivers'])
-        self.daemon.db.__getitem__('id').AndReturn(updated_doc)
-        self.daemon.db.save_doc(merged_doc)
+    def test_retries_next_revision_after_failed_save(self):
+        self.setup_destutter()
+        timer = mox.IsA(stage_timing.StageTimer)
+        doc = {"_id": "a", "_rev": "1-x"}
+        self.daemon.parser.parse(doc, timer=timer).AndReturn(doc)
+        self.daemon._save_updated_doc(doc).AndRaise(RuntimeError)
+        self.daemon.parser.stage_timings.record(timer)
+        self.expect_parse({"_id": "a", "_rev": "2-y"})
         self.m.ReplayAll()
-        self.daemon._save_updated_doc(parsed_doc)
+        assert_raises(RuntimeError, self.daemon._couch_callback,
+                      {"seq": 1, "doc": dict(doc)})
+        self.daemon._couch_callback(
+                {"seq": 2, "doc": {"_id": "a", "_rev": "2-y"}})
         self.m.VerifyAll()
 
-    def test_saving_merges_after_conflict(self):
-        orig_doc = {"_id": "id", "receivers": [1], 'data': {'a': 1}}
-        parsed_doc = deepcopy(orig_doc)
-        parsed_doc['data']['b'] = 2
-        updated_doc = deepcopy(orig_doc)
-        updated_doc['receivers'].append(2)
-        merged_doc = deepcopy(parsed_doc)
-        merged_doc['receivers'] = deepcopy(updated_doc['receivers'])
-        self.daemon.db.__getitem__('id').AndReturn(orig_doc)
-        self.daemon.db.save_doc(parsed_doc).AndRaise(
-            couchdbkit.exceptions.ResourceConflict())
-        self.daemon.db.__getitem__('id').AndReturn(updated_doc)
-        self.daemon.db.save_doc(merged_doc)
+    def test_destutter_window(self):
+        self.daemon.recent = lru_cache.LRUCache(10, 60)
+        self.setup_destutter()
+        self.m.StubOutWithMock(lru_cache, 'time')
+        lru_cache.time.time().AndReturn(1000)
+        self.expect_parse({"_id": "a"})
+        lru_cache.time.time().AndReturn(1070)
+        lru_cache.time.time().AndReturn(1070)
+        self.expect_parse({"_id": "a"})
         self.m.ReplayAll()
-        self.daemon._save_updated_doc(parsed_doc)
+        self.daemon._couch_callback({"seq": 1, "doc": {"_id": "a"}})
+        self.daemon._couch_callback({"seq": 2, "doc": {"_id": "a"}})
+        self.m.VerifyAll()
+
+    def test_saving_saves_with_update_handler(self):
+        doc = {"_id": "id", "receivers": [1], 'data': {'a': 1, 'b': 2}}
+        self.daemon.db.res = self.m.CreateMockAnything()
+        response = self.m.CreateMockAnything()
+        self.daemon.db.res.put(self.update_url,
+                               payload={"data": {'a': 1, 'b': 2}})\
+                .AndReturn(response)
+        response.skip_body()
+        self.m.ReplayAll()
+        self.daemon._save_updated_doc(doc)
+        self.m.VerifyAll()
+
+    def test_saving_retries_after_conflict(self):
+        doc = {"_id": "id", "receivers": [1], 'data': {'a': 1, 'b': 2}}
+        self.daemon.db.res = self.m.CreateMockAnything()
+        response = self.m.CreateMockAnything()
+        self.daemon.db.res.put(self.update_url, payload={"data": doc["data"]})\
+                .AndRaise(couchdbkit.exceptions.ResourceConflict())
+        self.daemon.db.res.put(self.update_url, payload={"data": doc["data"]})\
+                .AndReturn(response)
+        response.skip_body()
+        self.m.ReplayAll()
+        self.daemon._save_updated_doc(doc)
         self.m.VerifyAll()
 
     def test_saving_quits_after_many_conflicts(self):
-        orig_doc = {"_id": "id", "receivers": [1], 'data': {'a': 1}}
-        parsed_doc = deepcopy(orig_doc)
-        parsed_doc['data']['b'] = 2
+        doc = {"_id": "id", "receivers": [1], 'data': {'a': 1, 'b': 2}}
+        self.daemon.db.res = self.m.CreateMockAnything()
         for i in xrange(30):
-            self.daemon.db.__getitem__('id').AndReturn(orig_doc)
-            self.daemon.db.save_doc(parsed_doc).AndRaise(
-                couchdbkit.exceptions.ResourceConflict())
+            self.daemon.db.res.put(self.update_url,
+                                   payload={"data": doc["data"]})\
+                    .AndRaise(couchdbkit.exceptions.ResourceConflict())
         self.m.ReplayAll()
-        assert_raises(RuntimeError, self.daemon._save_updated_doc, parsed_doc)
+        assert_raises(RuntimeError, self.daemon._save_updated_doc, doc)
         self.m.VerifyAll()
 
     def test_saving_quits_after_unauthorized(self):
         doc = {"_id": "id", "not_valid": True, "data": {}}
-        self.daemon.db.__getitem__('id').AndReturn(doc)
-        self.daemon.db.save_doc(doc).AndRaise(
-            restkit.errors.Unauthorized())
+        self.daemon.db.res = self.m.CreateMockAnything()
+        self.daemon.db.res.put(self.update_url, payload={"data": {}})\
+                .AndRaise(restkit.errors.Unauthorized())
         self.m.ReplayAll()
         self.daemon._save_updated_doc(doc)
         self.m.VerifyAll()
+
+
+class TestParserDaemonWorkers(ParserDaemonFixture):
+    daemon_config = {"workers": 2}
+
+    def expect_daemon(self):
+        self.m.StubOutWithMock(parser_daemon, 'multiprocessing')
+        self.mock_pool = self.m.CreateMockAnything()
+        parser_daemon.multiprocessing.Pool(2, parser_daemon._worker_init,
+                (self.config, )).AndReturn(self.mock_pool)
+        super(TestParserDaemonWorkers, self).expect_daemon()
+
+    def test_callback_dispatches_to_pool(self):
+        doc = {"_id": "a", "hello": "world"}
+        result = self.m.CreateMockAnything()
+        self.mock_pool.apply_async(parser_daemon._worker_parse, (doc, ))\
+                .AndReturn(result)
+        self.m.ReplayAll()
+        self.daemon._couch_callback({"seq": 5, "doc": doc})
+        self.m.VerifyAll()
+
+        assert self.daemon.last_seq == 191238
+        assert self.daemon.pending.get_nowait() == (5, "a", result)
+
+    def test_collects_in_order_and_advances_seq(self):
+        first = self.m.CreateMockAnything()
+        second = self.m.CreateMockAnything()
+        self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
+        first.get().AndReturn({"_id": "a"})
+        self.daemon._save_updated_doc({"_id": "a"})
+        second.get().AndRaise(ValueError("parse failed"))
+        self.m.ReplayAll()
+
+        self.daemon.pending.put((5, "a", first))
+        self.daemon.pending.put((6, "b", second))
+        self.daemon._collect_one()
+        assert self.daemon.last_seq == 5
+        self.daemon._collect_one()
+        assert self.daemon.last_seq == 6
+        self.m.VerifyAll()
+
+    def test_worker_parses_with_own_parser(self):
+        mock_parser = self.m.CreateMockAnything()
+        parser_daemon.parser.Parser(self.config).AndReturn(mock_parser)
+        mock_parser.parse({"_id": "a"}).AndReturn({"_id": "a", "data": {}})
+        self.m.ReplayAll()
+        parser_daemon._worker_init(self.config)
+        assert parser_daemon._worker_parse({"_id": "a"}) == \
+                {"_id": "a", "data": {}}
+        self.m.VerifyAll()
+        parser_daemon._worker_parser = None
+
+
+class TestParserDaemonBulkSave(ParserDaemonFixture):
+    daemon_config = {"bulk_save_size": 3}
+
+    def make_doc(self, doc_id, rev="1-a"):
+        return {"_id": doc_id, "_rev": rev, "receivers": {"A": {}},
+                "data": {"_parsed": True}}
+
+    def test_callback_queues_parsed_doc(self):
+        doc = {"_id": "a"}
+        self.m.StubOutWithMock(self.daemon, 'parser')
+        self.daemon.parser.parse(doc).AndReturn(self.make_doc("a"))
+        self.m.ReplayAll()
+        self.daemon._couch_callback({"seq": 5, "doc": doc})
+        self.m.VerifyAll()
+
+        assert self.daemon.last_seq == 191238
+        assert self.daemon.save_queue.get_nowait() == (5, self.make_doc("a"))
+
+    def test_callback_forgets_docs_that_fail_to_parse(self):
+        self.m.StubOutWithMock(self.daemon, 'parser')
+        self.daemon.parser.parse({"_id": "a", "_rev": "1-a"}).AndReturn(None)
+        self.daemon.parser.parse({"_id": "b", "_rev": "1-b"})\
+                .AndRaise(KeyError)
+        self.daemon.parser.parse({"_id": "a", "_rev": "2-a"})\
+                .AndReturn(self.make_doc("a"))
+        self.m.ReplayAll()
+        self.daemon._couch_callback(
+                {"seq": 5, "doc": {"_id": "a", "_rev": "1-a"}})
+        self.daemon._couch_callback(
+                {"seq": 6, "doc": {"_id": "b", "_rev": "1-b"}})
+        assert "a" not in self.daemon.recent
+        assert "b" not in self.daemon.recent
+        # so the next revision is parsed
+        self.daemon._couch_callback(
+                {"seq": 7, "doc": {"_id": "a", "_rev": "2-a"}})
+        self.m.VerifyAll()
+        eq_([self.daemon.save_queue.get_nowait() for i in xrange(3)],
+            [(5, None), (6, None), (7, self.make_doc("a"))])
+
+    def test_write_batch_saves_up_to_size_and_advances_seq(self):
+        self.m.StubOutWithMock(self.daemon, '_bulk_save')
+        self.daemon._bulk_save([self.make_doc("a"), self.make_doc("c")])
+        self.m.ReplayAll()
+
+        self.daemon.save_queue.put((5, self.make_doc("a")))
+        self.daemon.save_queue.put((6, None))
+        self.daemon.save_queue.put((7, self.make_doc("c")))
+        self.daemon.save_queue.put((8, self.make_doc("d")))
+        self.daemon._write_batch()
+        self.m.VerifyAll()
+
+        assert self.daemon.last_seq == 7
+        assert self.daemon.save_queue.qsize() == 1
+
+    def test_write_batch_times_bulk_saves(self):
+        self.m.StubOutWithMock(self.daemon, '_bulk_save')
+        self.m.StubOutWithMock(self.daemon.parser.stage_timings, 'record')
+        timers = []
+        self.daemon._bulk_save([self.make_doc("a"), self.make_doc("b")])
+        self.daemon.parser.stage_timings.record(
+                mox.IsA(stage_timing.StageTimer))\
+                .WithSideEffects(timers.append)
+        self.m.ReplayAll()
+        self.daemon.save_queue.put((5, self.make_doc("a")))
+        self.daemon.save_queue.put((6, self.make_doc("b")))
+        self.daemon.bulk_save_window = 0
+        self.daemon._write_batch()
+        self.m.VerifyAll()
+        eq_([entry[:3] for entry in timers[0].entries],
+            [("save", None, None)])
+
+    def test_bulk_save_saves(self):
+        docs = [self.make_doc("a"), self.make_doc("b")]
+        self.mock_db.save_docs(docs)
+        self.m.ReplayAll()
+        self.daemon._bulk_save(docs)
+        self.m.VerifyAll()
+
+    def test_bulk_save_resubmits_only_conflicts(self):
+        docs = [self.make_doc("a"), self.make_doc("b"), self.make_doc("c")]
+        results = [{"id": "a", "rev": "2-a"},
+                   {"id": "b", "error": "conflict", "reason": "conflict"},
+                   {"id": "c", "error": "forbidden", "reason": "invalid"}]
+        latest = self.make_doc("b", "2-b")
+        latest["receivers"]["B"] = {}
+        latest["data"] = {}
+        merged = deepcopy(latest)
+        merged["data"]["_parsed"] = True
+
+        self.mock_db.save_docs(docs).AndRaise(
+            couchdbkit.exceptions.BulkSaveError(results[1:], results))
+        self.mock_db.all_docs(keys=["b"], include_docs=True)\
+                .AndReturn([{"id": "b", "key": "b", "doc": latest}])
+        self.mock_db.save_docs([merged])
+        self.m.ReplayAll()
+        self.daemon._bulk_save(docs)
+        self.m.VerifyAll()
+
+    def test_bulk_save_quits_after_many_conflicts(self):
+        doc = self.make_doc("a")
+        results = [{"id": "a", "error": "conflict", "reason": "conflict"}]
+        error = couchdbkit.exceptions.BulkSaveError(results, results)
+        self.daemon.save_attempts = 3
+        self.mock_db.save_docs([doc]).AndRaise(error)
+        for i in xrange(2):
+            self.mock_db.all_docs(keys=["a"], include_docs=True)\
+                    .AndReturn([{"id": "a", "key": "a", "doc": doc}])
+            self.mock_db.save_docs([doc]).AndRaise(error)
+        self.m.ReplayAll()
+        assert_raises(RuntimeError, self.daemon._bulk_save, [doc])
+        self.m.VerifyAll()
+
+
+class TestParserDaemonCheckpoint(ParserDaemonFixture):
+    create_daemon = False
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tempdir, "checkpoint")
+        self.daemon_config = {"checkpoint_file": self.checkpoint,
+                              "catch_up_batch_size": 2}
+        super(TestParserDaemonCheckpoint, self).setup()
+
+    def teardown(self):
+        super(TestParserDaemonCheckpoint, self).teardown()
+        shutil.rmtree(self.tempdir)
+
+    def test_starts_from_update_seq_without_checkpoint(self):
+        daemon = self.make_daemon()
+        assert daemon.last_seq == 191238
+        assert not daemon.catch_up
+
+    def test_ignores_corrupt_checkpoint(self):
+        with open(self.checkpoint, "w") as f:
+            f.write("not json")
+        daemon = self.make_daemon()
+        assert daemon.last_seq == 191238
+        assert not daemon.catch_up
+
+    def test_advance_writes_checkpoint(self):
+        daemon = self.make_daemon()
+        daemon._advance(191240)
+        with open(self.checkpoint) as f:
+            assert f.read() == "191240"
+
+        # not again until checkpoint_interval has passed
+        daemon._advance(191241)
+        with open(self.checkpoint) as f:
+            assert f.read() == "191240"
+        assert daemon.last_seq == 191241
+
+    def test_failed_save_does_not_advance_checkpoint(self):
+        daemon = self.make_daemon()
+        doc = {"_id": "a"}
+        daemon.parser = self.m.CreateMockAnything()
+        daemon.parser.stage_timings = self.m.CreateMockAnything()
+        self.m.StubOutWithMock(daemon, '_save_updated_doc')
+        timer = mox.IsA(stage_timing.StageTimer)
+        daemon.parser.parse(doc, timer=timer).AndReturn({"_id": "a", "x": 1})
+        daemon._save_updated_doc({"_id": "a", "x": 1})\
+                .AndRaise(RuntimeError)
+        daemon.parser.stage_timings.record(timer)
+        self.m.ReplayAll()
+        assert_raises(RuntimeError, daemon._couch_callback,
+                      {"seq": 191240, "doc": doc})
+        self.m.VerifyAll()
+        eq_(daemon.last_seq, 191238)
+        assert not os.path.exists(self.checkpoint)
+
+    def test_catches_up_in_batches_from_checkpoint(self):
+        with open(self.checkpoint, "w") as f:
+            f.write("100")
+        daemon = self.make_daemon()
+        assert daemon.last_seq == 100
+        assert daemon.catch_up
+
+        results = [{"seq": i, "doc": {"_id": str(i)}} for i in (101, 102, 104)]
+        self.m.StubOutWithMock(daemon, '_couch_callback')
+        c = self.m.CreateMock(immortal_changes.Consumer)
+        parser_daemon.immortal_changes.Consumer(daemon.db).AndReturn(c)
+        c.fetch(filter="parser/unparsed", since=100, limit=2,
+                include_docs=True)\
+                .AndReturn({"results": results[:2], "last_seq": 102})
+        daemon._couch_callback(results[0])
+        daemon._couch_callback(results[1])
+        self.mock_db.info().AndReturn({"update_seq": 110})
+        c.fetch(filter="parser/unparsed", since=102, limit=2,
+                include_docs=True)\
+                .AndReturn({"results": results[2:], "last_seq": 105})
+        daemon._couch_callback(results[2])
+        self.mock_db.info().AndReturn({"update_seq": 110})
+        c.wait(daemon._couch_callback, filter="parser/unparsed",
+               since=105, include_docs=True, heartbeat=1000)
+        self.m.ReplayAll()
+        daemon.run()
+        self.m.VerifyAll()
+
+    def test_seq_number(self):
+        assert parser_daemon._seq_number(42) == 42
+        assert parser_daemon._seq_number("42-g1AAAAEzeJzLYWBg") == 42
+
+
+class TestParserDaemonShards(ParserDaemonFixture):
+    daemon_config = {"shard": 1, "shards": 2}
+    update_seq = 10
+
+    def test_run_asks_for_shard(self):
+        c = self.m.CreateMock(immortal_changes.Consumer)
+        parser_daemon.immortal_changes.Consumer(self.daemon.db).AndReturn(c)
+        c.wait(self.daemon._couch_callback, filter="parser/unparsed",
+               shard=1, shards=2, since=10, include_docs=True,
+               heartbeat=1000)
+        self.m.ReplayAll()
+        self.daemon.run()
+        self.m.VerifyAll()
+
+    def test_callback_skips_other_shards(self):
+        self.m.StubOutWithMock(self.daemon, 'parser')
+        self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
+        self.daemon.parser.stage_timings = self.m.CreateMockAnything()
+        self.daemon.parser.parse({"_id": "a"}, timer=mox.IgnoreArg())
+        self.daemon.parser.stage_timings.record(mox.IgnoreArg())
+        self.m.ReplayAll()
+        self.daemon._couch_callback({"doc": {"_id": "d"}, "seq": 11})
+        assert self.daemon.last_seq == 11
+        self.daemon._couch_callback({"doc": {"_id": "a"}, "seq": 12})
+        self.m.VerifyAll()
+
+    def test_rejects_invalid_shard(self):
+        self.m.ReplayAll()
+        config = deepcopy(self.config)
+        config["parserdaemon"]["shard"] = 2
+        assert_raises(ValueError, parser_daemon.ParserDaemon, config)
+
+
+class TestParserDaemonPipeline(ParserDaemonFixture):
+    daemon_config = {"pipeline": True, "queue_size": 2}
+    update_seq = 10
+
+    def test_queues_are_bounded(self):
+        assert not self.daemon.inline
+        assert self.daemon.parse_queue.maxsize == 2
+        assert self.daemon.save_queue.maxsize == 2
+
+    def test_callback_queues_doc_for_parsing(self):
+        self.daemon._couch_callback({"seq": 11, "doc": {"_id": "a"}})
+        # destuttering doesn't advance past documents still queued
+        self.daemon._couch_callback({"seq": 12, "doc": {"_id": "a"}})
+        assert self.daemon.last_seq == 10
+        assert self.daemon.parse_queue.get_nowait() == (11, {"_id": "a"})
+        assert self.daemon.parse_queue.empty()
+
+    def test_parse_stage_parses_and_queues_for_saving(self):
+        self.m.StubOutWithMock(self.daemon, 'parser')
+        self.daemon.parser.parse({"_id": "a"}).AndReturn({"_id": "a", "x": 1})
+        self.daemon.parser.parse({"_id": "b"}).AndRaise(KeyError)
+        self.m.ReplayAll()
+        self.daemon.recent.put("a", 0)
+        self.daemon.recent.put("b", 0)
+        self.daemon.parse_queue.put((11, {"_id": "a"}))
+        self.daemon.parse_queue.put((12, {"_id": "b"}))
+        self.daemon._parse_one()
+        self.daemon._parse_one()
+        self.m.VerifyAll()
+        # b's next revision will be tried again
+        assert "a" in self.daemon.recent
+        assert "b" not in self.daemon.recent
+        assert self.daemon.save_queue.get_nowait() == \
+                (11, {"_id": "a", "x": 1})
+        assert self.daemon.save_queue.get_nowait() == (12, None)
+
+    def test_writer_times_saves_by_config(self):
+        doc = {"_id": "a", "data": {"_parsed": {
+            "payload_configuration": "config"}}}
+        self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
+        self.m.StubOutWithMock(self.daemon.parser.stage_timings, 'record')
+        timers = []
+        self.daemon._save_updated_doc(doc)
+        self.daemon.parser.stage_timings.record(
+                mox.IsA(stage_timing.StageTimer))\
+                .WithSideEffects(timers.append)
+        self.m.ReplayAll()
+        self.daemon.save_queue.put((11, doc))
+        self.daemon._write_batch()
+        self.m.VerifyAll()
+        eq_(timers[0].doc_id, "a")
+        eq_([entry[:3] for entry in timers[0].entries],
+            [("save", None, "config")])
+
+    def test_writer_saves_one_at_a_time(self):
+        self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
+        self.daemon._save_updated_doc({"_id": "a"})
+        self.m.ReplayAll()
+        self.daemon.save_queue.put((11, {"_id": "a"}))
+        self.daemon.save_queue.put((12, None))
+        self.daemon._write_batch()
+        assert self.daemon.last_seq == 11
+        self.daemon._write_batch()
+        assert self.daemon.last_seq == 12
+        self.m.VerifyAll()
+
+    def test_reports_queue_lengths(self):
+        self.m.StubOutWithMock(parser_daemon, 'metrics')
+        parser_daemon.metrics.gauge("parser_daemon.queue.parse", 1)
+        parser_daemon.metrics.gauge("parser_daemon.queue.save", 0)
+        self.m.ReplayAll()
+        self.daemon.parse_queue.put((11, {"_id": "a"}))
+        self.daemon._report_queues()
+        self.m.VerifyAll()
+
+
+class TestParserDaemonPriority(ParserDaemonFixture):
+    daemon_config = {"pipeline": True, "priority": True, "queue_size": 10,
+                     "shed_threshold": 2}
+    update_seq = 10
+
+    def setup(self):
+        super(TestParserDaemonPriority, self).setup()
+        # only the imports were stubbed; sniffing is still needed
+        self.m.UnsetStubs()
+
+    def make_mock_parser(self):
+        mock_parser = super(TestParserDaemonPriority, self).make_mock_parser()
+        mock_parser.config_resolver = self.m.CreateMockAnything()
+        return mock_parser
+
+    def doc(self, doc_id, raw):
+        return {"_id": doc_id, "data": {"_raw": base64.b64encode(raw)}}
+
+    def test_requires_config_resolver(self):
+        self.stub_imports()
+        self.mock_parser.config_resolver = None
+        self.expect_daemon()
+        self.m.ReplayAll()
+        assert_raises(ValueError, parser_daemon.ParserDaemon, self.config)
+        self.m.VerifyAll()
+
+    def test_rejects_options_that_would_be_ignored(self):
+        for options in ({"pipeline": False}, {"workers": 4},
+                        {"priority": False}):
+            self.config["parserdaemon"] = dict(self.daemon_config, **options)
+            assert_raises(ValueError, parser_daemon.ParserDaemon, self.config)
+
+    def test_guess_callsign(self):
+        guess = parser_daemon._guess_callsign
+        eq_(guess(self.doc("a", "$$HABITAT,1,2*ABCD\n")), "HABITAT")
+        eq_(guess({"_id": "a", "data": {"_raw": base64.b64encode("\x01\x02"),
+                                        "_fallbacks": {"payload": "BIN"}}}),
+            "BIN")
+        eq_(guess(self.doc("a", "\x01\x02\x03")), None)
+        eq_(guess({"_id": "a", "data": {}}), None)
+
+    def test_parses_in_priority_order(self):
+        resolver = self.mock_parser.config_resolver
+        resolver.priority("UNKNOWN").AndReturn(2)
+        resolver.priority("STANDALONE").AndReturn(1)
+        resolver.priority("FLIGHT").AndReturn(0)
+        resolver.priority("FLIGHTB").AndReturn(0)
+        self.m.ReplayAll()
+
+        docs = [self.doc("u", "$$UNKNOWN,1*00\n"),
+                self.doc("s", "$$STANDALONE,1*00\n"),
+                self.doc("f", "$$FLIGHT,1*00\n"),
+                self.doc("g", "$$FLIGHTB,1*00\n")]
+        for seq, doc in enumerate(docs, 11):
+            self.daemon._couch_callback({"seq": seq, "doc": doc})
+        self.m.VerifyAll()
+
+        order = [self.daemon.parse_queue.get_nowait()[-2:]
+                 for doc in docs]
+        eq_(order, [(13, docs[2]), (14, docs[3]), (12, docs[1]),
+                    (11, docs[0])])
+
+    def test_last_seq_waits_for_earlier_docs(self):
+        self.m.StubOutWithMock(self.daemon, '_save_updated_doc')
+        self.daemon._save_updated_doc({"_id": "b"})
+        self.daemon._save_updated_doc({"_id": "a"})
+        self.m.ReplayAll()
+
+        self.daemon.seqs.start(11)
+        self.daemon.seqs.start(12)
+        self.daemon.save_queue.put((12, {"_id": "b"}))
+        self.daemon.save_queue.put((11, {"_id": "a"}))
+        self.daemon._write_batch()
+        eq_(self.daemon.last_seq, 10)
+        self.daemon._write_batch()
+        eq_(self.daemon.last_seq, 12)
+        self.m.VerifyAll()
+
+    def test_sheds_unknown_callsigns_when_busy(self):
+        resolver = self.mock_parser.config_resolver
+        resolver.priority("FLIGHT").AndReturn(0)
+        resolver.priority("FLIGHTB").AndReturn(0)
+        resolver.priority("UNKNOWN").AndReturn(2)
+        resolver.priority("STANDALONE").AndReturn(1)
+        self.m.StubOutWithMock(parser_daemon.metrics, 'increment')
+        parser_daemon.metrics.increment("parser_daemon.shed")
+        self.m.ReplayAll()
+
+        docs = [self.doc("f", "$$FLIGHT,1*00\n"),
+                self.doc("g", "$$FLIGHTB,1*00\n"),
+                self.doc("u", "$$UNKNOWN,1*00\n"),
+                self.doc("s", "$$STANDALONE,1*00\n")]
+        for seq, doc in enumerate(docs, 11):
+            self.daemon._couch_callback({"seq": seq, "doc": doc})
+        self.m.VerifyAll()
+
+        eq_(self.daemon.parse_queue.qsize(), 3)
+        # the shed document is finished, but not the ones before it
+        eq_(self.daemon.last_seq, 10)
+        self.daemon._finish([11, 12])
+        eq_(self.daemon.last_seq, 13)
+
+
+def test_seq_tracker():
+    tracker = parser_daemon._SeqTracker()
+    for seq in (1, 2, 3, 4):
+        tracker.start(seq)
+    eq_(tracker.finish([2, 3]), None)
+    eq_(tracker.finish([1]), 3)
+    eq_(tracker.finish([4]), 4)
+    eq_(tracker.finished, set())
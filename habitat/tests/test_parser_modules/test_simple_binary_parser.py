@@ -26,7 +26,7 @@ from copy import deepcopy
 # Mocking the LoadableManager is a heck of a lot of effort. Not worth it.
 from ...loadable_manager import LoadableManager
 from ...parser_modules.simple_binary_parser import SimpleBinaryParser
-from ...parser import CantExtractCallsign
+from ...parser import CantExtractCallsign, SentenceConfig
 
 # Provide the sensor functions to the parser
 fake_sensors_config = {
@@ -132,3 +132,28 @@ class TestSimpleBinaryParser:
         config["fields"][3]["sensor"] = "base.ascii_float"
         output = self.p.parse(data, config)
         assert output["altitude"] == 12.34
+
+    def test_accepts_buffers(self):
+        data = struct.pack("iddI", 5, 52.1234, -0.0123, 1234)
+        for value in (bytearray(data), memoryview(data)):
+            assert self.p.parse(value, base_config)["altitude"] == 1234
+
+    def test_error_on_too_much_data(self):
+        data = struct.pack("iddII", 5, 1.0, 1.0, 1, 1)
+        assert_raises(ValueError, self.p.parse, data, base_config)
+
+    def test_caches_plans_by_sentence_key(self):
+        data = struct.pack("iddI", 5, 52.1234, -0.0123, 1234)
+        config = SentenceConfig(base_config, ("id", "1-abc", 0))
+        self.p.parse(data, config)
+        plan = self.p.plans.get(("id", "1-abc", 0))
+        assert plan.struct.format == "iddI"
+
+        # the cached plan is used, not the (modified) config
+        config["fields"] = []
+        assert self.p.parse(data, config)["altitude"] == 1234
+
+    def test_doesnt_cache_plans_without_key(self):
+        data = struct.pack("iddI", 5, 52.1234, -0.0123, 1234)
+        self.p.parse(data, base_config)
+        assert len(self.p.plans) == 0
@@ -24,7 +24,7 @@ from copy import deepcopy
 
 # Mocking the LoadableManager is a heck of a lot of effort. Not worth it.
 from ...loadable_manager import LoadableManager
-from ...parser import CantParse
+from ...parser import CantParse, SentenceConfig
 from ...parser_modules.ukhas_parser import UKHASParser
 
 # Provide the sensor functions to the parser
@@ -421,3 +421,79 @@ class TestUKHASParser:
         bad_sentence = "$$habitat,123,12:45:06,-35.1032,138.8568,4285*5260"
 
         assert_raises(ValueError, self.p.parse, bad_sentence, base_config)
+
+    def test_parse_with_cached_plan_matches_uncached(self):
+        sentences = [
+            "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*5681\n",
+            "$$habitat,123,12:45:06, -35.1032,138.8568,4285,3.6,hab*96A2\n",
+            "$$habitat,123,12:45:06,035.1032,0138.8568,4285,3.6,hab*D856\n"]
+        config = SentenceConfig(base_config, ("config", "1-abc", 0))
+        for sentence in sentences * 2:
+            assert self.p.parse(sentence, config) == \
+                    UKHASParser(FakeParser()).parse(sentence, base_config)
+        assert len(self.p.plans) == 1
+
+        # the cached plan still rejects what the config would reject
+        bad = "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*0000\n"
+        assert_raises(ValueError, self.p.parse, bad, config)
+        short = "$$habitat,123,12:45:06,-35.1032,138.8568,4285*5260\n"
+        assert_raises(ValueError, self.p.parse, short, config)
+
+    def test_parse_uses_new_revision_of_config(self):
+        sentence = \
+            "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*5681\n"
+        old = SentenceConfig(base_config, ("config", "1-abc", 0))
+        old_output = self.p.parse(sentence, old)
+        assert old_output["latitude"] == -35.1032
+
+        config_minutes = deepcopy(base_config)
+        config_minutes["fields"][2]["format"] = "ddmm.mm"
+        config_minutes["fields"][3]["format"] = "ddmm.mm"
+        new = SentenceConfig(config_minutes, ("config", "2-def", 0))
+        new_output = self.p.parse(sentence, new)
+        assert new_output != old_output
+        assert new_output == \
+                UKHASParser(FakeParser()).parse(sentence, config_minutes)
+        assert self.p.parse(sentence, old) == old_output
+
+    def test_parse_doesnt_cache_plans_without_key(self):
+        sentence = \
+            "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*5681\n"
+        self.p.parse(sentence, base_config)
+        self.p.parse(sentence, SentenceConfig(base_config))
+        assert len(self.p.plans) == 0
+
+    def test_parse_rejects_unknown_sensors(self):
+        sentence = \
+            "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*5681\n"
+        config = deepcopy(base_config)
+        config["fields"][6]["sensor"] = "base.not_a_sensor"
+        config = SentenceConfig(config, ("config", "1-abc", 0))
+        assert_raises(ValueError, self.p.parse, sentence, config)
+        assert len(self.p.plans) == 0
+
+    def test_tokenize(self):
+        tokens = self.p._tokenize("$$habitat,1,2*abcd\n")
+        assert tokens == ("habitat,1,2", "abcd", ["habitat", "1", "2"])
+        tokens = self.p._tokenize("$$habitat,1,2\n")
+        assert tokens == ("habitat,1,2", None, ["habitat", "1", "2"])
+
+    def test_parse_after_pre_parse_matches_fresh_parse(self):
+        sentence = \
+            "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*5681\n"
+        expected = UKHASParser(FakeParser()).parse(sentence, base_config)
+        assert self.p.pre_parse(sentence) == "habitat"
+        assert self.p.parse(sentence, base_config) == expected
+
+    def test_parse_after_pre_parse_of_another_string(self):
+        # e.g., an intermediate filter changed the string after pre_parse
+        sentence = \
+            "$$habitat,123,12:45:06,-35.1032,138.8568,4285,3.6,hab*5681\n"
+        filtered = \
+            "$$habitat,123,12:45:06,035.1032,0138.8568,4285,3.6,hab*D856\n"
+        assert self.p.pre_parse(sentence) == "habitat"
+        assert self.p.parse(filtered, base_config)["latitude"] == 35.1032
+
+        assert self.p.pre_parse(filtered) == "habitat"
+        bad = sentence[:-5] + "0000\n"
+        assert_raises(ValueError, self.p.parse, bad, base_config)
@@ -33,3 +33,26 @@ class TestChecksums:
 
     def test_calculates_fletcher_16_checksum_modulus_256(self):
         assert checksums.fletcher_16(self.data, 256) == "8848"
+
+    def test_calculates_fletcher_16_256_checksum(self):
+        assert checksums.fletcher_16_256(self.data) == "8848"
+
+    def test_accepts_buffers(self):
+        for data in (bytearray(self.data), memoryview(self.data),
+                     buffer(self.data)):
+            assert checksums.crc16_ccitt(data) == "D4C0"
+            assert checksums.xor(data) == "0C"
+            assert checksums.fletcher_16(data) == "8C65"
+
+    def test_zero_fills(self):
+        assert checksums.xor("aa") == "00"
+        assert checksums.xor("") == "00"
+
+    def test_checksum_by_name(self):
+        assert checksums.checksum("crc16-ccitt", self.data) == "D4C0"
+        assert checksums.checksum("fletcher-16-256", self.data) == "8848"
+        assert checksums.checksum("none", self.data) == ""
+
+    def test_checksum_many(self):
+        assert checksums.checksum_many("xor", [self.data, "aa", "a"]) == \
+                ["0C", "00", "61"]
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with habitat.  If not, see <http://www.gnu.org/licenses/>.
 
-from ...utils import filtertools
+from ...utils import filtertools, checksums
 
 
 class TestUKHASChecksumFixer:
@@ -32,6 +32,11 @@ class TestUKHASChecksumFixer:
         self.check_fixer("xor", "$$habitat,good*4c\n",
             "$$habitat,other*4c\n", "$$habitat,other*2B\n")
 
+    def test_updates_fletcher_16_256_checksum(self):
+        self.check_fixer("fletcher-16-256", "$$habitat,good*B296\n",
+            "$$habitat,other*B296\n", "$$habitat,other*{0}\n".format(
+                checksums.fletcher_16_256("habitat,other")))
+
     def test_leaves_when_protocol_is_none(self):
         self.check_fixer("none", "$$habitat,boring\n",
             "$$habitat,sucky\n", "$$habitat,sucky\n")
@@ -0,0 +1,78 @@
+# Copyright 2013 (C) Daniel Richman
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for habitat.utils.lru_cache
+"""
+
+import mox
+
+from nose.tools import assert_raises, eq_
+
+from ...utils import lru_cache
+
+
+class TestLRUCache(object):
+    def setup(self):
+        self.m = mox.Mox()
+        self.m.StubOutWithMock(lru_cache, 'time')
+
+    def teardown(self):
+        self.m.UnsetStubs()
+
+    def test_stores_and_retrieves(self):
+        cache = lru_cache.LRUCache(10)
+        cache.put("a", 1)
+        eq_(cache.get("a"), 1)
+        assert "a" in cache
+        assert "b" not in cache
+        eq_(cache.get("b", "default"), "default")
+        eq_(len(cache), 1)
+
+    def test_discards_least_recently_used(self):
+        cache = lru_cache.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
+        eq_(len(cache), 2)
+
+    def test_expires_items(self):
+        cache = lru_cache.LRUCache(2, ttl=10)
+        lru_cache.time.time().AndReturn(100)
+        lru_cache.time.time().AndReturn(109)
+        lru_cache.time.time().AndReturn(110)
+        self.m.ReplayAll()
+        cache.put("a", 1)
+        eq_(cache.get("a"), 1)
+        assert cache.get("a") is None
+        self.m.VerifyAll()
+
+    def test_pop_and_clear(self):
+        cache = lru_cache.LRUCache(5)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        eq_(cache.pop("a"), 1)
+        assert cache.pop("a") is None
+        cache.clear()
+        eq_(len(cache), 0)
+
+    def test_requires_positive_size(self):
+        assert_raises(ValueError, lru_cache.LRUCache, 0)
@@ -0,0 +1,207 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the in-memory CouchDB stand-in
+"""
+
+import json
+import couchdbkit
+import couchdbkit.exceptions
+import restkit.errors
+
+from nose.tools import eq_, assert_raises
+
+from ...utils import memory_couch, checksums
+from ... import uploader, parser_daemon
+
+
+def make_config(doc_id, callsign, time_created):
+    return {"_id": doc_id, "type": "payload_configuration",
+            "name": doc_id, "time_created": time_created,
+            "sentences": [{
+                "protocol": "UKHAS", "callsign": callsign,
+                "checksum": "crc16-ccitt",
+                "fields": [{"name": "sentence_id",
+                            "sensor": "base.ascii_int"},
+                           {"name": "altitude", "sensor": "base.ascii_int"}]
+            }]}
+
+
+class TestMemoryCouch(object):
+    def setup(self):
+        memory_couch.reset()
+        self.db = memory_couch.Server("http://memory")["habitat"]
+        self.raw = memory_couch.Server("http://raw", validate=False)["raw"]
+
+    def teardown(self):
+        memory_couch.reset()
+        memory_couch.uninstall()
+
+    def test_databases_are_shared(self):
+        assert memory_couch.Server("http://memory/")["habitat"] is self.db
+        assert memory_couch.Server("http://other")["habitat"] is not self.db
+
+    def test_install(self):
+        memory_couch.install()
+        assert couchdbkit.Server is memory_couch.Server
+        memory_couch.uninstall()
+        assert couchdbkit.Server is not memory_couch.Server
+
+    def test_save_get_and_conflicts(self):
+        doc = {"_id": "a", "type": "other"}
+        self.raw.save_doc(doc)
+        assert doc["_rev"].startswith("1-")
+        eq_(self.raw["a"], doc)
+        eq_(self.raw.info()["update_seq"], 1)
+
+        stale = dict(doc, _rev=None)
+        assert_raises(couchdbkit.exceptions.ResourceConflict,
+                      self.raw.save_doc, stale)
+        assert_raises(couchdbkit.exceptions.ResourceNotFound,
+                      self.raw.get, "b")
+
+        new = {"type": "other"}
+        self.raw.save_doc(new)
+        assert new["_id"] in self.raw
+
+    def test_validation(self):
+        assert_raises(restkit.errors.Unauthorized, self.db.save_doc,
+                      {"type": "payload_configuration", "not": "valid"})
+
+    def test_bulk_save(self):
+        self.raw.save_doc({"_id": "a", "type": "other"})
+        docs = [{"_id": "a", "type": "other"}, {"_id": "b", "type": "other"}]
+        try:
+            self.raw.save_docs(docs)
+        except couchdbkit.exceptions.BulkSaveError as e:
+            eq_([r.get("error") for r in e.results], ["conflict", None])
+        else:
+            raise AssertionError("expected BulkSaveError")
+        assert docs[1]["_rev"].startswith("1-")
+
+        rows = self.raw.all_docs(keys=["b", "c"], include_docs=True)
+        eq_(rows[0]["doc"], docs[1])
+        eq_(rows[1], {"key": "c", "error": "not_found"})
+
+    def test_views(self):
+        self.db.save_doc(make_config("c1", "habitat", "2013-01-01T00:00:00Z"))
+        self.db.save_doc(make_config("c2", "habitat", "2013-01-02T00:00:00Z"))
+        self.db.save_doc(make_config("c3", "other", "2013-01-03T00:00:00Z"))
+        view = "payload_configuration/callsign_time_created_index"
+
+        row = self.db.view(view, startkey=["habitat", "inf"],
+                           include_docs=True, limit=1,
+                           descending=True).first()
+        eq_(row["id"], "c2")
+        eq_(row["doc"]["_id"], "c2")
+
+        rows = self.db.view(view, startkey=["habitat"], endkey=["habitat", {}])
+        eq_([r["id"] for r in rows], ["c1", "c2"])
+        rows = self.db.view(view, descending=True, skip=1)
+        eq_([r["id"] for r in rows], ["c2", "c1"])
+
+        self.db.delete_doc("c2")
+        rows = self.db.view("payload_configuration/name_time_created")
+        eq_([r["id"] for r in rows], ["c1", "c3"])
+
+    def test_linked_documents(self):
+        self.db.save_doc(make_config("c1", "habitat", "2013-01-01T00:00:00Z"))
+        self.db.save_doc({"_id": "f1", "type": "flight", "approved": True,
+                          "start": "2013-01-01T00:00:00Z",
+                          "end": "2013-01-02T00:00:00Z", "name": "f",
+                          "launch": {"time": "2013-01-01T12:00:00Z",
+                                     "timezone": "Europe/London",
+                                     "location": {"latitude": 52,
+                                                  "longitude": 0}},
+                          "payloads": ["c1", "missing"]})
+        rows = self.db.view("flight/end_start_including_payloads",
+                            include_docs=True)
+        eq_([(r["key"][3], r["doc"] and r["doc"]["_id"]) for r in rows],
+            [(0, "f1"), (1, "c1"), (1, None)])
+
+    def test_collation(self):
+        values = [{}, ["a"], [], "b", "a", 2, 1.5, True, False, None]
+        ordered = sorted(values, key=memory_couch.collation_key)
+        eq_(ordered, [None, False, True, 1.5, 2, "a", "b", [], ["a"], {}])
+
+    def test_changes_and_filters(self):
+        self.raw.save_doc({"_id": "x", "type": "other"})
+        self.raw.save_doc(make_config("c1", "habitat", "2013-01-01T00:00:00Z"))
+        self.raw.save_doc({"_id": "y", "type": "other"})
+        self.raw.delete_doc("x")
+
+        changes = self.raw.res.get("_changes", since=0).json_body
+        eq_([c["id"] for c in changes["results"]], ["c1", "y", "x"])
+        eq_(changes["last_seq"], 4)
+        assert changes["results"][2]["deleted"]
+
+        changes = self.raw.res.get("_changes", since=0, limit=1,
+                                  filter="parser/configs",
+                                  include_docs=True).json_body
+        eq_([c["doc"]["_id"] for c in changes["results"]], ["c1"])
+        eq_(changes["last_seq"], 2)
+
+    def test_continuous_changes(self):
+        stream = self.raw.res.get("_changes", feed="continuous", since=0,
+                                 heartbeat=1).body_stream()
+        with stream as body:
+            eq_(body.readline(), "\n")
+            self.raw.save_doc({"_id": "x", "type": "other"})
+            eq_(json.loads(body.readline())["id"], "x")
+
+    def test_update_handlers(self):
+        up = uploader.Uploader("M0RND", couch_uri="http://memory")
+        up._db = self.db
+        doc_id = up.payload_telemetry("$$hello\n")
+        doc = self.db[doc_id]
+        eq_(doc["receivers"].keys(), ["M0RND"])
+
+        url = "_design/payload_telemetry/_update/add_parsed_data/" + doc_id
+        self.db.res.put(url, payload={"data": {"a": 1}}).skip_body()
+        eq_(self.db[doc_id]["data"]["a"], 1)
+
+        assert_raises(restkit.errors.Unauthorized, self.db.res.put,
+                      url, payload={"data": {"_raw": "AAAA"}})
+
+    def test_upload_parse_save_loop(self):
+        memory_couch.install()
+        self.db.save_doc(make_config("c1", "HABITAT", "2013-01-01T00:00:00Z"))
+
+        config = {"couch_uri": "http://memory", "couch_db": "habitat",
+                  "parser": {"certs_dir": "habitat/tests/test_parser/certs",
+                             "modules": [{"name": "UKHAS",
+                                "class": "habitat.parser_modules."
+                                         "ukhas_parser.UKHASParser"}]},
+                  "loadables": [{"name": "sensors.base",
+                                 "class": "habitat.sensors.base"}]}
+        daemon = parser_daemon.ParserDaemon(config)
+
+        up = uploader.Uploader("M0RND", couch_uri="http://memory")
+        body = "HABITAT,1,1234"
+        doc_id = up.payload_telemetry(
+            "$${0}*{1}\n".format(body, checksums.crc16_ccitt(body)))
+
+        changes = self.db.res.get("_changes", filter="parser/unparsed",
+                                  since=daemon.last_seq,
+                                  include_docs=True).json_body
+        eq_(len(changes["results"]), 1)
+        daemon._couch_callback(changes["results"][0])
+
+        data = self.db[doc_id]["data"]
+        eq_(data["altitude"], 1234)
+        eq_(data["_parsed"]["payload_configuration"], "c1")
@@ -0,0 +1,125 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for in-memory metric aggregation
+"""
+
+import mox
+import threading
+
+from nose.tools import eq_
+
+from ...utils import metrics
+
+
+class TestHistogram(object):
+    def test_percentiles(self):
+        histogram = metrics.Histogram()
+        eq_(histogram.percentile(50), 0.0)
+        for i in xrange(99):
+            histogram.add(0.00005)
+        histogram.add(0.3)
+        eq_(histogram.n, 100)
+        eq_(histogram.percentile(50), 0.0001)
+        eq_(histogram.percentile(99), 0.0001)
+        eq_(histogram.percentile(100), 0.3)
+        eq_(histogram.max, 0.3)
+
+    def test_overflow(self):
+        histogram = metrics.Histogram()
+        histogram.add(100000)
+        eq_(histogram.percentile(50), 100000)
+
+
+class TestMetrics(object):
+    def setup(self):
+        self.m = mox.Mox()
+        self.metrics = metrics.Metrics(60)
+        self.m.StubOutWithMock(self.metrics, "_send")
+
+    def teardown(self):
+        self.m.UnsetStubs()
+
+    def test_aggregates_counters(self):
+        self.metrics._send("habitat.parser.parsed:3|c")
+        self.m.ReplayAll()
+        self.metrics.increment("parser.parsed")
+        self.metrics.increment("parser.parsed", 2)
+        self.metrics.flush()
+        self.m.VerifyAll()
+        eq_(self.metrics.counters, {})
+
+    def test_sends_last_gauge_value(self):
+        self.metrics._send("habitat.queue:2|g")
+        self.m.ReplayAll()
+        self.metrics.gauge("queue", 5)
+        self.metrics.gauge("queue", 2)
+        self.metrics.flush()
+        self.m.VerifyAll()
+
+    def test_aggregates_timers(self):
+        self.metrics._send("\n".join([
+            "habitat.parser.time.count:2|c",
+            "habitat.parser.time.p50:0.1|ms",
+            "habitat.parser.time.p99:0.2|ms",
+            "habitat.parser.time.max:0.2|ms",
+            "habitat.parser.time.total:0.15|ms|@0.5"]))
+        self.m.ReplayAll()
+        self.metrics.timing("parser.time", 0.0001)
+        self.metrics.timing("parser.time", 0.0002)
+        self.metrics.flush()
+        self.m.VerifyAll()
+
+    def test_flushes_when_due(self):
+        self.metrics._next_flush = 0
+        self.metrics._send("habitat.a:1|c")
+        self.m.ReplayAll()
+        self.metrics.increment("a")
+        self.m.VerifyAll()
+        assert self.metrics._next_flush > 0
+
+    def test_background_flush(self):
+        sent = threading.Event()
+        self.metrics.interval = 0.01
+        self.metrics._send("habitat.a:1|c")\
+                .WithSideEffects(lambda packet: sent.set())
+        self.m.ReplayAll()
+        self.metrics.increment("a")
+        self.metrics._next_flush = 0
+        self.metrics.start()
+        sent.wait(5)
+        self.metrics.interval = 60
+        self.m.VerifyAll()
+
+    def test_splits_packets(self):
+        self.metrics.max_packet = 45
+        lines = ["habitat.counter{0}:1|c".format(i) for i in xrange(3)]
+        eq_(list(self.metrics._packets(lines)),
+            [lines[0] + "\n" + lines[1], lines[2]])
+
+    def test_timed(self):
+        @self.metrics.timed("f")
+        def f(x):
+            return x * 2
+        eq_(f(2), 4)
+        eq_(self.metrics.timers["f"].n, 1)
+
+    def test_nothing_to_send(self):
+        self.m.ReplayAll()
+        self.metrics.flush()
+        self.m.VerifyAll()
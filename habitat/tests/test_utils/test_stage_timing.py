@@ -0,0 +1,95 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for per-stage timing
+"""
+
+import mox
+
+from nose.tools import eq_
+
+from ...utils import stage_timing
+
+
+class TestStageTimer(object):
+    def test_stages(self):
+        timer = stage_timing.StageTimer("doc")
+        with timer.stage("pre_parse", "UKHAS"):
+            pass
+        try:
+            with timer.stage("parse", "UKHAS"):
+                raise ValueError
+        except ValueError:
+            pass
+        timer.add("save", None, 0.25)
+
+        eq_([(n, m) for n, m, c, s in timer.entries],
+            [("pre_parse", "UKHAS"), ("parse", "UKHAS"), ("save", None)])
+        assert timer.describe().endswith("save 250.0ms")
+        assert "pre_parse (UKHAS)" in timer.describe()
+
+
+class TestStageTimings(object):
+    def setup(self):
+        self.m = mox.Mox()
+        self.m.StubOutWithMock(stage_timing, "metrics")
+        self.m.StubOutWithMock(stage_timing, "logger")
+        self.timings = stage_timing.StageTimings("parser.stages", 1.0)
+
+    def teardown(self):
+        self.m.UnsetStubs()
+
+    def make_timer(self, seconds):
+        timer = stage_timing.StageTimer("doc")
+        timer.config_id = "config.1"
+        timer.add("parse", "UKHAS", seconds)
+        timer.add("save", None, seconds)
+        return timer
+
+    def test_records_timings(self):
+        stage_timing.metrics.timing("parser.stages.parse.UKHAS.config_1",
+                                    0.01)
+        stage_timing.metrics.timing("parser.stages.save.none.config_1",
+                                    0.01)
+        self.m.ReplayAll()
+        self.timings.record(self.make_timer(0.01))
+        self.m.VerifyAll()
+
+    def test_tags_stages_with_config_in_use(self):
+        timer = stage_timing.StageTimer("doc")
+        timer.config_id = "config.1"
+        timer.add("parse", "UKHAS", 0.01)
+        timer.config_id = "config.2"
+        timer.add("parse", "UKHAS", 0.02)
+        stage_timing.metrics.timing("parser.stages.parse.UKHAS.config_1",
+                                    0.01)
+        stage_timing.metrics.timing("parser.stages.parse.UKHAS.config_2",
+                                    0.02)
+        self.m.ReplayAll()
+        self.timings.record(timer)
+        self.m.VerifyAll()
+
+    def test_logs_slow_messages(self):
+        timer = self.make_timer(0.01)
+        timer.start -= 2
+        stage_timing.metrics.timing(mox.IsA(str), 0.01).MultipleTimes()
+        stage_timing.logger.warning(mox.And(mox.StrContains("Slow message"),
+                                            mox.StrContains("parse (UKHAS)")))
+        self.m.ReplayAll()
+        self.timings.record(timer)
+        self.m.VerifyAll()
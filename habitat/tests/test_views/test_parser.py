@@ -51,3 +51,26 @@ def test_unparsed_filter():
 def test_issue_241():
     # this should not produce an exception
     parser.unparsed_filter({"_deleted": True}, {})
+
+def test_configs_filter():
+    fil = parser.configs_filter
+
+    assert fil({"type": "flight"}, {})
+    assert fil({"type": "payload_configuration"}, {})
+    assert fil({"_id": "x", "_deleted": True}, {})
+    assert not fil(doc, {})
+    assert not fil({}, {})
+
+def test_unparsed_filter_shards():
+    fil = parser.unparsed_filter
+    ok = deepcopy(doc)
+    del ok['data']['_parsed']
+
+    ids = ["doc{0}".format(i) for i in xrange(20)]
+    shards = [[i for i in ids if fil(dict(ok, _id=i),
+                                    {"query": {"shard": str(n),
+                                               "shards": "3"}})]
+              for n in xrange(3)]
+    assert sorted(sum(shards, [])) == sorted(ids)
+    assert all(shards)
+    assert parser.shard_of(u"doc1", 3) == parser.shard_of("doc1", 3)
@@ -305,6 +305,41 @@ class TestPayloadTelemetry(object):
         assert_raises(ForbiddenError, f, None, {"body":
             '{"data": {"_raw": "a"}, "receivers": {"a": {}, "b": {}}}'})
 
+    def test_add_parsed_data_update(self):
+        olddoc = deepcopy(doc)
+        olddoc["_rev"] = "2-abc"
+        olddoc["receivers"]["OTHER"] = \
+                deepcopy(olddoc["receivers"]["M0RND"])
+        req = {"body": json.dumps({"data": {
+            "_raw": "ABCDEF==", "_parsed": {"payload": "habitat"},
+            "payload": "habitat", "altitude": 120}})}
+        result, status = payload_telemetry.add_parsed_data_update(
+                deepcopy(olddoc), req)
+
+        assert status == "OK"
+        assert result["receivers"] == olddoc["receivers"]
+        assert result["data"] == {
+            "_raw": "ABCDEF==", "_parsed": {"payload": "habitat"},
+            "payload": "habitat", "altitude": 120}
+        payload_telemetry.validate(result, olddoc, {'roles': ['parser']}, {})
+
+    def test_add_parsed_data_update_sanity_checks(self):
+        f = payload_telemetry.add_parsed_data_update
+
+        # no such doc
+        assert_raises(ForbiddenError, f, None, {"body": '{"data": {}}'})
+
+        # not JSON
+        assert_raises(ForbiddenError, f, deepcopy(doc), {"body": 'data'})
+
+        # no data
+        assert_raises(ForbiddenError, f, deepcopy(doc),
+                      {"body": '{"not data": {}}'})
+
+        # different _raw
+        assert_raises(ForbiddenError, f, deepcopy(doc),
+                      {"body": '{"data": {"_raw": "AAAA"}}'})
+
     def test_http_post_update(self):
         formdata = {"data": "$$HELLO", "oob": "blargh"}
         req = {"form": formdata, "query": {}}
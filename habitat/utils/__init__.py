@@ -26,7 +26,10 @@ Various utilities for general use by ``habitat``.
     habitat.utils.filtertools
     habitat.utils.startup
     habitat.utils.immortal_changes
+    habitat.utils.lru_cache
+    habitat.utils.metrics
     habitat.utils.quick_traceback
+    habitat.utils.stage_timing
 """
 
 from . import checksums
@@ -34,4 +37,7 @@ from . import dynamicloader
 from . import filtertools
 from . import startup
 from . import immortal_changes
+from . import lru_cache
+from . import metrics
 from . import quick_traceback
+from . import stage_timing
@@ -15,11 +15,52 @@
 # You should have received a copy of the GNU General Public License
 # along with habitat.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Various checksum calculation utilities."""
+"""
+Various checksum calculation utilities.
+
+Each function accepts a ``str``, ``bytearray``, ``buffer`` or ``memoryview``.
+The CRC table is built once, on import (by :mod:`crcmod`, which uses its C
+extension if available), and the other checksums are computed in a single
+loop over the bytes. Other than a ``bytearray``, the input is copied once
+first: for the loops, since iterating over the others gives characters rather
+than integers, and for :mod:`crcmod` if it is a ``memoryview``. At sentence
+lengths the copy costs less than avoiding it.
+
+:func:`checksum` and :func:`checksum_many` select the algorithm by the name
+used in payload_configuration documents (see :data:`algorithms`).
+
+``bin/checksum_benchmark`` times each algorithm.
+"""
 
 import crcmod
+import crcmod.predefined
 from operator import xor as op_xor
 
+__all__ = ["crc16_ccitt", "xor", "fletcher_16", "fletcher_16_256",
+           "algorithms", "checksum", "checksum_many"]
+
+
+_crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
+
+
+def _bytes(data):
+    """*data* as something that iterates over integers (a copy, unless
+    *data* is a ``bytearray``)."""
+    if isinstance(data, bytearray):
+        return data
+    return bytearray(data)
+
+
+def _readable(data):
+    """*data* as something :mod:`crcmod` can read (a copy, if *data* is a
+    ``memoryview``)."""
+    if isinstance(data, bytearray):
+        return buffer(data)
+    elif isinstance(data, memoryview):
+        # crcmod only accepts the old buffer interface
+        return data.tobytes()
+    return data
+
 
 def crc16_ccitt(data):
     """
@@ -33,8 +74,7 @@ def crc16_ccitt(data):
     >>> crc16_ccitt("hello,world")
     'E408'
     """
-    crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
-    return hex(crc16(data))[2:].upper().zfill(4)
+    return "%04X" % _crc16(_readable(data))
 
 
 def xor(data):
@@ -47,8 +87,7 @@ def xor(data):
     >>> xor("hello,world")
     '2C'
     """
-    numbers = map(ord, data)
-    return hex(reduce(op_xor, numbers))[2:].upper().zfill(2)
+    return "%02X" % reduce(op_xor, _bytes(data), 0)
 
 
 def fletcher_16(data, modulus=255):
@@ -63,11 +102,59 @@ def fletcher_16(data, modulus=255):
     >>> fletcher_16("hello,world", 256)
     '6848'
     """
-    numbers = map(ord, data)
     a = b = 0
-    for number in numbers:
+    for number in _bytes(data):
         a += number
         b += a
     a %= modulus
     b %= modulus
-    return hex((a << 8) | b)[2:].upper().zfill(4)
+    return "%04X" % ((a << 8) | b)
+
+
+def fletcher_16_256(data):
+    """
+    Calculate the Fletcher-16 checksum of *data* with modulus 256.
+
+    >>> fletcher_16_256("hello,world")
+    '6848'
+    """
+    return fletcher_16(data, 256)
+
+
+def _none(data):
+    return ""
+
+
+#: Checksum functions by the names used in payload_configuration documents.
+algorithms = {
+    "crc16-ccitt": crc16_ccitt,
+    "xor": xor,
+    "fletcher-16": fletcher_16,
+    "fletcher-16-256": fletcher_16_256,
+    "none": _none
+}
+
+
+def checksum(algorithm, data):
+    """
+    Calculate the checksum of *data* using *algorithm* (a key of
+    :data:`algorithms`); ``none`` gives an empty string.
+
+    Raises :exc:`KeyError` if *algorithm* is unknown.
+
+    >>> checksum("xor", "hello,world")
+    '2C'
+    """
+    return algorithms[algorithm](data)
+
+
+def checksum_many(algorithm, sentences):
+    """
+    Calculate the checksum of each of *sentences* using *algorithm*,
+    returning a list.
+
+    >>> checksum_many("crc16-ccitt", ["hello,world", "hello"])
+    ['E408', 'D26E']
+    """
+    func = algorithms[algorithm]
+    return [func(sentence) for sentence in sentences]
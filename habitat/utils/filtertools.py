@@ -84,14 +84,8 @@ class UKHASChecksumFixer(object):
 
     @classmethod
     def _sum(cls, protocol, data):
-        if protocol == "crc16-ccitt":
-            return checksums.crc16_ccitt(data)
-        elif protocol == "xor":
-            return checksums.xor(data)
-        elif protocol == "fletcher-16":
-            return checksums.fletcher_16(data)
-        elif protocol == "fletcher-16-256":
-            return checksums.fletcher_16_256(data)
+        if protocol in checksums.algorithms:
+            return checksums.checksum(protocol, data)
         else:
             return ""
 
@@ -0,0 +1,112 @@
+# Copyright 2013 (C) Daniel Richman
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A small, thread safe, bounded cache.
+
+:class:`LRUCache` holds at most *max_size* items, discarding the least
+recently used when full. If *ttl* is given, items also expire that many
+seconds after they were stored::
+
+    >>> cache = LRUCache(2)
+    >>> cache.put("a", 1)
+    >>> cache.put("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.put("c", 3)
+    >>> "b" in cache
+    False
+"""
+
+import time
+import threading
+import collections
+
+__all__ = ["LRUCache"]
+
+_missing = object()
+
+
+class LRUCache(object):
+    """A bounded mapping that forgets the least recently used items."""
+
+    def __init__(self, max_size, ttl=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for *key*, or *default* if it is not present
+        or has expired.
+        """
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= time.time():
+                return default
+
+            self._items[key] = (value, expires)
+            return value
+
+    def put(self, key, value):
+        """Store *value* for *key*, discarding old items if full."""
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        else:
+            expires = None
+
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove *key*, returning its value or *default*."""
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+
+        if expires is not None and expires <= time.time():
+            return default
+        return value
+
+    def clear(self):
+        """Remove all items."""
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._items)
+
+    _repr_format = "<habitat.utils.lru_cache.LRUCache: {n}/{m} items>"
+
+    def __repr__(self):
+        return self._repr_format.format(n=len(self._items), m=self.max_size)
@@ -0,0 +1,628 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-memory stand-in for the parts of CouchDB that habitat uses.
+
+:class:`Server` and :class:`Database` implement the subset of the
+:mod:`couchdbkit` interface used by the parser, parser daemon and uploader:
+
+* ``info()``, ``db[id]`` / ``get``, ``save_doc``, ``save_docs``,
+  ``delete_doc``, ``all_docs`` and ``view``, with ``startkey``,
+  ``endkey``, ``key``, ``keys``, ``limit``, ``skip``, ``descending`` and
+  ``include_docs`` (including linked documents)
+* ``db.res.put`` and ``db.res.post`` on ``_design/*/_update/*`` handlers
+* ``db.res.get("_changes", ...)`` with the normal, longpoll and continuous
+  feeds and filters, so that :class:`couchdbkit.Consumer` (and
+  :mod:`habitat.utils.immortal_changes`) work unmodified
+
+Views, filters, updates and validation functions are the Python functions
+from :mod:`habitat.views`, loaded as listed in ``couchdb/designdocs.yml``
+and run in-process. Errors are reported with the same exceptions couchdbkit
+and restkit would raise.
+
+Databases are shared by every :class:`Server` in the process, keyed by URI
+and name, so that :func:`install` can replace :class:`couchdbkit.Server`
+and let several habitat components talk to each other with no network::
+
+    memory_couch.install()
+    uploader = Uploader("habitat", couch_uri="http://memory")
+    daemon = ParserDaemon(config)   # with couch_uri: "http://memory"
+"""
+
+import os
+import copy
+import json
+import uuid
+import bisect
+import hashlib
+import threading
+import yaml
+import couchdbkit
+import couchdbkit.exceptions
+import restkit.errors
+
+from couch_named_python import ForbiddenError, UnauthorizedError
+
+from . import dynamicloader
+
+__all__ = ["Server", "Database", "install", "uninstall", "reset"]
+
+
+default_designdocs = os.path.join(os.path.dirname(__file__), "..", "..",
+                                  "couchdb", "designdocs.yml")
+
+_databases = {}
+_databases_lock = threading.Lock()
+_original_server = None
+
+
+def install():
+    """Replace :class:`couchdbkit.Server` with :class:`Server`."""
+    global _original_server
+    if _original_server is None:
+        _original_server = couchdbkit.Server
+        couchdbkit.Server = Server
+
+def uninstall():
+    """Undo :func:`install`."""
+    global _original_server
+    if _original_server is not None:
+        couchdbkit.Server = _original_server
+        _original_server = None
+
+def reset():
+    """Forget all databases."""
+    with _databases_lock:
+        _databases.clear()
+
+
+def collation_key(value):
+    """
+    Return a key that sorts JSON values in CouchDB's view collation order:
+    null, false, true, numbers, strings, arrays then objects.
+
+    Strings are compared by code point rather than with ICU.
+    """
+    if value is None:
+        return (0, )
+    elif value is False:
+        return (1, )
+    elif value is True:
+        return (2, )
+    elif isinstance(value, (int, long, float)):
+        return (3, value)
+    elif isinstance(value, basestring):
+        return (4, value)
+    elif isinstance(value, (list, tuple)):
+        return (5, [collation_key(v) for v in value])
+    elif isinstance(value, dict):
+        return (6, [(collation_key(k), collation_key(v))
+                    for k, v in sorted(value.items())])
+    else:
+        raise TypeError("Can't collate {0!r}".format(value))
+
+# Collates after anything collation_key can return.
+_collates_last = (7, )
+
+def _jsonify(value):
+    """Return a copy of *value* as it would be after a trip through JSON."""
+    return json.loads(json.dumps(value))
+
+
+class Server(object):
+    """
+    A stand-in for :class:`couchdbkit.Server`.
+
+    Documents are written as *userctx* (by default, an administrator) and
+    are checked by the ``validate_doc_update`` functions unless *validate*
+    is false.
+    """
+
+    def __init__(self, uri="http://127.0.0.1:5984", designdocs=None,
+                 userctx=None, validate=True):
+        self.uri = uri.rstrip("/")
+        self.designdocs = designdocs or default_designdocs
+        self.userctx = userctx or {"name": None, "roles": ["_admin"]}
+        self.validate = validate
+
+    def __getitem__(self, dbname):
+        with _databases_lock:
+            key = (self.uri, dbname)
+            if key not in _databases:
+                _databases[key] = Database(dbname, self.designdocs,
+                                           self.userctx, self.validate)
+            return _databases[key]
+
+    def __contains__(self, dbname):
+        return (self.uri, dbname) in _databases
+
+
+class _View(object):
+    """The rows emitted by one map function, kept sorted."""
+
+    def __init__(self, func):
+        self.func = func
+        # ((key collation key, id collation key), index, id, key, value)
+        self.rows = []
+        # doc id -> [rows]
+        self.by_doc = {}
+
+    def lower(self, key):
+        """Index of the first row whose key collates at or after *key*."""
+        return bisect.bisect_left(self.rows, ((key, ), ))
+
+    def upper(self, key):
+        """Index of the first row whose key collates after *key*."""
+        return bisect.bisect_left(self.rows, ((key, _collates_last), ))
+
+    def update(self, doc_id, doc):
+        for row in self.by_doc.pop(doc_id, []):
+            i = bisect.bisect_left(self.rows, row)
+            del self.rows[i]
+
+        if doc is None:
+            return
+
+        try:
+            emitted = list(self.func(doc) or [])
+        except Exception:
+            # CouchDB skips documents whose map functions fail.
+            emitted = []
+
+        rows = []
+        for index, (key, value) in enumerate(emitted):
+            key, value = _jsonify(key), _jsonify(value)
+            row = ((collation_key(key), collation_key(doc_id)), index,
+                   doc_id, key, value)
+            bisect.insort(self.rows, row)
+            rows.append(row)
+        if rows:
+            self.by_doc[doc_id] = rows
+
+
+class ViewResults(list):
+    """A list of rows, with the convenience methods couchdbkit provides."""
+
+    def first(self):
+        return self[0] if self else None
+
+    def all(self):
+        return list(self)
+
+
+class Database(object):
+    """A stand-in for :class:`couchdbkit.Database`."""
+
+    def __init__(self, dbname, designdocs, userctx, validate):
+        self.dbname = dbname
+        self.userctx = userctx
+        self.res = _Resource(self)
+
+        self.docs = {}
+        self.update_seq = 0
+        self.changes = []       # (seq, doc id), possibly superseded
+        self.doc_seqs = {}      # doc id -> (latest seq, doc)
+        self._condition = threading.Condition()
+
+        with open(designdocs) as f:
+            ddocs = yaml.safe_load(f)
+
+        self.views = {}
+        self.filters = {}
+        self.updates = {}
+        self.validators = []
+        for ddoc, funcs in ddocs.items():
+            for kind, store in (("views", self.views),
+                                ("filters", self.filters),
+                                ("updates", self.updates)):
+                for name, path in (funcs.get(kind) or {}).items():
+                    func = dynamicloader.load(path)
+                    if kind == "views":
+                        func = _View(func)
+                    store[ddoc + "/" + name] = func
+            if validate and "validate_doc_update" in funcs:
+                path = funcs["validate_doc_update"]
+                self.validators.append(dynamicloader.load(path))
+
+    def info(self):
+        with self._condition:
+            return {"db_name": self.dbname, "doc_count": len(self.docs),
+                    "update_seq": self.update_seq}
+
+    def get(self, docid):
+        with self._condition:
+            if docid not in self.docs:
+                raise couchdbkit.exceptions.ResourceNotFound(
+                        "missing", http_code=404)
+            return copy.deepcopy(self.docs[docid])
+
+    __getitem__ = get
+
+    def __contains__(self, docid):
+        return docid in self.docs
+
+    def doc_exist(self, docid):
+        return docid in self.docs
+
+    def save_doc(self, doc, **params):
+        """Save *doc*, setting its ``_id`` (if needed) and ``_rev``."""
+        with self._condition:
+            doc["_id"], doc["_rev"] = self._write(doc)
+        return {"ok": True, "id": doc["_id"], "rev": doc["_rev"]}
+
+    def save_docs(self, docs, **params):
+        """
+        Save each of *docs*, raising
+        :class:`couchdbkit.exceptions.BulkSaveError` if any failed.
+        """
+        results = []
+        errors = []
+        with self._condition:
+            for doc in docs:
+                try:
+                    doc["_id"], doc["_rev"] = self._write(doc)
+                except restkit.errors.ResourceError as e:
+                    error = "conflict" if e.status_int == 409 else "forbidden"
+                    result = {"id": doc.get("_id"), "error": error,
+                              "reason": e.msg}
+                    errors.append(result)
+                else:
+                    result = {"id": doc["_id"], "rev": doc["_rev"]}
+                results.append(result)
+
+        if errors:
+            raise couchdbkit.exceptions.BulkSaveError(errors, results)
+        return results
+
+    bulk_save = save_docs
+
+    def delete_doc(self, doc, **params):
+        """Delete *doc* (a document or an id)."""
+        if isinstance(doc, basestring):
+            doc = self.get(doc)
+        deleted = {"_id": doc["_id"], "_rev": doc.get("_rev"),
+                   "_deleted": True}
+        return self.save_doc(deleted)
+
+    def _write(self, doc):
+        """
+        Validate and store a copy of *doc*, returning its id and new
+        revision. Requires the lock.
+        """
+        doc = _jsonify(doc)
+        if "_id" not in doc:
+            doc["_id"] = uuid.uuid4().hex
+        doc_id = doc["_id"]
+        old = self.docs.get(doc_id)
+
+        old_rev = old["_rev"] if old is not None else None
+        if doc.get("_rev") != old_rev:
+            raise couchdbkit.exceptions.ResourceConflict(
+                    "Document update conflict.", http_code=409)
+
+        deleted = doc.get("_deleted", False)
+        if not deleted:
+            for validate in self.validators:
+                try:
+                    validate(doc, old, self.userctx, {})
+                except ForbiddenError as e:
+                    raise restkit.errors.Unauthorized(
+                            json.dumps({"forbidden": str(e)}), http_code=403)
+                except UnauthorizedError as e:
+                    raise restkit.errors.Unauthorized(
+                            json.dumps({"unauthorized": str(e)}),
+                            http_code=401)
+
+        generation = int(old_rev.split("-")[0]) if old_rev else 0
+        body = json.dumps(doc, sort_keys=True)
+        doc["_rev"] = "{0}-{1}".format(generation + 1,
+                                       hashlib.md5(body).hexdigest())
+
+        if deleted:
+            self.docs.pop(doc_id, None)
+            view_doc = None
+        else:
+            self.docs[doc_id] = doc
+            view_doc = doc
+
+        for view in self.views.itervalues():
+            view.update(doc_id, view_doc)
+
+        self.update_seq += 1
+        self.changes.append((self.update_seq, doc_id))
+        self.doc_seqs[doc_id] = (self.update_seq, doc)
+        self._condition.notify_all()
+        return doc_id, doc["_rev"]
+
+    def all_docs(self, **params):
+        """Query ``_all_docs``."""
+        return self.view("_all_docs", **params)
+
+    def view(self, view_name, **params):
+        """Query a view, returning a :class:`ViewResults` list of rows."""
+        with self._condition:
+            if view_name == "_all_docs":
+                rows = self._all_docs_rows(params.get("keys"))
+            elif view_name in self.views:
+                rows = self._view_rows(self.views[view_name], params)
+            else:
+                raise couchdbkit.exceptions.ResourceNotFound(
+                        "missing_named_view", http_code=404)
+
+            if params.get("include_docs"):
+                for row in rows:
+                    if "error" in row:
+                        continue
+                    linked = row["value"]
+                    if isinstance(linked, dict) and "_id" in linked:
+                        doc = self.docs.get(linked["_id"])
+                    else:
+                        doc = self.docs.get(row["id"])
+                    row["doc"] = copy.deepcopy(doc)
+
+            return ViewResults(rows)
+
+    def _all_docs_rows(self, keys):
+        if keys is None:
+            keys = sorted(self.docs)
+        rows = []
+        for key in keys:
+            if key in self.docs:
+                rows.append({"id": key, "key": key,
+                             "value": {"rev": self.docs[key]["_rev"]}})
+            else:
+                rows.append({"key": key, "error": "not_found"})
+        return rows
+
+    def _view_rows(self, view, params):
+        if "keys" in params:
+            selected = []
+            for key in params["keys"]:
+                key = collation_key(_jsonify(key))
+                selected += view.rows[view.lower(key):view.upper(key)]
+        else:
+            selected = self._key_range(view, params)
+
+        skip = params.get("skip", 0)
+        limit = params.get("limit")
+        selected = selected[skip:]
+        if limit is not None:
+            selected = selected[:limit]
+
+        return [{"id": doc_id, "key": copy.deepcopy(key),
+                 "value": copy.deepcopy(value)}
+                for _, _, doc_id, key, value in selected]
+
+    def _key_range(self, view, params):
+        descending = params.get("descending", False)
+        inclusive_end = params.get("inclusive_end", True)
+
+        if "key" in params:
+            params = dict(params, startkey=params["key"],
+                          endkey=params["key"])
+            inclusive_end = True
+
+        lo, hi = 0, len(view.rows)
+        start = end = None
+        if "startkey" in params:
+            start = collation_key(_jsonify(params["startkey"]))
+        if "endkey" in params:
+            end = collation_key(_jsonify(params["endkey"]))
+
+        if not descending:
+            if start is not None:
+                lo = view.lower(start)
+            if end is not None:
+                hi = view.upper(end) if inclusive_end else view.lower(end)
+            return view.rows[lo:hi]
+        else:
+            if start is not None:
+                hi = view.upper(start)
+            if end is not None:
+                lo = view.lower(end) if inclusive_end else view.upper(end)
+            return view.rows[lo:hi][::-1]
+
+    def _changes_since(self, since, filter_func, params):
+        """
+        Return the ``_changes`` results after *since*, with the sequence of
+        the last change examined. Requires the lock.
+        """
+        results = []
+        last_seq = since
+        limit = params.get("limit")
+        start = bisect.bisect_left(self.changes, (since + 1, ))
+
+        for seq, doc_id in self.changes[start:]:
+            if limit is not None and len(results) >= limit:
+                break
+            latest_seq, doc = self.doc_seqs[doc_id]
+            if latest_seq != seq:
+                continue
+            last_seq = seq
+
+            if filter_func is not None and \
+                    not filter_func(copy.deepcopy(doc), {"query": params}):
+                continue
+
+            result = {"seq": seq, "id": doc_id,
+                      "changes": [{"rev": doc["_rev"]}]}
+            if doc.get("_deleted"):
+                result["deleted"] = True
+            if params.get("include_docs"):
+                result["doc"] = copy.deepcopy(doc)
+            results.append(result)
+
+        return results, last_seq
+
+    def _changes(self, params):
+        """Handle a ``_changes`` request, returning a :class:`_Response`."""
+        filter_name = params.get("filter")
+        filter_func = None
+        if filter_name is not None:
+            if filter_name not in self.filters:
+                raise couchdbkit.exceptions.ResourceNotFound(
+                        "missing filter", http_code=404)
+            filter_func = self.filters[filter_name]
+
+        since = params.get("since", 0)
+        if since == "now":
+            since = self.update_seq
+        since = int(since)
+
+        feed = params.get("feed", "normal")
+        if feed == "continuous":
+            return _Response(stream=_ChangesStream(
+                self, since, filter_func, params))
+
+        with self._condition:
+            results, last_seq = self._changes_since(since, filter_func,
+                                                    params)
+            if feed == "longpoll" and not results:
+                timeout = params.get("timeout", 60000) / 1000.0
+                self._condition.wait(timeout)
+                results, last_seq = self._changes_since(since, filter_func,
+                                                        params)
+
+        return _Response({"results": results, "last_seq": last_seq})
+
+    def _update(self, ddoc, name, docid, body, params):
+        """Run an update handler, returning a :class:`_Response`."""
+        func = self.updates.get(ddoc + "/" + name)
+        if func is None:
+            raise couchdbkit.exceptions.ResourceNotFound(
+                    "missing update function", http_code=404)
+
+        req = {"id": docid, "query": params, "form": {}, "body": body}
+        if isinstance(body, dict):
+            req["form"] = body
+        if not isinstance(body, basestring):
+            req["body"] = json.dumps(body)
+
+        with self._condition:
+            doc = copy.deepcopy(self.docs.get(docid)) if docid else None
+            try:
+                doc, response = func(doc, req)
+            except ForbiddenError as e:
+                raise restkit.errors.Unauthorized(
+                        json.dumps({"forbidden": str(e)}), http_code=403)
+            except UnauthorizedError as e:
+                raise restkit.errors.Unauthorized(
+                        json.dumps({"unauthorized": str(e)}), http_code=401)
+
+            if isinstance(response, dict):
+                code = response.get("code",
+                        response.get("headers", {}).get("code", 200))
+                body = response.get("body",
+                        response.get("headers", {}).get("body", ""))
+                if code >= 400:
+                    raise restkit.errors.RequestFailed(body, http_code=code)
+                response = body
+
+            if doc is not None:
+                self._write(doc)
+
+        return _Response(response)
+
+
+class _Resource(object):
+    """Routes the raw requests habitat makes with ``db.res``."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, path, **params):
+        if path.strip("/") == "_changes":
+            return self.db._changes(params)
+        raise couchdbkit.exceptions.ResourceNotFound("not_found",
+                                                     http_code=404)
+
+    def put(self, path, payload=None, **params):
+        return self._update(path, payload, params)
+
+    def post(self, path, payload=None, **params):
+        return self._update(path, payload, params)
+
+    def _update(self, path, payload, params):
+        parts = path.strip("/").split("/", 4)
+        if len(parts) < 4 or parts[0] != "_design" or parts[2] != "_update":
+            raise couchdbkit.exceptions.ResourceNotFound("not_found",
+                                                         http_code=404)
+        docid = parts[4] if len(parts) == 5 else None
+        return self.db._update(parts[1], parts[3], docid, payload, params)
+
+
+class _Response(object):
+    """Enough of :class:`restkit.Response` for couchdbkit and habitat."""
+
+    def __init__(self, body=None, stream=None):
+        self.body = body
+        self.stream = stream
+
+    @property
+    def json_body(self):
+        return self.body
+
+    def body_string(self):
+        if isinstance(self.body, basestring):
+            return self.body
+        return json.dumps(self.body)
+
+    def skip_body(self):
+        pass
+
+    def body_stream(self):
+        return self.stream
+
+
+class _ChangesStream(object):
+    """
+    A continuous ``_changes`` feed, read a line at a time. ``readline``
+    blocks until there is a change, returning a blank line every
+    ``heartbeat`` milliseconds meanwhile.
+    """
+
+    def __init__(self, db, since, filter_func, params):
+        self.db = db
+        self.since = since
+        self.filter_func = filter_func
+        self.params = dict(params)
+        self.params.pop("limit", None)
+        self.heartbeat = params.get("heartbeat", 60000) / 1000.0
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def readline(self):
+        with self.db._condition:
+            if not self.pending:
+                self._read()
+                if not self.pending:
+                    self.db._condition.wait(self.heartbeat)
+                    self._read()
+            if not self.pending:
+                return "\n"
+            return json.dumps(self.pending.pop(0)) + "\n"
+
+    def _read(self):
+        results, self.since = self.db._changes_since(
+                self.since, self.filter_func, self.params)
+        self.pending += results
@@ -0,0 +1,279 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counters and timers, aggregated in memory and sent to statsd in batches.
+
+Sending a UDP packet to statsd for every event is costly when there are
+several events per message (one per filter run, for example). Instead,
+:func:`increment` and :func:`timing` just add to a dict, and every
+*interval* seconds (checked when a metric is recorded and, once
+:func:`configure` has been called, by a background thread, so that the last
+metrics before a quiet spell are not held back) the totals are sent in as few
+packets as possible::
+
+    metrics.increment("parser.parsed")
+    metrics.timing("parser.time", 0.012)
+
+    @metrics.timed("parser_daemon.save_time")
+    def save(doc):
+        ...
+
+Counters are sent as they are, as is the last value given to each gauge
+(:func:`gauge`). Each timer is kept in a :class:`Histogram`
+and sent as ``<name>.count``, ``<name>.p50``, ``<name>.p99`` and
+``<name>.max``. Names should be formatted once, not for every event.
+
+For compatibility with dashboards built on the ``<name>.total`` timers that
+``statsd.StatsdTimer`` used to send, the mean duration is also sent as
+``<name>.total`` with a sample rate of one over the number of events, so
+that statsd's count and mean for it stay correct (its upper bound and
+percentiles become the mean, however).
+
+The statsd host and port are read from the :mod:`statsd` module's settings,
+so :func:`statsd.init_statsd` still applies; every name is prefixed with
+``habitat.``.
+"""
+
+import bisect
+import socket
+import functools
+import threading
+import time
+import logging
+import statsd
+
+logger = logging.getLogger("habitat.utils.metrics")
+
+__all__ = ["Metrics", "Histogram", "increment", "gauge", "timing", "timed",
+           "flush", "configure"]
+
+
+class Histogram(object):
+    """
+    Counts of durations in exponentially sized buckets, from which
+    approximate percentiles can be read.
+    """
+
+    # upper bounds, in seconds
+    bounds = [0.0001 * (2 ** i) for i in xrange(18)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket containing the *p*th percentile
+        (capped at the largest duration seen).
+        """
+        if not self.n:
+            return 0.0
+        wanted = p / 100.0 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+
+class Metrics(object):
+    """
+    Aggregates counters and timers, sending them to statsd every *interval*
+    seconds.
+    """
+
+    prefix = "habitat"
+    percentiles = (50, 99)
+
+    # keep packets below a typical MTU
+    max_packet = 1400
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+        self._socket = None
+        self._thread = None
+        self._next_flush = time.time() + interval
+
+    def start(self):
+        """
+        Flush from a background thread whenever a flush is due, even if no
+        metrics are being recorded. Does nothing if already started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name="MetricsFlusher")
+            self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            wait = self._next_flush - time.time()
+            if wait > 0:
+                time.sleep(min(wait, self.interval))
+            else:
+                self.flush()
+
+    def increment(self, name, delta=1):
+        """Add *delta* to the counter *name*."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + delta
+            due = time.time() >= self._next_flush
+        if due:
+            self.flush()
+
+    def gauge(self, name, value):
+        """Set the gauge *name* (e.g., the length of a queue) to *value*."""
+        with self._lock:
+            self.gauges[name] = value
+            due = time.time() >= self._next_flush
+        if due:
+            self.flush()
+
+    def timing(self, name, seconds):
+        """Add a duration of *seconds* to the timer *name*."""
+        with self._lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                histogram = self.timers[name] = Histogram()
+            histogram.add(seconds)
+            due = time.time() >= self._next_flush
+        if due:
+            self.flush()
+
+    def timed(self, name):
+        """Decorator that records the duration of each call in *name*."""
+        def wrapper(func):
+            @functools.wraps(func)
+            def f(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.timing(name, time.time() - start)
+            return f
+        return wrapper
+
+    def flush(self):
+        """Send everything recorded so far to statsd, and reset."""
+        with self._lock:
+            counters = self.counters
+            gauges = self.gauges
+            timers = self.timers
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+            self._next_flush = time.time() + self.interval
+
+        lines = []
+        for name, value in counters.iteritems():
+            lines.append("{0}.{1}:{2}|c".format(self.prefix, name, value))
+        for name, value in gauges.iteritems():
+            lines.append("{0}.{1}:{2}|g".format(self.prefix, name, value))
+        for name, histogram in timers.iteritems():
+            name = "{0}.{1}".format(self.prefix, name)
+            lines.append("{0}.count:{1}|c".format(name, histogram.n))
+            for p in self.percentiles:
+                lines.append("{0}.p{1}:{2}|ms".format(
+                    name, p, histogram.percentile(p) * 1000))
+            lines.append("{0}.max:{1}|ms".format(name, histogram.max * 1000))
+            lines.append(self._total_line(name, histogram))
+
+        for packet in self._packets(lines):
+            self._send(packet)
+
+    def _total_line(self, name, histogram):
+        """The old ``<name>.total`` timer, as one sampled event."""
+        line = "{0}.total:{1}|ms".format(
+                name, histogram.total / histogram.n * 1000)
+        if histogram.n > 1:
+            line += "|@{0}".format(1.0 / histogram.n)
+        return line
+
+    def _packets(self, lines):
+        """Join *lines* into as few packets as possible."""
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.max_packet:
+                yield "\n".join(packet)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            yield "\n".join(packet)
+
+    def _send(self, packet):
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_DGRAM)
+            self._socket.sendto(packet,
+                                (statsd.STATSD_HOST, statsd.STATSD_PORT))
+        except socket.error:
+            logger.debug("Could not send metrics to statsd", exc_info=True)
+
+
+_metrics = Metrics()
+
+def increment(name, delta=1):
+    """Add *delta* to the counter *name*; see :meth:`Metrics.increment`."""
+    _metrics.increment(name, delta)
+
+def gauge(name, value):
+    """Set the gauge *name* to *value*; see :meth:`Metrics.gauge`."""
+    _metrics.gauge(name, value)
+
+def timing(name, seconds):
+    """Record a duration for the timer *name*; see :meth:`Metrics.timing`."""
+    _metrics.timing(name, seconds)
+
+def timed(name):
+    """Decorator to time calls in *name*; see :meth:`Metrics.timed`."""
+    return _metrics.timed(name)
+
+def flush():
+    """Send all metrics to statsd now."""
+    _metrics.flush()
+
+def configure(interval):
+    """
+    Set how often (in seconds) metrics are sent to statsd, and start sending
+    them from a background thread (see :meth:`Metrics.start`).
+    """
+    _metrics.interval = interval
+    _metrics._next_flush = min(_metrics._next_flush, time.time() + interval)
+    _metrics.start()
@@ -0,0 +1,130 @@
+# Copyright 2013 (C) Daniel Richman, Adam Greig
+#
+# This file is part of habitat.
+#
+# habitat is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# habitat is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with habitat.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time each stage of processing a message, and aggregate the results.
+
+A :class:`StageTimer` records how long one message spent in each stage
+(and which parser module and payload_configuration were involved)::
+
+    timer = StageTimer("doc id")
+    with timer.stage("pre_parse", "UKHAS"):
+        ...
+    timer.config_id = "payload_configuration id"
+    with timer.stage("parse", "UKHAS"):
+        ...
+
+:class:`StageTimings` then records finished timers as
+:mod:`metrics <habitat.utils.metrics>` timers per stage, module and
+payload_configuration, and logs the full breakdown of any message that took
+longer than *slow_threshold* seconds.
+"""
+
+import logging
+import time
+
+from . import metrics
+
+logger = logging.getLogger("habitat.utils.stage_timing")
+
+__all__ = ["StageTimer", "StageTimings"]
+
+
+class _Stage(object):
+    def __init__(self, timer, name, module):
+        self.timer = timer
+        self.name = name
+        self.module = module
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, self.module, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """
+    The time one message spent in each stage.
+
+    Each stage is tagged with the :attr:`config_id` set when it finished.
+    """
+
+    def __init__(self, doc_id=None):
+        self.doc_id = doc_id
+        self.config_id = None
+        self.entries = []
+        self.start = time.time()
+
+    def stage(self, name, module=None):
+        """Return a context manager that times the stage *name*."""
+        return _Stage(self, name, module)
+
+    def add(self, name, module, seconds):
+        """Record that *seconds* were spent in the stage *name*."""
+        self.entries.append((name, module, self.config_id, seconds))
+
+    def total(self):
+        """Seconds since the timer was created."""
+        return time.time() - self.start
+
+    def describe(self):
+        """A one line breakdown of the stages, for logging."""
+        parts = []
+        for name, module, config_id, seconds in self.entries:
+            if module is not None:
+                name = "{0} ({1})".format(name, module)
+            parts.append("{0} {1:.1f}ms".format(name, seconds * 1000))
+        return ", ".join(parts)
+
+
+class StageTimings(object):
+    """
+    Records :class:`StageTimer` results in :mod:`habitat.utils.metrics`,
+    as the timer ``<prefix>.<stage>.<module>.<config id>``.
+
+    Messages that took longer than *slow_threshold* seconds are logged with
+    their breakdown.
+    """
+
+    def __init__(self, prefix, slow_threshold=None):
+        self.prefix = prefix
+        self.slow_threshold = slow_threshold
+        self._names = {}
+
+    def record(self, timer):
+        """Add the stages of a finished *timer*."""
+        total = timer.total()
+
+        for stage, module, config_id, seconds in timer.entries:
+            key = (stage, module, config_id)
+            name = self._names.get(key)
+            if name is None:
+                name = self._names[key] = ".".join(
+                        [self.prefix] + [_bucket(k or "none") for k in key])
+            metrics.timing(name, seconds)
+
+        if self.slow_threshold and total >= self.slow_threshold:
+            logger.warning("Slow message {0}: {1:.1f}ms ({2})"
+                           .format(timer.doc_id, total * 1000,
+                                   timer.describe()))
+
+
+def _bucket(part):
+    """Make *part* safe to use in a statsd bucket name."""
+    return str(part).replace(".", "_").replace(":", "_")
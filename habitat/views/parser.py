@@ -17,19 +17,55 @@
 """
 Functions for the parser design document.
 
-Contains a filter to select unparsed payload_telemetry.
+Contains a filter to select unparsed payload_telemetry and a filter to
+select the documents used to configure the parser.
 """
 
+import zlib
+
 from couch_named_python import version
 
-@version(1)
+def shard_of(doc_id, shards):
+    """
+    The shard (from 0 to *shards* - 1) that the document *doc_id* belongs to,
+    when the parser is split across *shards* daemons.
+
+    This is the CRC32 of the UTF-8 encoded ID, so is the same in every
+    process.
+    """
+    if isinstance(doc_id, unicode):
+        doc_id = doc_id.encode("utf-8")
+    return (zlib.crc32(doc_id) & 0xffffffff) % shards
+
+@version(2)
 def unparsed_filter(doc, req):
     """
     Filter: ``parser/unparsed``
 
     Only select unparsed payload_telemetry documents.
+
+    If the query parameters ``shard`` and ``shards`` are given, only
+    documents whose ID is in that shard (see :func:`shard_of`) are selected.
     """
     if 'type' in doc and doc['type'] == "payload_telemetry":
         if 'data' in doc and '_parsed' not in doc['data']:
+            query = req.get('query', {})
+            if 'shards' in query:
+                shard = shard_of(doc['_id'], int(query['shards']))
+                return shard == int(query['shard'])
             return True
     return False
+
+@version(1)
+def configs_filter(doc, req):
+    """
+    Filter: ``parser/configs``
+
+    Only select flight and payload_configuration documents, and deletions
+    (which cannot be told apart by type).
+    """
+    if doc.get('_deleted'):
+        return True
+    if 'type' in doc and doc['type'] in ("flight", "payload_configuration"):
+        return True
+    return False
@@ -275,6 +275,50 @@ def add_listener_update(doc, req):
     doc["receivers"][callsign] = protodoc["receivers"][callsign]
     return doc, "OK"
 
+@version(1)
+def add_parsed_data_update(doc, req):
+    """
+    Update function: ``payload_telemetry/_update/add_parsed_data``
+
+    Given an object containing just the ``data`` produced by the parser in
+    the request body, merge it into the existing document's ``data``.
+
+    Used by the parser daemon to save its results without first fetching the
+    document, so that it does not have to race listeners adding themselves
+    to ``receivers``.
+
+    Usage::
+
+        PUT /habitat/_design/payload_telemetry/_update/add_parsed_data/<doc ID>
+
+        {
+            "data": {
+                "_raw": "<base64 raw telemetry data>",
+                "_parsed": {...},
+                <parsed fields>
+            }
+        }
+
+    ``_raw``, if given, must match the document's.
+
+    Returns "OK" if everything was fine, otherwise CouchDB will raise an error.
+    Validation applies as usual, so only the parser may use this function.
+    In the event of a save conflict the same request should be retried.
+    """
+    if doc is None:
+        raise ForbiddenError("document does not exist")
+    try:
+        protodoc = json.loads(req["body"])
+    except ValueError:
+        raise ForbiddenError("invalid JSON")
+    if not isinstance(protodoc.get("data"), dict):
+        raise ForbiddenError("data is required")
+    data = protodoc["data"]
+    if data.get("_raw", doc["data"]["_raw"]) != doc["data"]["_raw"]:
+        raise ForbiddenError("data._raw may not be changed")
+    doc["data"].update(data)
+    return doc, "OK"
+
 @version(3)
 def http_post_update(doc, req):
     """